@@ -1,86 +1,475 @@
+import io
 import os
+import hashlib
+from collections import deque, Counter
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from functools import partial
+from PIL import Image
 from observer import Observer
-from planner import Planner
-from web_navigator import WebNavigator
-from vision_processor import VisionProcessor
+from planner import Planner, AsyncPlanner, LATE_FIELDS
+from web_navigator import WebNavigator, AsyncWebNavigator
+from vision_processor import VisionProcessor, AsyncVisionProcessor
+from utils import element_candidates, normalize_target, draw_marks, frame_change, crop_region, encode_screenshot
+from trajectory_cache import TrajectoryCache, url_pattern
+
+# Prefixed to an observation when the screen is pixel-for-pixel what the last one described
+NO_CHANGE_NOTE = "(The screen did not visibly change after the last action.)\n"
+
+# Planner actions carried out by the browser: navigator method, required action fields, what the user is told
+BROWSER_ACTIONS = {
+    "NAVIGATE": ("navigate", ("url",), "I will navigate to {url}."),
+    "CLICK": ("click", ("element_description",), "I will click on '{element_description}'."),
+    "TYPE": ("type", ("text", "element_description"), "I will type '{text}' into '{element_description}'."),
+    "SCROLL": ("scroll", ("direction",), "I will scroll {direction}."),
+    "WAIT": ("wait", ("seconds",), "I will wait {seconds} seconds."),
+    "CLEAR_INPUT": ("clear_input", ("element_description",), "I will clear the input field '{element_description}'."),
+}
+
+
+def load_openai_api_key():
+    """OPENAI_API_KEY, else the contents of .openai_api_key (exported to the environment), else None."""
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        if os.path.exists(".openai_api_key"):
+            with open(".openai_api_key", "r") as f:
+                api_key = f.read().strip()
+            os.environ["OPENAI_API_KEY"] = api_key
+        else:
+            print("Warning: OPENAI_API_KEY not set.")
+    return api_key
+
+
+def _frame_digest(frame):
+    return hashlib.blake2b(frame.image_bytes, digest_size=16).digest()
+
+
+def _changed_region(image_bytes, bbox):
+    """JPEG crop around the changed bbox of a screenshot, for a region-only description."""
+    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    return encode_screenshot(img.crop(crop_region(img.size, bbox, margin=0.25, min_fraction=0.2)), "jpeg", 90)
+
 
 class Agent:
-    def __init__(self):
-        self.openai_api_key = os.environ.get("OPENAI_API_KEY")
-        if not self.openai_api_key:
-            if os.path.exists(".openai_api_key"):
-                with open(".openai_api_key", "r") as f:
-                    self.openai_api_key = f.read().strip()
-                os.environ["OPENAI_API_KEY"] = self.openai_api_key
-            else:
-                 print("Warning: OPENAI_API_KEY not set.")
+    """
+    Observe -> plan -> act loop. The loop and its helpers are written once as
+    generators of operations (see _drive); Agent runs them on threads and
+    AsyncAgent on an event loop, so the two only differ in how they wait.
+    """
 
-        self.vision_processor = VisionProcessor()
-        self.web_navigator = WebNavigator(self.vision_processor)
+    vision_class = VisionProcessor
+    navigator_class = WebNavigator
+    planner_class = Planner
+
+    def __init__(self, vision_processor=None, browser_pool=None, web_navigator=None, openai_client=None):
+        self.openai_api_key = load_openai_api_key()
+
+        # A multi-session server shares one vision client, one OpenAI client and one Chromium (BrowserPool)
+        # across agents, or hands each agent a RemoteNavigator on a browser worker process
+        self._owns_vision = vision_processor is None
+        self.vision_processor = vision_processor or self.vision_class()
+        self.web_navigator = web_navigator or self.navigator_class(self.vision_processor, pool=browser_pool)
         self.observer = Observer(self.vision_processor)
-        self.planner = Planner(self.openai_api_key)
+        self.planner = self.planner_class(self.openai_api_key, client=openai_client)
         self.conversation_history = []
+        # Planner calls, speculative grounding and next-frame prefetch overlap on this pool
+        self.executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="agent-pipeline")
+        self.speculative_targets = int(os.environ.get("AGENT_SPECULATIVE_TARGETS", "6"))
+        self._prefetch = None
+        self._planning = None  # planner call still streaming after its action was dispatched early
+        # Remaining steps of a planner action sequence, executed without re-planning
+        self._queued_actions = deque()
+        # Numbered element list shown to the planner so CLICK/TYPE can name an element by id
+        self.element_index = os.environ.get("AGENT_ELEMENT_INDEX", "1") == "1"
+        self.element_limit = int(os.environ.get("AGENT_ELEMENT_LIMIT", "50"))
+        self._elements = None  # ElementList the current plan refers to
+        # Re-observations diff the new frame against the last described ones and only describe what changed
+        self.change_detection = os.environ.get("AGENT_CHANGE_DETECTION", "1") == "1"
+        self._last_observed = None  # (image_bytes, description) of the latest observation
+        self._full_observed = None  # (image_bytes, description) of the latest whole-page description
+        self.stats = Counter()  # planner_calls, actions, macro_steps, checkpoint_failures, replayed
+        # Successful runs are memoized per goal/page and replayed before asking the planner. Opt-in: the
+        # store is shared by everyone who runs the same goal (typed user answers are never kept, see TrajectoryCache)
+        cache_path = os.environ.get("TRAJECTORY_CACHE", "")
+        self.trajectories = TrajectoryCache(
+            cache_path,
+            max_steps=int(os.environ.get("TRAJECTORY_CACHE_MAX_STEPS", "5000")),
+            max_distance=int(os.environ.get("TRAJECTORY_MAX_DISTANCE", "8")),
+        ) if cache_path else None
+
+    def close(self):
+        """Release the browser (or this agent's context in a shared one) and a vision client it built."""
+        self.executor.shutdown(wait=False)
+        self.web_navigator.close()
+        if self._owns_vision:
+            self.vision_processor.close()
 
     def reset(self):
         self.conversation_history = []
+        self._prefetch = None
+        self._planning = None
+        self._queued_actions.clear()
+        self._elements = None
+        self._last_observed = self._full_observed = None
+        self.stats = Counter()
+        self.planner.reset()
 
     def run(self, user_goal, socketio, shared_state):
+        return self._drive(self._run(user_goal, socketio, shared_state))
+
+    def _drive(self, steps):
+        """
+        Run a step generator to completion. Steps yield (operation, *args) and are
+        sent the result, or have the operation's exception thrown in:
+          _io(fn, *args)      a navigator, vision, planner or user wait
+          _cpu(fn, *args)     image or cache work that would block an event loop
+          _spawn(fn, *args)   start fn in the background; a future
+          _result(future, timeout=None), _first(futures), _new_future()
+        """
+        value, error = None, None
+        while True:
+            try:
+                operation = steps.send(value) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value, error = getattr(self, operation[0])(*operation[1:]), None
+            except Exception as e:
+                value, error = None, e
+
+    # Operations for the threaded agent: block the calling thread
+
+    def _io(self, fn, *args):
+        return fn(*args)
+
+    def _cpu(self, fn, *args):
+        return fn(*args)
+
+    def _spawn(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def _result(self, future, timeout=None):
+        return future.result(timeout=timeout)
+
+    def _first(self, futures):
+        wait(futures, return_when=FIRST_COMPLETED)
+
+    def _new_future(self):
+        return Future()
+
+    # The agent's steps, shared by Agent and AsyncAgent
+
+    def _join_plan(self):
+        """Wait for a planner call that is still streaming after an early dispatch; its final action."""
+        planning, self._planning = self._planning, None
+        if planning is None:
+            return None
+        return (yield ("_result", planning))  # get_next_action reports its own errors as an action
+
+    @staticmethod
+    def _reconcile(action, final):
+        """Fields of the finished plan that streamed in after action was dispatched early."""
+        if not final or final.get("action") != action.get("action"):
+            return action  # a sequence (its steps arrive whole) or an unrelated fallback
+        for field in LATE_FIELDS:
+            if field in final and field not in action:
+                if field == "element_id":
+                    print(f"⚠️ element_id {final[field]} arrived after {action['action']} was dispatched; "
+                          f"it was grounded by description.")
+                else:
+                    action[field] = final[field]
+        return action
+
+    def _checkpoint(self, expect, url_before, frame_before):
+        """Reason the step's declared checkpoint failed, or "" if it holds."""
+        if expect == "url_changed" and (yield ("_io", self.web_navigator.get_current_url)) == url_before:
+            return "the URL did not change"
+        if expect == "frame_changed":
+            frame = yield ("_io", self.web_navigator.get_frame)
+            if frame and _frame_digest(frame) == _frame_digest(frame_before):
+                return "the page did not visibly change"
+        return ""
+
+    def _element_list(self):
+        if not self.element_index:
+            return None
+        return (yield ("_io", self.web_navigator.get_elements, self.element_limit)) or None
+
+    def _describe(self, frame, on_token=None):
+        """
+        (description, elements) of frame. An unchanged screen reuses the last
+        description, a local change only describes the changed region, and
+        anything else is one whole-page vision call. Indexed elements without
+        a text label are tagged with their ids on the image, so the description
+        can name them for the planner.
+        """
+        elements = yield from self._element_list()
+        description = (yield from self._describe_change(frame, on_token)) if self.change_detection else None
+        if description is not None:
+            return description, elements
+        if elements and elements.unlabeled:
+            image = yield ("_cpu", draw_marks, frame.image_bytes, elements.unlabeled)
+            description = yield ("_io", self.observer.observe, image, self.vision_processor.MARKED_DESCRIBE_PROMPT, on_token)
+        else:
+            description = yield ("_io", self.observer.observe, frame.image_bytes, None, on_token)
+        self.stats["observations_full"] += 1
+        self._last_observed = self._full_observed = (frame.image_bytes, description)
+        return description, elements
+
+    def _describe_change(self, frame, on_token=None):
+        """Description of frame built from earlier observations, or None if it needs a whole-page one."""
+        if self._last_observed is not None:
+            image_bytes, description = self._last_observed
+            if (yield ("_cpu", frame_change, image_bytes, frame.image_bytes))[0] == "none":
+                self.stats["observations_reused"] += 1
+                return NO_CHANGE_NOTE + description
+        if self._full_observed is None:
+            return None
+        image_bytes, description = self._full_observed
+        kind, bbox = yield ("_cpu", frame_change, image_bytes, frame.image_bytes)
+        if kind == "global":
+            return None
+        if kind == "local":
+            crop = yield ("_cpu", _changed_region, frame.image_bytes, bbox)
+            header = f"{description}\n\nUpdate: the region {bbox} (0..1000 page coordinates) changed; it now shows:\n"
+            region = yield ("_io", self.observer.observe, crop, self.vision_processor.REGION_DESCRIBE_PROMPT,
+                            on_token and (lambda text: on_token(header + text)))
+            description = header + region
+            self.stats["observations_local"] += 1
+        else:
+            self.stats["observations_reused"] += 1  # back to the page as last fully described
+        self._last_observed = (frame.image_bytes, description)
+        return description
+
+    def _prefetch_observation(self, socketio):
+        """Capture and describe the next frame as soon as the last action has settled."""
+        frame = yield ("_io", self.web_navigator.get_frame)
+        if not frame:
+            raise RuntimeError("could not capture a screenshot")
+        current_url = yield ("_io", self.web_navigator.get_current_url)
+        return frame.version, (yield from self._describe(frame, self._stream_observation(socketio, current_url)))
+
+    @staticmethod
+    def _stream_observation(socketio, current_url):
+        """on_token that streams a description to the UI, headed by the page URL."""
+        url_prefix = f"Current URL: {current_url}\n" if current_url else ""
+        return lambda text: socketio.emit('agent_observation_partial', {'data': url_prefix + text})
+
+    def _observe_frame(self, frame, on_token=None):
+        """(description, elements) of frame, reusing the prefetched ones when made from the same page version."""
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch is not None:
+            try:
+                version, observation = yield ("_result", prefetch)
+                if version == frame.version:
+                    return observation
+            except Exception:
+                pass  # speculative; fall through to a fresh observation
+        return (yield from self._describe(frame, on_token))
+
+    def _element_ref(self, action):
+        """(element_id, generation) for the navigator if the action names an element from the shown list."""
+        if self._elements is None:
+            return None, None
+        try:
+            return int(action["element_id"]), self._elements.generation
+        except (KeyError, TypeError, ValueError):
+            return None, None
+
+    def _action_call(self, action):
+        """
+        (response to the user, failure reason, navigator method, args) for a
+        BROWSER_ACTIONS action; the failure reason is set when a required field is missing.
+        """
+        method, fields, message = BROWSER_ACTIONS[action["action"]]
+        response_to_user = message.format(**{f: action.get(f) for f in fields})
+        values = [action.get(f) for f in fields]
+        # WAIT 0 is a valid wait; everything else must be non-empty
+        if any(v is None if action["action"] == "WAIT" else not v for v in values):
+            missing = " or ".join(f"'{f}'" for f in fields)
+            return response_to_user, f"Missing {missing} for {action['action']} action.", None, None
+        if "element_description" in fields:
+            values.extend(self._element_ref(action))
+        return response_to_user, "", method, values
+
+    def _ask_user(self, question, socketio, shared_state):
+        # Parks the session until the user answers; an asyncio.Event for AsyncAgent
+        user_input_event = shared_state["user_input_event"]
+        socketio.emit('request_user_input', {'question': question})
+        yield ("_io", user_input_event.wait)
+        user_input_event.clear()
+        self.conversation_history.append({"role": "assistant", "content": question})
+        self.conversation_history.append({"role": "user", "content": shared_state["user_response"], "answer": True})
+
+    @staticmethod
+    def _options_message(action):
+        message = f"I found a few options for {action.get('topic', 'your item')}:\n"
+        for i, option in enumerate(action.get('options', [])):
+            title = option.get('title', 'N/A')
+            price = option.get('price', 'N/A')
+            message += f"{i+1}. {title} - {price}\n"
+        return message + "\nPlease let me know which one you'd like, or if you want me to keep looking."
+
+    def _record_trajectory(self, user_goal, trajectory, current_url):
+        """Store a finished run's steps, each with the URL it led to, for replay."""
+        if self.trajectories is None or not trajectory:
+            return
+        urls_after = [url for url, _, _ in trajectory[1:]] + [current_url]
+        answers = [entry["content"] for entry in self.conversation_history if entry.get("answer")]
+        self.trajectories.record(
+            user_goal, [(*step, url_after) for step, url_after in zip(trajectory, urls_after)], user_inputs=answers,
+        )
+        print(f"♻️ Trajectory cache: {self.trajectories.metrics()}")
+
+    def _speculate_grounding(self, frame, description):
+        """
+        Ground the elements the page description names while the planner is
+        deciding, so a CLICK/TYPE on one of them skips its own vision call.
+        Results are tied to the frame version and dropped if the page changes.
+        """
+        targets = element_candidates(description or "", self.speculative_targets)
+        if not targets:
+            return None, set()
+        speculation = yield ("_spawn", self._drive, self._ground_targets(frame, targets))
+        return speculation, {normalize_target(t) for t in targets}
+
+    def _ground_targets(self, frame, targets):
+        bboxes = yield ("_io", self.vision_processor.get_element_bboxes, frame.image_bytes, targets)
+        for target, bbox in zip(targets, bboxes):
+            self.web_navigator.frames.add_hint(frame.version, target, bbox)
+
+    def _plan(self, frame, screenshot_description, planner_description, current_url, socketio):
+        """Plan and pre-ground likely targets on the same frame concurrently; act on the first executable action."""
+        # A previous planner call still streaming must finish first, as both update the planner context
+        yield from self._join_plan()
+        early = yield ("_new_future",)
+
+        def on_action(action):
+            if not early.done():
+                early.set_result(action)
+
+        def show_plan(text, done=False):
+            socketio.emit('agent_plan' if done else 'agent_plan_partial', {'data': text})
+
+        plan = yield ("_spawn", partial(
+            self.planner.get_next_action, list(self.conversation_history), planner_description, current_url,
+            on_action=on_action, on_partial=show_plan,
+        ))
+        if self._elements and self._elements.listing:
+            speculation, speculated = None, set()  # targets resolve by id or from the DOM
+        else:
+            speculation, speculated = yield from self._speculate_grounding(frame, screenshot_description)
+        # Act as soon as the streamed action is executable; the planner finishes its reason meanwhile
+        yield ("_first", [early, plan])
+        action = early.result() if early.done() else plan.result()
+        if early.done():
+            self._planning = plan
+        self.stats["planner_calls"] += 1
+        if action["action"] == "MACRO":
+            steps = action["actions"]
+            print(f"🤖 Planner returned a {len(steps)}-step sequence.")
+            self._queued_actions.extend(steps[1:])
+            action = steps[0]
+        target = action.get("element_description")
+        if speculation is not None:
+            if target and normalize_target(target) in speculated:
+                # The planner picked a pre-grounded element: let that grounding finish rather than repeat it
+                try:
+                    yield ("_result", speculation, 60)
+                except Exception:
+                    pass
+            else:
+                # Left to finish; its outcome is collected so a failure is not reported as unhandled
+                speculation.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return action
+
+    def _pause(self, seconds):
+        """Brief backoff to let the page settle before retrying."""
+        try:
+            yield ("_io", self.web_navigator.wait, seconds)
+        except Exception:
+            pass
+
+    def _run(self, user_goal, socketio, shared_state):
         self.conversation_history.append({"role": "user", "content": user_goal})
-        
+
         screenshot_description = ""
-        user_input_event = shared_state["user_input_event"]
         retry_count = 0
         max_retries = 3
+        trajectory = []      # (url, image_bytes, action) of each step that worked, for the cache
+        replaying = self.trajectories is not None
+        replayed_ids = set()
 
         while True:
-            screenshot_bytes = self.web_navigator.take_screenshot()
+            if shared_state.get("cancelled"):
+                print("🛑 Task cancelled.")
+                return
+            frame = yield ("_io", self.web_navigator.get_frame)
+            screenshot_bytes = frame.image_bytes if frame else None
             if not isinstance(screenshot_bytes, (bytes, bytearray)):
                 socketio.emit('agent_response', {'data': 'I could not capture a screenshot (browser timeout). Retrying...'} )
-                # brief backoff to let the page settle
-                try:
-                    self.web_navigator.wait(1)
-                except Exception:
-                    pass
+                yield from self._pause(1)
                 continue
-            current_url = self.web_navigator.get_current_url()
-            
-            if not screenshot_description:
-                try:
-                    screenshot_description = self.observer.observe(screenshot_bytes)
-                except Exception as e:
-                    socketio.emit('agent_response', {'data': f'Vision service error: {e}. Retrying...'} )
-                    try:
-                        self.web_navigator.wait(1)
-                    except Exception:
-                        pass
-                    continue
-                # Add observation to history so the planner can build memory
-                self.conversation_history.append({
-                    "role": "assistant",
-                    "content": f"Observation (URL={self.web_navigator.get_current_url()}):\n{screenshot_description}"
-                })
+            current_url = yield ("_io", self.web_navigator.get_current_url)
 
-            # Include current URL in the observation stream for transparency
-            display_obs = (f"Current URL: {current_url}\n" if current_url else "") + (screenshot_description or "")
-            socketio.emit('agent_observation', {'data': display_obs})
+            replay = None
+            if replaying and not self._queued_actions and not screenshot_description:
+                replay = yield ("_cpu", partial(
+                    self.trajectories.lookup, user_goal, current_url, screenshot_bytes, exclude=replayed_ids))
 
-            action = self.planner.get_next_action(self.conversation_history, screenshot_description, current_url)
+            if self._queued_actions:
+                # Next step of a planned sequence: no new observation or planner call
+                action = self._queued_actions.popleft()
+                self.stats["macro_steps"] += 1
+            elif replay is not None:
+                # A previous successful run took this step on this page: repeat it without vision or planner
+                step_id, action, url_after = replay
+                replayed_ids.add(step_id)
+                self.stats["replayed"] += 1
+                print(f"♻️ Replaying cached step: {action}")
+            else:
+                elements = None
+                if not screenshot_description:
+                    try:
+                        # Stream the description to the UI as it is generated
+                        screenshot_description, elements = yield from self._observe_frame(
+                            frame, self._stream_observation(socketio, current_url),
+                        )
+                    except Exception as e:
+                        socketio.emit('agent_response', {'data': f'Vision service error: {e}. Retrying...'} )
+                        yield from self._pause(1)
+                        continue
+                    # Add observation to history so the planner can build memory
+                    observation = screenshot_description
+                    if observation.startswith(NO_CHANGE_NOTE):
+                        observation = NO_CHANGE_NOTE.strip()  # the page text is already in the history
+                    observed_url = yield ("_io", self.web_navigator.get_current_url)
+                    self.conversation_history.append({
+                        "role": "assistant",
+                        "content": f"Observation (URL={observed_url}):\n{observation}"
+                    })
+                else:
+                    elements = yield from self._element_list()
+                self._elements = elements
+                planner_description = screenshot_description
+                if elements and elements.listing:
+                    planner_description += "\n\nInteractive elements:\n" + elements.listing
+
+                # Include current URL in the observation stream for transparency
+                display_obs = (f"Current URL: {current_url}\n" if current_url else "") + (screenshot_description or "")
+                socketio.emit('agent_observation', {'data': display_obs})
+                action = yield from self._plan(frame, screenshot_description, planner_description, current_url, socketio)
 
             screenshot_description = ""
             action_failed = False
             failure_reason = ""
             response_to_user = ""
+            url_before, frame_before = current_url, frame
 
             if action["action"] == "RETRY":
                 retry_count += 1
                 if retry_count >= max_retries:
-                    question = "I'm having trouble. Can you please guide me?"
-                    socketio.emit('request_user_input', {'question': question})
-                    user_input_event.wait()
-                    user_input_event.clear()
-                    user_response = shared_state["user_response"]
-                    self.conversation_history.append({"role": "assistant", "content": question})
-                    self.conversation_history.append({"role": "user", "content": user_response})
+                    yield from self._ask_user("I'm having trouble. Can you please guide me?", socketio, shared_state)
                     retry_count = 0 
                 else:
                     print(f"🤖 Planner returned malformed JSON, retrying ({retry_count}/{max_retries})...")
@@ -90,7 +479,7 @@ class Agent:
 
             if action["action"] == "OBSERVE":
                 q = action.get("question")
-                screenshot_description = self.observer.observe(screenshot_bytes, q)
+                screenshot_description = yield ("_io", self.observer.observe, screenshot_bytes, q)
                 # Persist observation to history to avoid repeated re-observations
                 self.conversation_history.append({
                     "role": "assistant",
@@ -99,33 +488,15 @@ class Agent:
                 continue
 
             elif action["action"] == "SUMMARIZE_OPTIONS":
-                summary_message = f"I found a few options for {action.get('topic', 'your item')}:\n"
-                for i, option in enumerate(action.get('options', [])):
-                    title = option.get('title', 'N/A')
-                    price = option.get('price', 'N/A')
-                    summary_message += f"{i+1}. {title} - {price}\n"
-                summary_message += "\nPlease let me know which one you'd like, or if you want me to keep looking."
-                
-                question = summary_message
-                socketio.emit('request_user_input', {'question': question})
-                user_input_event.wait()
-                user_input_event.clear()
-                user_response = shared_state["user_response"]
-                self.conversation_history.append({"role": "assistant", "content": question})
-                self.conversation_history.append({"role": "user", "content": user_response})
+                yield from self._ask_user(self._options_message(action), socketio, shared_state)
                 continue
 
             elif action["action"] == "ASK_USER":
-                question = action.get("question", "What should I do next?")
-                socketio.emit('request_user_input', {'question': question})
-                user_input_event.wait()
-                user_input_event.clear()
-                user_response = shared_state["user_response"]
-                self.conversation_history.append({"role": "assistant", "content": question})
-                self.conversation_history.append({"role": "user", "content": user_response})
+                yield from self._ask_user(action.get("question", "What should I do next?"), socketio, shared_state)
                 continue 
 
             elif action["action"] == "FINISH":
+                yield ("_cpu", self._record_trajectory, user_goal, trajectory, current_url)
                 response_to_user = action.get("reason", "Task is complete.")
                 socketio.emit('agent_response', {'data': f"Task Complete: {response_to_user}"})
                 socketio.emit('task_finished')
@@ -133,60 +504,12 @@ class Agent:
                 return 
 
             # Construct response first, then execute action
-            elif action["action"] == "NAVIGATE":
-                url = action.get("url")
-                response_to_user = f"I will navigate to {url}."
-                if not url:
-                    action_failed = True
-                    failure_reason = "Missing 'url' for NAVIGATE action."
-                else:
-                    if not self.web_navigator.navigate(url): action_failed = True
-
-            elif action["action"] == "CLICK":
-                element = action.get("element_description")
-                response_to_user = f"I will click on '{element}'."
-                if not element:
-                    action_failed = True
-                    failure_reason = "Missing 'element_description' for CLICK action."
-                else:
-                    if not self.web_navigator.click(element): action_failed = True
-
-            elif action["action"] == "TYPE":
-                text = action.get("text")
-                element = action.get("element_description")
-                response_to_user = f"I will type '{text}' into '{element}'."
-                if not text or not element:
-                    action_failed = True
-                    failure_reason = "Missing 'text' or 'element_description' for TYPE action."
-                else:
-                    if not self.web_navigator.type(text, element): action_failed = True
-            
-            elif action["action"] == "SCROLL":
-                direction = action.get("direction")
-                response_to_user = f"I will scroll {direction}."
-                if not direction:
-                    action_failed = True
-                    failure_reason = "Missing 'direction' for SCROLL action."
-                else:
-                    if not self.web_navigator.scroll(direction): action_failed = True
-
-            elif action["action"] == "WAIT":
-                seconds = action.get("seconds")
-                response_to_user = f"I will wait {seconds} seconds."
-                if seconds is None:
+            elif action["action"] in BROWSER_ACTIONS:
+                response_to_user, failure_reason, method, args = self._action_call(action)
+                if failure_reason:
                     action_failed = True
-                    failure_reason = "Missing 'seconds' for WAIT action."
-                else:
-                    if not self.web_navigator.wait(seconds): action_failed = True
-
-            elif action["action"] == "CLEAR_INPUT":
-                element = action.get("element_description")
-                response_to_user = f"I will clear the input field '{element}'."
-                if not element:
+                elif not (yield ("_io", getattr(self.web_navigator, method), *args)):
                     action_failed = True
-                    failure_reason = "Missing 'element_description' for CLEAR_INPUT action."
-                else:
-                    if not self.web_navigator.clear_input(element): action_failed = True
 
             else:
                 response_to_user = "I am not sure what to do next. I will ask the user for help."
@@ -194,11 +517,111 @@ class Agent:
                 self.conversation_history.append({"role": "assistant", "content": response_to_user})
                 continue
 
+            self.stats["actions"] += 1
+            if self._planning is not None:
+                action = self._reconcile(action, (yield from self._join_plan()))
+            if not action_failed and action.get("expect"):
+                failure_reason = yield from self._checkpoint(action["expect"], url_before, frame_before)
+                if failure_reason:
+                    action_failed = True
+                    self.stats["checkpoint_failures"] += 1
+                    failure_reason = f"expected {action['expect']} but {failure_reason}"
+
+            if replay is not None:
+                if not action_failed and url_pattern((yield ("_io", self.web_navigator.get_current_url))) != url_after:
+                    action_failed = True
+                    failure_reason = "the replayed step did not lead to the recorded page"
+                if action_failed:
+                    # Diverged from the recorded run: hand control back to the live planner
+                    yield ("_cpu", self.trajectories.diverged, step_id)
+                    replaying = False
+                else:
+                    yield ("_cpu", self.trajectories.replayed, step_id)
+                response_to_user += " (replayed)"
+            if not action_failed:
+                trajectory.append((url_before, frame_before.image_bytes, action))
+
             if action_failed:
+                if self._queued_actions:
+                    failure_reason += f"; dropped the remaining {len(self._queued_actions)} planned step(s)"
+                    self._queued_actions.clear()
                 if not failure_reason:
                     failure_reason = f"I could not find the element '{action.get('element_description', 'N/A')}'."
                 response_to_user += f" (But I failed: {failure_reason})."
-                screenshot_description = f"Previous action failed: {failure_reason}\n\n" + self.observer.observe(screenshot_bytes)
+                screenshot_description = (f"Previous action failed: {failure_reason}\n\n"
+                                          + (yield ("_io", self.observer.observe, screenshot_bytes)))
 
+            if not action_failed and not self._queued_actions and replay is None:
+                # Describe the settled page while the response is being reported
+                self._prefetch = yield ("_spawn", self._drive, self._prefetch_observation(socketio))
             self.conversation_history.append({"role": "assistant", "content": response_to_user})
             socketio.emit('agent_response', {'data': response_to_user})
+
+
+class AsyncAgent(Agent):
+    """
+    Agent for the asyncio runtime: the same observe -> plan -> act steps over
+    AsyncWebNavigator, AsyncVisionProcessor and AsyncPlanner. Waiting on the
+    browser, a model or the user suspends a coroutine rather than holding a
+    thread, so many mostly-idle sessions can share one event loop. Call
+    `await start()` before run(); shared_state["user_input_event"] must be an
+    asyncio.Event, and cancelling the task that runs run() stops the agent.
+    """
+
+    vision_class = AsyncVisionProcessor
+    navigator_class = AsyncWebNavigator
+    planner_class = AsyncPlanner
+
+    async def start(self):
+        await self.web_navigator.start()
+        return self
+
+    async def close(self):
+        if self._prefetch is not None:
+            self._prefetch.cancel()
+        if self._planning is not None:
+            self._planning.cancel()
+        self.executor.shutdown(wait=False)
+        await self.web_navigator.close()
+        if self._owns_vision:
+            await self.vision_processor.close()
+
+    async def run(self, user_goal, socketio, shared_state):
+        return await self._drive(self._run(user_goal, socketio, shared_state))
+
+    async def _drive(self, steps):
+        """Agent._drive, awaiting each operation on the event loop."""
+        value, error = None, None
+        while True:
+            try:
+                operation = steps.send(value) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value, error = await getattr(self, operation[0])(*operation[1:]), None
+            except Exception as e:
+                value, error = None, e
+
+    # Operations for the asyncio agent: suspend this session's coroutine
+
+    async def _io(self, fn, *args):
+        return await fn(*args)
+
+    async def _cpu(self, fn, *args):
+        return await asyncio.to_thread(fn, *args)
+
+    async def _spawn(self, fn, *args):
+        return asyncio.ensure_future(fn(*args))
+
+    async def _result(self, future, timeout=None):
+        # Like Future.result(timeout): a timeout leaves the task running
+        await asyncio.wait([future], timeout=timeout)
+        if not future.done():
+            raise asyncio.TimeoutError()
+        return future.result()
+
+    async def _first(self, futures):
+        await asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED)
+
+    async def _new_future(self):
+        return asyncio.get_running_loop().create_future()
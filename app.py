@@ -1,18 +1,210 @@
-from flask import Flask, render_template
+from flask import Flask, render_template, request
 from flask_socketio import SocketIO
-from threading import Event
+from threading import Event, Lock, Thread
+from collections import deque
+import asyncio
+import traceback
 import os
-from agent import Agent
+import openai
+from agent import Agent, AsyncAgent, load_openai_api_key
+from vision_processor import VisionProcessor, AsyncVisionProcessor
+from web_navigator import BrowserPool, AsyncBrowserPool
+from browser_workers import BrowserDispatcher
 
 app = Flask(__name__)
 socketio = SocketIO(app)
 
-agent_instance = Agent()
-shared_state = {
-    "user_response": None,
-    "user_input_event": Event(),
-    "is_agent_running": False
-}
+# "threads" runs each task on its own thread; "asyncio" runs every session as a coroutine on one event loop
+RUNTIME = os.environ.get("APP_RUNTIME", "threads")
+
+# Shared by every session (threads runtime): one vision client (connection pool, result cache) and either
+# one in-process Chromium or, with BROWSER_WORKERS set, sessions spread over browser worker processes
+vision_processor = dispatcher = browser_pool = None
+if RUNTIME != "asyncio":
+    vision_processor = VisionProcessor()
+    dispatcher = BrowserDispatcher.from_env(vision_url=",".join(e.infer_url for e in vision_processor.endpoints))
+    browser_pool = None if dispatcher else BrowserPool()
+
+
+class SessionSocket:
+    """Routes an agent's emits to the one client that owns it."""
+
+    def __init__(self, sid):
+        self.sid = sid
+
+    def emit(self, event, data=None):
+        socketio.emit(event, data, to=self.sid)
+
+
+class Session:
+    """One connected client: its agent (created on its first task) and its question/answer channel."""
+
+    def __init__(self, sid, user_input_event):
+        self.sid = sid
+        self.socket = SessionSocket(sid)
+        self.agent = None
+        self.task = None  # asyncio runtime: the Task running this session's agent
+        self.shared_state = {
+            "user_response": None,
+            "user_input_event": user_input_event,
+            "is_agent_running": False,
+            "cancelled": False,
+        }
+
+
+class Scheduler:
+    """Runs at most max_running agent tasks at once; later tasks wait in arrival order."""
+
+    def __init__(self, max_running):
+        self.max_running = max_running
+        self.running = 0
+        self.waiting = deque()  # (session, goal)
+        self._lock = Lock()
+
+    def new_event(self):
+        return Event()
+
+    def wake(self, session):
+        """Unblock an agent waiting for this session's user."""
+        session.shared_state["user_input_event"].set()
+
+    def stop(self, session):
+        """Cancel a disconnected session's task, queued or running, and release its browser context."""
+        state = session.shared_state
+        self.wake(session)
+        if self.cancel(session):
+            state["is_agent_running"] = False
+        if not state["is_agent_running"] and session.agent is not None:
+            session.agent.close()
+
+    def submit(self, session, goal):
+        with self._lock:
+            start = self.running < self.max_running
+            if start:
+                self.running += 1
+            else:
+                self.waiting.append((session, goal))
+                position = len(self.waiting)
+        if start:
+            socketio.start_background_task(self._run, session, goal)
+        else:
+            session.socket.emit('agent_response', {'data': f"All agents are busy. Your task is #{position} in the queue."})
+
+    def cancel(self, session):
+        """Drop a session's queued task; True if it had one."""
+        with self._lock:
+            queued = [entry for entry in self.waiting if entry[0] is session]
+            for entry in queued:
+                self.waiting.remove(entry)
+        return bool(queued)
+
+    def _run(self, session, goal):
+        try:
+            if not session.shared_state["cancelled"]:
+                if session.agent is None:
+                    navigator = dispatcher.open_session() if dispatcher else None
+                    session.agent = Agent(vision_processor, browser_pool, web_navigator=navigator)
+                session.agent.reset()  # Reset agent state for new task
+                session.agent.run(goal, session.socket, session.shared_state)
+        except Exception as e:
+            traceback.print_exc()
+            session.socket.emit('agent_response', {'data': f"The task stopped with an error: {e}"})
+            session.socket.emit('task_finished')
+        finally:
+            session.shared_state["is_agent_running"] = False
+            if session.shared_state["cancelled"] and session.agent is not None:
+                session.agent.close()
+            print(f"Agent for session {session.sid} has finished the task.")
+            with self._lock:
+                following = self.waiting.popleft() if self.waiting else None
+                if following is None:
+                    self.running -= 1
+            if following is not None:
+                socketio.start_background_task(self._run, *following)
+
+
+class AsyncRuntime:
+    """
+    APP_RUNTIME=asyncio: every session's agent is a coroutine on one event loop
+    (run by a background thread) over async browser contexts in one Chromium
+    and shared async vision and OpenAI clients. A session waiting for its user
+    or a model is a suspended coroutine, not a parked thread. As with the
+    Scheduler, at most max_running tasks run at once and later ones wait in
+    arrival order.
+    """
+
+    def __init__(self, max_running):
+        self.max_running = max_running
+        self.waiting = 0
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, daemon=True, name="agent-runtime").start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    async def _start(self):
+        self.slots = asyncio.Semaphore(self.max_running)
+        self.vision_processor = AsyncVisionProcessor()
+        self.openai_client = openai.AsyncOpenAI(api_key=load_openai_api_key())
+        self.browser_pool = await AsyncBrowserPool().start()
+
+    def new_event(self):
+        return asyncio.Event()
+
+    def submit(self, session, goal):
+        asyncio.run_coroutine_threadsafe(self._run(session, goal), self.loop)
+
+    def wake(self, session):
+        self.loop.call_soon_threadsafe(session.shared_state["user_input_event"].set)
+
+    def stop(self, session):
+        asyncio.run_coroutine_threadsafe(self._stop(session), self.loop)
+
+    async def _run(self, session, goal):
+        session.task = asyncio.current_task()
+        queued = self.slots.locked()
+        try:
+            if queued:
+                self.waiting += 1
+                session.socket.emit('agent_response', {'data': f"All agents are busy. Your task is #{self.waiting} in the queue."})
+            try:
+                await self.slots.acquire()
+            finally:
+                if queued:
+                    self.waiting -= 1
+            try:
+                if not session.shared_state["cancelled"]:
+                    if session.agent is None:
+                        session.agent = AsyncAgent(self.vision_processor, self.browser_pool, openai_client=self.openai_client)
+                        await session.agent.start()
+                    session.agent.reset()  # Reset agent state for new task
+                    await session.agent.run(goal, session.socket, session.shared_state)
+            finally:
+                self.slots.release()
+        except asyncio.CancelledError:
+            pass  # the client disconnected; stop() closes the agent
+        except Exception as e:
+            traceback.print_exc()
+            session.socket.emit('agent_response', {'data': f"The task stopped with an error: {e}"})
+            session.socket.emit('task_finished')
+        finally:
+            session.shared_state["is_agent_running"] = False
+            print(f"Agent for session {session.sid} has finished the task.")
+
+    async def _stop(self, session):
+        task = session.task
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.wait([task])
+        if session.agent is not None:
+            try:
+                await session.agent.close()
+            except Exception:
+                traceback.print_exc()
+
+
+max_running = int(os.environ.get("APP_MAX_RUNNING_TASKS", "2"))
+scheduler = AsyncRuntime(max_running) if RUNTIME == "asyncio" else Scheduler(max_running)
+sessions = {}  # Socket.IO sid -> Session
+
 
 @app.route('/')
 def index():
@@ -20,35 +212,45 @@ def index():
 
 @socketio.on('connect')
 def handle_connect():
-    print('Client connected')
+    sessions[request.sid] = Session(request.sid, scheduler.new_event())
+    print(f'Client connected ({len(sessions)} sessions)')
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    print('Client disconnected')
+    session = sessions.pop(request.sid, None)
+    print(f'Client disconnected ({len(sessions)} sessions)')
+    if session is None:
+        return
+    session.shared_state["cancelled"] = True
+    scheduler.stop(session)
 
 @socketio.on('start_task')
 def handle_start_task(data):
-    if shared_state["is_agent_running"]:
-        socketio.emit('agent_response', {'data': "I am already running a task. Please wait."})
+    session = sessions.get(request.sid)
+    if session is None:
+        return
+    if session.shared_state["is_agent_running"]:
+        session.socket.emit('agent_response', {'data': "I am already running a task. Please wait."})
         return
 
-    shared_state["is_agent_running"] = True
-    agent_instance.reset() # Reset agent state for new task
+    session.shared_state["is_agent_running"] = True
     goal = data['goal']
-    print(f"Received new task from user: {goal}")
-    socketio.start_background_task(agent_instance.run, goal, socketio, shared_state)
+    print(f"Received new task from session {request.sid}: {goal}")
+    scheduler.submit(session, goal)
 
 @socketio.on('user_response')
 def handle_user_response(data):
-    if shared_state["is_agent_running"]:
-        shared_state["user_response"] = data['response']
-        shared_state["user_input_event"].set()
-
-@socketio.on('task_finished')
-def handle_task_finished():
-    shared_state["is_agent_running"] = False
-    print("Agent has finished the task.")
+    session = sessions.get(request.sid)
+    if session is not None and session.shared_state["is_agent_running"]:
+        session.shared_state["user_response"] = data['response']
+        scheduler.wake(session)
 
 
 if __name__ == '__main__':
-    socketio.run(app, host='127.0.0.1', port=5001, debug=False, allow_unsafe_werkzeug=True)
\ No newline at end of file
+    try:
+        socketio.run(app, host='127.0.0.1', port=5001, debug=False, allow_unsafe_werkzeug=True)
+    finally:
+        if dispatcher:
+            dispatcher.close()
+        if vision_processor:
+            vision_processor.close()
@@ -0,0 +1,104 @@
+"""
+Planner-call and step counts per task, with and without macro actions.
+
+Goals are read one per line. Each goal runs against a real browser, vision
+server and planner. Questions the agent asks are answered with a fixed
+"use your best judgement" reply, and each run is cut off after --max-actions.
+The trajectory cache is off in the macro and single modes so no run replays
+another's steps; the replay mode runs every goal once on a fresh cache and
+reports a second run.
+
+    python bench_agent.py goals.txt --modes macro,single,replay
+"""
+import argparse
+import os
+import tempfile
+import time
+from threading import Event
+
+from agent import Agent
+
+
+class BudgetExhausted(BaseException):
+    """Raised out of Agent.run once a run has used its action budget (not an Exception, so never swallowed)."""
+
+
+class BenchSocket:
+    """Stands in for Flask-SocketIO: answers questions, notices FINISH and enforces the budget."""
+
+    def __init__(self, agent, shared_state, max_actions):
+        self.agent = agent
+        self.shared_state = shared_state
+        self.max_actions = max_actions
+        self.finished = False
+
+    def emit(self, event, data=None):
+        if event == "request_user_input":
+            self.shared_state["user_response"] = "Use your best judgement and continue."
+            self.shared_state["user_input_event"].set()
+        elif event == "task_finished":
+            self.finished = True
+        elif self.agent.stats["actions"] >= self.max_actions:
+            raise BudgetExhausted()
+
+
+def run_goal(agent, goal, max_actions):
+    shared_state = {"user_response": None, "user_input_event": Event(), "is_agent_running": True}
+    socket = BenchSocket(agent, shared_state, max_actions)
+    agent.reset()
+    start = time.perf_counter()
+    try:
+        agent.run(goal, socket, shared_state)
+    except BudgetExhausted:
+        pass
+    return {
+        "finished": socket.finished,
+        "seconds": time.perf_counter() - start,
+        **{k: agent.stats[k] for k in ("planner_calls", "actions", "macro_steps", "checkpoint_failures", "replayed",
+                                       "observations_full", "observations_local", "observations_reused")},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("goals", help="text file, one goal per line")
+    parser.add_argument("--modes", default="macro,single", help="comma-separated: macro, single, replay")
+    parser.add_argument("--max-actions", type=int, default=30)
+    args = parser.parse_args()
+
+    with open(args.goals) as f:
+        goals = [line.strip() for line in f if line.strip()]
+
+    totals = {}
+    for mode in args.modes.split(","):
+        os.environ["PLANNER_MACROS"] = "0" if mode == "single" else "1"
+        cache_dir = tempfile.TemporaryDirectory() if mode == "replay" else None
+        os.environ["TRAJECTORY_CACHE"] = os.path.join(cache_dir.name, "trajectories.sqlite") if cache_dir else ""
+        os.environ["VISION_CACHE"] = "0"  # every mode pays for its own vision calls
+        agent = Agent()
+        try:
+            for goal in goals:
+                if mode == "replay":
+                    run_goal(agent, goal, args.max_actions)  # records the trajectory the measured run replays
+                r = run_goal(agent, goal, args.max_actions)
+                t = totals.setdefault(mode, {"planner_calls": 0, "actions": 0, "finished": 0})
+                t["planner_calls"] += r["planner_calls"]
+                t["actions"] += r["actions"]
+                t["finished"] += r["finished"]
+                print(f"[{mode}] {goal[:50]:<50} planner={r['planner_calls']:>3} actions={r['actions']:>3} "
+                      f"macro_steps={r['macro_steps']:>3} replayed={r['replayed']:>3} checkpoint_fail={r['checkpoint_failures']:>2} "
+                      f"done={'yes' if r['finished'] else 'no':<3} {r['seconds']:.0f}s")
+        finally:
+            agent.close()
+            if cache_dir:
+                cache_dir.cleanup()
+
+    print()
+    for mode, t in totals.items():
+        per_action = t["planner_calls"] / t["actions"] if t["actions"] else 0.0
+        print(f"{mode:<7} planner calls={t['planner_calls']:>4} actions={t['actions']:>4} "
+              f"calls/action={per_action:.2f} finished={t['finished']}/{len(goals)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Grounding accuracy vs. screenshot pixel budget.
+
+Each line of the cases file is a JSON object:
+    {"image": "shots/search.png", "element": "search button", "bbox": [x1, y1, x2, y2]}
+with the reference bbox in the model's normalized 0..1000 space. Every case is
+re-encoded at each budget/format, grounded with VisionProcessor.get_element_bbox,
+and scored: a hit means the predicted center lies inside the reference box.
+
+    python bench_grounding.py cases.jsonl --budgets 200000,400000,800000,1152000 --formats jpeg,png
+    python bench_grounding.py cases.jsonl --coarse-to-fine
+"""
+import argparse
+import json
+import os
+import time
+
+from utils import encode_screenshot
+from vision_processor import VisionProcessor
+
+
+def iou(a, b):
+    ix = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def center_hit(pred, ref):
+    cx, cy = (pred[0] + pred[2]) / 2, (pred[1] + pred[3]) / 2
+    return ref[0] <= cx <= ref[2] and ref[1] <= cy <= ref[3]
+
+
+def load_cases(path):
+    base = os.path.dirname(os.path.abspath(path))
+    cases = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                case = json.loads(line)
+                with open(os.path.join(base, case["image"]), "rb") as img:
+                    case["image_bytes"] = img.read()
+                cases.append(case)
+    return cases
+
+
+def run(cases, vision_processor, fmt, quality, max_pixels, coarse_to_fine=False):
+    hits, ious, sizes, latencies = 0, [], [], []
+    for case in cases:
+        image_bytes = encode_screenshot(case["image_bytes"], fmt, quality, max_pixels=max_pixels)
+        sizes.append(len(image_bytes))
+        start = time.perf_counter()
+        pred = vision_processor.get_element_bbox(image_bytes, case["element"], stream=False,
+                                                coarse_to_fine=coarse_to_fine)
+        latencies.append(time.perf_counter() - start)
+        if pred is not None:
+            hits += center_hit(pred, case["bbox"])
+            ious.append(iou(pred, case["bbox"]))
+        else:
+            ious.append(0.0)
+    n = len(cases)
+    latencies.sort()
+    return {
+        "format": fmt,
+        "max_pixels": max_pixels,
+        "hit_rate": hits / n,
+        "mean_iou": sum(ious) / n,
+        "mean_kb": sum(sizes) / n / 1024,
+        "p50_ms": latencies[n // 2] * 1000,
+        "p95_ms": latencies[int(0.95 * (n - 1))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("cases", help="JSONL file of grounding cases")
+    parser.add_argument("--budgets", default="200000,400000,800000,1152000",
+                        help="comma-separated max_pixels values")
+    parser.add_argument("--formats", default="jpeg,png", help="comma-separated: png, jpeg, webp, raw")
+    parser.add_argument("--quality", type=int, default=90)
+    parser.add_argument("--coarse-to-fine", action="store_true",
+                        help="ground with a low-res pass plus a zoomed crop (budgets then size the frame the crop is cut from)")
+    parser.add_argument("--model-url", default=None)
+    args = parser.parse_args()
+
+    cases = load_cases(args.cases)
+    # No result cache: every budget and format must reach the model, not reuse the first run's answer
+    vision_processor = VisionProcessor(args.model_url, streaming=False, cache=False)
+    print(f"{'format':<6} {'max_px':>9} {'hit':>6} {'iou':>6} {'KB':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    try:
+        for fmt in args.formats.split(","):
+            for budget in args.budgets.split(","):
+                r = run(cases, vision_processor, fmt, args.quality, int(budget), args.coarse_to_fine)
+                print(f"{r['format']:<6} {r['max_pixels']:>9} {r['hit_rate']:>6.2f} {r['mean_iou']:>6.2f} "
+                      f"{r['mean_kb']:>8.1f} {r['p50_ms']:>8.0f} {r['p95_ms']:>8.0f}")
+    finally:
+        vision_processor.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import namedtuple
+from multiprocessing import AuthenticationError, resource_tracker
+from multiprocessing.connection import Listener, Client
+from multiprocessing.shared_memory import SharedMemory
+from queue import Queue, Empty
+
+from vision_processor import VisionProcessor
+from web_navigator import WebNavigator, BrowserPool, Frame
+
+# A screenshot left in the worker's shared-memory ring instead of being pickled
+ShmRef = namedtuple("ShmRef", "slot size")
+
+# WebNavigator calls a session may make over the wire ("add_hint" is frames.add_hint)
+SESSION_METHODS = {
+    "navigate", "take_screenshot", "get_frame", "get_elements", "scroll", "click", "type",
+    "clear_input", "wait", "get_current_url", "settle_stats", "grounding_stats", "add_hint",
+}
+
+
+def parse_address(text):
+    """"host:port" -> (host, port) for TCP; anything else is a Unix socket path."""
+    host, sep, port = text.rpartition(":")
+    if sep and port.isdigit() and "/" not in text:
+        return host or "127.0.0.1", int(port)
+    return text
+
+
+def is_local(address):
+    return isinstance(address, str) or address[0] in ("127.0.0.1", "localhost")
+
+
+def _attach(name):
+    """Open another process's shared memory without letting this process's tracker unlink it at exit."""
+    shm = SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class FrameRing:
+    """Fixed shared-memory slots that screenshots are written into; a client frees a slot once it has copied it."""
+
+    def __init__(self, slots, slot_size):
+        self.slot_size = slot_size
+        self.shm = SharedMemory(create=True, size=slots * slot_size)
+        self._free = Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+
+    def store(self, data):
+        """ShmRef for data, or data itself if it does not fit or every slot is in use."""
+        if len(data) > self.slot_size:
+            return data
+        try:
+            slot = self._free.get_nowait()
+        except Empty:
+            return data
+        start = slot * self.slot_size
+        self.shm.buf[start:start + len(data)] = data
+        return ShmRef(slot, len(data))
+
+    def release(self, slot):
+        self._free.put(slot)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class BrowserWorker:
+    """
+    One worker process: a Chromium (BrowserPool) with one WebNavigator context per
+    session, served over multiprocessing.connection. Every client connection is a
+    session with its own thread, so sessions only share this process's cores.
+    """
+
+    def __init__(self, address, authkey, cdp_port, max_sessions=8, slots=16, slot_size=4 << 20,
+                 vision_url=None, vision_health_interval=0):
+        self.address = address
+        self.authkey = authkey
+        # Soft limit: reported to the dispatcher, which prefers less-loaded workers but never turns a session away
+        self.max_sessions = max_sessions
+        self.pool = BrowserPool(port=cdp_port)
+        # Only the app process keeps a result cache and (by default) polls endpoint health; a worker
+        # talks to the same endpoints with just its circuit breaker, so N workers add no N caches/pollers
+        self.vision_processor = VisionProcessor(vision_url, cache=False, health_interval=vision_health_interval)
+        self.ring = FrameRing(slots, slot_size)
+        self.sessions = 0
+        self._lock = threading.Lock()
+
+    def serve_forever(self):
+        listener = Listener(self.address, authkey=self.authkey)
+        print(f"Browser worker listening on {self.address} (CDP port {self.pool.port})")
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:  # failed handshake (wrong authkey) or dropped client
+                    print(f"Rejected browser worker connection: {e}")
+                    continue
+                threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            self.ring.close()
+            self.pool.close()
+            self.vision_processor.close()
+
+    def _serve(self, conn):
+        navigator = None
+        shared_memory = False
+        lent = set()  # ring slots this client has not copied yet
+        try:
+            while True:
+                method, args = conn.recv()
+                if method == "free":  # one-way: the client has copied a slot
+                    lent.discard(args[0])
+                    self.ring.release(args[0])
+                    continue
+                if method == "load":
+                    conn.send(("ok", {"sessions": self.sessions, "max_sessions": self.max_sessions}))
+                elif method == "open":
+                    shared_memory = args[0]
+                    navigator = WebNavigator(self.vision_processor, pool=self.pool)
+                    with self._lock:
+                        self.sessions += 1
+                    conn.send(("ok", {"shm": self.ring.shm.name if shared_memory else None,
+                                      "slot_size": self.ring.slot_size}))
+                elif method == "close":
+                    conn.send(("ok", True))
+                    break
+                elif method in SESSION_METHODS and navigator is not None:
+                    try:
+                        result = self._call(navigator, method, args)
+                    except Exception as e:
+                        traceback.print_exc()
+                        conn.send(("error", repr(e)))
+                        continue
+                    conn.send(("ok", self._encode(result, lent) if shared_memory else result))
+                else:
+                    conn.send(("error", f"unknown or unopened session call '{method}'"))
+        except (EOFError, OSError):
+            pass  # client went away; its context is closed below
+        finally:
+            for slot in lent:
+                self.ring.release(slot)
+            if navigator is not None:
+                navigator.close()
+                with self._lock:
+                    self.sessions -= 1
+            conn.close()
+
+    @staticmethod
+    def _call(navigator, method, args):
+        if method == "add_hint":
+            return navigator.frames.add_hint(*args)
+        return getattr(navigator, method)(*args)
+
+    def _encode(self, result, lent):
+        if isinstance(result, Frame):
+            return result._replace(image_bytes=self._encode(result.image_bytes, lent))
+        if isinstance(result, (bytes, bytearray)):
+            result = self.ring.store(result)
+            if isinstance(result, ShmRef):
+                lent.add(result.slot)
+        return result
+
+
+class _RemoteFrames:
+    """The part of FrameStore the agent uses: speculative grounding hints."""
+
+    def __init__(self, navigator):
+        self.navigator = navigator
+
+    def add_hint(self, version, element_description, bbox):
+        self.navigator._call("add_hint", version, element_description, bbox)
+
+
+class RemoteNavigator:
+    """
+    WebNavigator stand-in for the agent process: the same blocking methods,
+    executed by a session on a BrowserWorker. Screenshots come through the
+    worker's shared-memory ring when it runs on this host. Like WebNavigator,
+    a failed call returns False rather than raising.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.conn = Client(address, authkey=authkey)
+        self._lock = threading.Lock()
+        self._shm = None
+        self.frames = _RemoteFrames(self)
+        info = self._call("open", is_local(address))
+        if not info:
+            raise RuntimeError(f"Browser worker {address} could not open a session")
+        if info["shm"]:
+            self._shm = _attach(info["shm"])
+            self._slot_size = info["slot_size"]
+
+    def _call(self, method, *args):
+        with self._lock:
+            try:
+                self.conn.send((method, args))
+                status, result = self.conn.recv()
+                result = self._decode(result)
+            except (EOFError, OSError) as e:
+                print(f"Browser worker {self.address} unreachable during '{method}': {e}")
+                return False
+        if status == "error":
+            print(f"Browser worker error in '{method}': {result}")
+            return False
+        return result
+
+    def _decode(self, result):
+        """Copy ShmRef payloads out of shared memory and hand their slots back (called under the lock)."""
+        if isinstance(result, Frame) and isinstance(result.image_bytes, ShmRef):
+            return result._replace(image_bytes=self._decode(result.image_bytes))
+        if isinstance(result, ShmRef):
+            start = result.slot * self._slot_size
+            data = bytes(self._shm.buf[start:start + result.size])
+            self.conn.send(("free", (result.slot,)))
+            return data
+        return result
+
+    def navigate(self, url):
+        return self._call("navigate", url)
+
+    def take_screenshot(self):
+        return self._call("take_screenshot")
+
+    def get_frame(self):
+        return self._call("get_frame")
+
+    def get_elements(self, limit=50):
+        return self._call("get_elements", limit)
+
+    def scroll(self, direction):
+        return self._call("scroll", direction)
+
+    def click(self, element_description, element_id=None, generation=None):
+        return self._call("click", element_description, element_id, generation)
+
+    def type(self, text, element_description, element_id=None, generation=None):
+        return self._call("type", text, element_description, element_id, generation)
+
+    def clear_input(self, element_description, element_id=None, generation=None):
+        return self._call("clear_input", element_description, element_id, generation)
+
+    def wait(self, seconds):
+        return self._call("wait", seconds)
+
+    def get_current_url(self):
+        return self._call("get_current_url")
+
+    def settle_stats(self):
+        return self._call("settle_stats")
+
+    def grounding_stats(self):
+        return self._call("grounding_stats")
+
+    def close(self):
+        self._call("close")
+        self.conn.close()
+        if self._shm is not None:
+            self._shm.close()
+
+
+class BrowserDispatcher:
+    """
+    Places each new session on the least-loaded browser worker (open sessions
+    relative to capacity, as reported by the worker itself), whether the worker
+    is a local process or on another host.
+    """
+
+    def __init__(self, addresses, authkey, processes=()):
+        self.addresses = list(addresses)
+        self.authkey = authkey
+        self.processes = list(processes)
+
+    @classmethod
+    def from_env(cls, vision_url=None):
+        """
+        BROWSER_WORKERS=N starts N local worker processes, pointed at vision_url
+        (the app's vision endpoints); a comma-separated list of host:port connects
+        to running workers (BROWSER_WORKER_AUTHKEY must match).
+        None when unset: browsers then run in-process.
+        """
+        spec = os.environ.get("BROWSER_WORKERS", "").strip()
+        if not spec:
+            return None
+        if spec.isdigit():
+            return cls.start_local(int(spec), vision_url=vision_url)
+        authkey = os.environ.get("BROWSER_WORKER_AUTHKEY", "").encode()
+        if not authkey:
+            raise RuntimeError("BROWSER_WORKER_AUTHKEY is required to connect to remote browser workers")
+        return cls([parse_address(a.strip()) for a in spec.split(",") if a.strip()], authkey)
+
+    @classmethod
+    def start_local(cls, count, vision_url=None, timeout=60):
+        """Launch count workers as separate interpreters on Unix sockets (each with its own Chromium)."""
+        authkey = os.environ.get("BROWSER_WORKER_AUTHKEY") or os.urandom(16).hex()
+        env = dict(os.environ, BROWSER_WORKER_AUTHKEY=authkey)
+        cdp_base = int(os.environ.get("BROWSER_CDP_PORT", "0"))  # 0: each worker's browser picks a free port
+        addresses, processes = [], []
+        for i in range(count):
+            address = os.path.join(tempfile.gettempdir(), f"vwa-browser-{os.getpid()}-{i}.sock")
+            command = [sys.executable, os.path.abspath(__file__), "--listen", address,
+                       "--cdp-port", str(cdp_base + 1 + i if cdp_base else 0)]
+            if vision_url:
+                command += ["--vision-url", vision_url]
+            processes.append(subprocess.Popen(command, env=env))
+            addresses.append(address)
+        dispatcher = cls(addresses, authkey.encode(), processes)
+        deadline = time.monotonic() + timeout
+        for address, process in zip(addresses, processes):
+            while dispatcher.load(address) is None:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    dispatcher.close()
+                    raise RuntimeError(f"Browser worker {address} did not start")
+                time.sleep(0.5)
+        return dispatcher
+
+    def load(self, address):
+        """Open sessions / capacity of a worker, or None if it cannot be reached."""
+        try:
+            conn = Client(address, authkey=self.authkey)
+        except (OSError, EOFError, AuthenticationError):
+            return None
+        try:
+            conn.send(("load", ()))
+            status, info = conn.recv()
+            return info["sessions"] / max(info["max_sessions"], 1)
+        except (OSError, EOFError):
+            return None
+        finally:
+            conn.close()
+
+    def open_session(self):
+        """
+        A RemoteNavigator on the least-loaded reachable worker. max_sessions is a
+        soft limit: when every worker is at it, the session is added anyway.
+        """
+        loads = [(load, i) for i, load in ((i, self.load(a)) for i, a in enumerate(self.addresses)) if load is not None]
+        if not loads:
+            raise RuntimeError("No browser worker is reachable")
+        load, index = min(loads)
+        if load >= 1:
+            print(f"All browser workers are at capacity; adding a session to {self.addresses[index]} anyway")
+        return RemoteNavigator(self.addresses[index], self.authkey)
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+        for address in self.addresses:
+            if isinstance(address, str) and os.path.exists(address):
+                os.unlink(address)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve browser sessions for remote agents")
+    parser.add_argument("--listen", default="127.0.0.1:7100", help="host:port, or a Unix socket path")
+    parser.add_argument("--cdp-port", type=int, default=int(os.environ.get("BROWSER_CDP_PORT", "0")),
+                        help="CDP port of this worker's Chromium (0 picks a free one)")
+    parser.add_argument("--max-sessions", type=int, default=int(os.environ.get("BROWSER_WORKER_SESSIONS", "8")),
+                        help="soft limit used for placement; sessions beyond it are still accepted")
+    parser.add_argument("--vision-url", default=os.environ.get("VISION_MODEL_URL"),
+                        help="vision endpoint(s), comma-separated; the same ones the app uses")
+    parser.add_argument("--vision-health-interval", type=float, default=0,
+                        help="seconds between vision health checks from this worker (0: none, the breaker still applies)")
+    parser.add_argument("--shm-slots", type=int, default=16, help="screenshots in flight through shared memory")
+    parser.add_argument("--shm-slot-mb", type=int, default=4)
+    args = parser.parse_args()
+    authkey = os.environ.get("BROWSER_WORKER_AUTHKEY", "")
+    if not authkey:
+        parser.error("set BROWSER_WORKER_AUTHKEY (shared with the agent process)")
+    # Exit through serve_forever's cleanup (shared memory, Chromium) when the dispatcher terminates us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    BrowserWorker(
+        parse_address(args.listen), authkey.encode(), args.cdp_port,
+        max_sessions=args.max_sessions, slots=args.shm_slots, slot_size=args.shm_slot_mb << 20,
+        vision_url=args.vision_url, vision_health_interval=args.vision_health_interval,
+    ).serve_forever()
+
+
+if __name__ == "__main__":
+    # Run from the importable module so pickled types are browser_workers.*, not __main__.*
+    from browser_workers import main
+    main()
@@ -0,0 +1,239 @@
+import re
+from collections import defaultdict
+
+# One round-trip: every visible, unoccluded interactive element within `reach` viewport
+# heights of the screen, with its role, accessible name (aria-label/labelledby, <label>,
+# placeholder, title, alt, visible text) and CSS-pixel box. Boxes are in document
+# coordinates unless the element is pinned (fixed/sticky), so a scroll only moves them.
+ELEMENTS_JS = """
+(reach) => {
+  const SELECTOR = 'a[href], button, input:not([type=hidden]), select, textarea, summary, ' +
+    '[role=button], [role=link], [role=textbox], [role=searchbox], [role=combobox], [role=checkbox], ' +
+    '[role=radio], [role=tab], [role=menuitem], [role=option], [role=switch], [contenteditable=""], ' +
+    '[contenteditable=true], [onclick], [tabindex]:not([tabindex="-1"])';
+  const INPUT_ROLES = {checkbox: 'checkbox', radio: 'radio', submit: 'button', button: 'button',
+    reset: 'button', image: 'button', search: 'searchbox', range: 'slider'};
+  const vw = window.innerWidth, vh = window.innerHeight, sx = window.scrollX, sy = window.scrollY;
+  const clean = (s) => (s || '').replace(/\\s+/g, ' ').trim().slice(0, 120);
+  const roleOf = (el) => {
+    const explicit = el.getAttribute('role');
+    if (explicit) return explicit.split(' ')[0];
+    const tag = el.tagName.toLowerCase();
+    if (tag === 'a') return 'link';
+    if (tag === 'button' || tag === 'summary') return 'button';
+    if (tag === 'select') return 'combobox';
+    if (tag === 'textarea' || el.isContentEditable) return 'textbox';
+    if (tag === 'input') return INPUT_ROLES[(el.type || 'text').toLowerCase()] || 'textbox';
+    return 'generic';
+  };
+  const nameOf = (el) => {
+    const labelledby = el.getAttribute('aria-labelledby');
+    if (labelledby) {
+      const text = labelledby.split(' ').map((id) => document.getElementById(id))
+        .filter(Boolean).map((n) => n.innerText).join(' ');
+      if (clean(text)) return clean(text);
+    }
+    const direct = el.getAttribute('aria-label') || (el.labels && el.labels[0] && el.labels[0].innerText);
+    if (clean(direct)) return clean(direct);
+    if (el.tagName === 'INPUT' && ['submit', 'button', 'reset'].includes(el.type)) return clean(el.value);
+    const text = el.innerText || '';
+    if (clean(text) && el.tagName !== 'INPUT' && el.tagName !== 'TEXTAREA' && el.tagName !== 'SELECT') return clean(text);
+    const img = el.querySelector && el.querySelector('img[alt]');
+    return clean(el.getAttribute('placeholder') || el.getAttribute('title') || el.getAttribute('alt') ||
+      (img && img.getAttribute('alt')) || el.getAttribute('name'));
+  };
+  const pinnedCache = new Map();
+  const pinned = (el) => {
+    if (!el || el === document.body || el === document.documentElement) return false;
+    if (pinnedCache.has(el)) return pinnedCache.get(el);
+    const position = getComputedStyle(el).position;
+    const result = position === 'fixed' || position === 'sticky' || pinned(el.parentElement);
+    pinnedCache.set(el, result);
+    return result;
+  };
+  const out = [];
+  for (const el of document.querySelectorAll(SELECTOR)) {
+    const r = el.getBoundingClientRect();
+    if (r.width < 2 || r.height < 2 || r.right <= 0 || r.left >= vw) continue;
+    if (r.bottom <= -reach * vh || r.top >= (1 + reach) * vh) continue;
+    const style = getComputedStyle(el);
+    if (style.visibility === 'hidden' || style.display === 'none' || +style.opacity === 0) continue;
+    const cx = (r.left + r.right) / 2, cy = (r.top + r.bottom) / 2;
+    if (cx >= 0 && cx < vw && cy >= 0 && cy < vh) {
+      // Occlusion can only be checked on screen
+      const hit = document.elementFromPoint(cx, cy);
+      if (!hit || !(el === hit || el.contains(hit) || hit.contains(el))) continue;
+    }
+    const fixed = pinned(el);
+    const dx = fixed ? 0 : sx, dy = fixed ? 0 : sy;
+    out.push({role: roleOf(el), name: nameOf(el), tag: el.tagName.toLowerCase(), pinned: fixed,
+      box: [r.left + dx, r.top + dy, r.right + dx, r.bottom + dy]});
+  }
+  return {width: vw, height: vh, scroll: [sx, sy], reach: reach, elements: out};
+}
+"""
+
+# Words in a planner description that name a kind of element rather than its label
+ROLE_WORDS = {
+    "button": {"button"},
+    "btn": {"button"},
+    "link": {"link"},
+    "tab": {"tab"},
+    "checkbox": {"checkbox"},
+    "radio": {"radio"},
+    "dropdown": {"combobox"},
+    "select": {"combobox"},
+    "menu": {"menuitem", "combobox", "button"},
+    "option": {"option"},
+    "input": {"textbox", "searchbox", "combobox"},
+    "field": {"textbox", "searchbox", "combobox"},
+    "textbox": {"textbox", "searchbox"},
+    "box": {"textbox", "searchbox", "combobox", "checkbox"},
+    "bar": {"textbox", "searchbox", "combobox"},
+    "searchbox": {"searchbox", "textbox"},
+}
+# Articles, glue and position words carry no label text
+STOPWORDS = {
+    "the", "a", "an", "to", "of", "on", "in", "at", "for", "with", "and", "or", "by", "this", "that",
+    "labeled", "labelled", "named", "called", "says", "saying", "text", "icon", "element", "area",
+    "top", "bottom", "left", "right", "upper", "lower", "corner", "side", "page", "main", "near", "next",
+    "above", "below", "first", "second", "third", "last", "header", "section", "blue", "red", "green",
+}
+
+# Spatial and container phrases: text after them names an anchor near the target, not the
+# target's own label ("the button next to 'Margherita Pizza'"); such descriptions go to vision
+ANCHOR_PHRASES = re.compile(
+    r"\b(next to|beside|near|nearby|under(?:neath)?|below|above|within|inside|left of|right of|"
+    r"same (?:card|row|section|item|container|line) as|in the (?:card|row|section|item|panel|container|entry) "
+    r"(?:for|of|with)|belonging to)\b\s*\S",
+    re.IGNORECASE,
+)
+
+
+def _tokens(text):
+    return [t[:-1] if len(t) > 3 and t.endswith("s") else t
+            for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in STOPWORDS]
+
+
+class DomIndex:
+    """
+    Text index over the interactive elements of one page state, numbered from 1.
+    resolve() returns an element's box only when a single element clearly matches
+    the description; anything ambiguous is left to the vision model. Boxes are
+    kept in document coordinates, so the index follows the page through scrolls
+    (scroll_to) instead of being rebuilt.
+    """
+
+    def __init__(self, snapshot, min_score=0.75, margin=0.2):
+        self.width = snapshot["width"]
+        self.height = snapshot["height"]
+        self.elements = snapshot["elements"]
+        self.scroll = tuple(snapshot.get("scroll", (0, 0)))
+        reach = snapshot.get("reach", 0) * self.height
+        self.covered = (self.scroll[0], self.scroll[1] - reach, self.scroll[1] + self.height + reach)
+        self.min_score = min_score
+        self.margin = margin
+        self._names = []
+        self._postings = defaultdict(set)  # token -> element indices
+        for i, element in enumerate(self.elements):
+            name = " ".join(re.findall(r"[a-z0-9]+", element["name"].lower()))
+            tokens = set(_tokens(element["name"]))
+            self._names.append((name, tokens))
+            for token in tokens:
+                self._postings[token].add(i)
+
+    def scroll_to(self, x, y):
+        self.scroll = (x, y)
+
+    def covers(self, x, y):
+        """Whether a viewport scrolled to (x, y) lies inside the region that was indexed."""
+        left, top, bottom = self.covered
+        return x == left and top <= y and y + self.height <= bottom
+
+    def _viewport_box(self, i):
+        """Element i's box in viewport pixels at the current scroll, or None if its center is off screen."""
+        element = self.elements[i]
+        dx, dy = (0, 0) if element.get("pinned") else self.scroll
+        x1, y1, x2, y2 = element["box"]
+        x1, y1, x2, y2 = x1 - dx, y1 - dy, x2 - dx, y2 - dy
+        if not (0 <= (x1 + x2) / 2 < self.width and 0 <= (y1 + y2) / 2 < self.height):
+            return None
+        return [max(x1, 0), max(y1, 0), min(x2, self.width), min(y2, self.height)]
+
+    def _normalized(self, box):
+        x1, y1, x2, y2 = box
+        return [round(x1 / self.width * 1000), round(y1 / self.height * 1000),
+                round(x2 / self.width * 1000), round(y2 / self.height * 1000)]
+
+    def box(self, element_id):
+        """Normalized 0..1000 bbox of element #element_id if it is on screen, else None."""
+        if not isinstance(element_id, int) or not 1 <= element_id <= len(self.elements):
+            return None
+        box = self._viewport_box(element_id - 1)
+        return self._normalized(box) if box else None
+
+    def on_screen(self):
+        """(id, element, normalized bbox) for every indexed element currently in the viewport."""
+        for i, element in enumerate(self.elements):
+            box = self._viewport_box(i)
+            if box:
+                yield i + 1, element, self._normalized(box)
+
+    def listing(self, limit=50):
+        """Compact numbered list for the planner: [id] role "label" (center x,y in 0..1000)."""
+        lines = []
+        for element_id, element, (x1, y1, x2, y2) in self.on_screen():
+            label = f'"{element["name"][:40]}"' if element["name"] else "(unlabeled)"
+            lines.append(f"[{element_id}] {element['role']} {label} ({(x1 + x2) // 2},{(y1 + y2) // 2})")
+            if len(lines) >= limit:
+                break
+        return "\n".join(lines)
+
+    def resolve(self, description):
+        """
+        Normalized 0..1000 bbox of the one on-screen element matching description, or None.
+        A role word in the description ("button", "link") must match the element's role, and
+        descriptions anchored on another element ("next to ...", "within ...") are not resolved.
+        """
+        if ANCHOR_PHRASES.search(description):
+            return None
+        quoted = [" ".join(re.findall(r"[a-z0-9]+", q.lower()))
+                  for q in re.findall(r"['\"‘“]([^'\"’”]+)['\"’”]", description)]
+        words = _tokens(description)
+        roles = set().union(*(ROLE_WORDS[w] for w in words if w in ROLE_WORDS))
+        label = {w for w in words if w not in ROLE_WORDS}
+        if not label and not quoted:
+            return None
+
+        candidates = set().union(*(self._postings.get(t, set()) for t in label)) if label else set()
+        scored = []
+        for i in candidates or range(len(self.elements)):
+            name, tokens = self._names[i]
+            box = self._viewport_box(i)
+            if not tokens or box is None or (roles and self.elements[i]["role"] not in roles):
+                continue
+            score = self._score(name, tokens, label, quoted)
+            if roles:
+                score += 0.1
+            scored.append((min(score, 1.0), i, box))
+        if not scored:
+            return None
+        scored.sort(key=lambda item: item[0], reverse=True)
+        best, _, box = scored[0]
+        runner_up = scored[1][0] if len(scored) > 1 else 0.0
+        if best < self.min_score or best - runner_up < self.margin:
+            return None
+        return self._normalized(box)
+
+    @staticmethod
+    def _score(name, tokens, label, quoted):
+        for phrase in quoted:
+            if phrase and phrase == name:
+                return 1.0
+            if phrase and f" {phrase} " in f" {name} ":
+                return 0.85
+        if not label:
+            return 0.0
+        shared = len(label & tokens)
+        # Mostly "how much of the description does the name explain", partly the converse
+        return 0.6 * shared / len(label) + 0.4 * shared / len(tokens)
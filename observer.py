@@ -4,9 +4,17 @@ class Observer:
     def __init__(self, vision_processor):
         self.vision_processor = vision_processor
 
-    def observe(self, screenshot_bytes, question=None):
+    def observe(self, screenshot_bytes, question=None, on_token=None):
         """
         Takes a screenshot and returns a description of the page.
+        on_token, if given, receives the partial description as it streams in.
         """
         print("👀 Observing the page with Qwen-VL...")
-        return self.vision_processor.describe_image(screenshot_bytes, question)
\ No newline at end of file
+        return self.vision_processor.describe_image(screenshot_bytes, question, on_token=on_token)
+
+    def observe_many(self, screenshot_bytes, questions):
+        """
+        Answers several questions about one screenshot with a single vision call.
+        """
+        print(f"👀 Observing the page with Qwen-VL ({len(questions)} questions)...")
+        return self.vision_processor.describe_many(screenshot_bytes, questions)
@@ -1,18 +1,40 @@
 import openai
 import json
 import os
+import hashlib
+import copy
 import traceback
+from collections import deque
 
-class Planner:
-    def __init__(self, api_key):
-        self.client = openai.OpenAI(api_key=api_key)
-        # Default to a cheaper capable model; allow override via env
-        self.model = os.getenv("OPENAI_PLANNER_MODEL", "gpt-4o-mini")
+try:
+    import tiktoken
+except ImportError:  # optional: token counts fall back to a chars/4 estimate
+    tiktoken = None
 
-    def get_next_action(self, conversation_history, screenshot_description, current_url=None):
-        print("🤖 Deciding next action with GPT-4...")
+ACTIONS = ["NAVIGATE", "CLICK", "TYPE", "CLEAR_INPUT", "SCROLL", "WAIT", "OBSERVE", "ASK_USER", "FINISH", "RETRY", "SUMMARIZE_OPTIONS"]
+
+# Arguments an action needs before it can be executed (see the system prompt)
+REQUIRED_ARGS = {
+    "NAVIGATE": ("url",),
+    "CLICK": ("element_description",),
+    "TYPE": ("text", "element_description"),
+    "CLEAR_INPUT": ("element_description",),
+    "SCROLL": ("direction",),
+    "WAIT": ("seconds",),
+    "OBSERVE": ("question",),
+    "SUMMARIZE_OPTIONS": ("topic", "options"),
+    "ASK_USER": ("question",),
+    "FINISH": ("reason",),
+}
 
-        system_prompt = """
+# Optional fields that change how an action is executed; an action is not dispatched early while one may still arrive
+LATE_FIELDS = ("element_id", "expect")
+
+# Actions allowed inside an "actions" sequence, and the checkpoints a step may declare
+MACRO_ACTIONS = {"NAVIGATE", "CLICK", "TYPE", "CLEAR_INPUT", "SCROLL", "WAIT", "OBSERVE"}
+CHECKPOINTS = {"url_changed", "frame_changed"}
+
+SYSTEM_PROMPT = """
         You are a versatile web agent's planner. Your goal is to help users accomplish tasks on any website in a reliable, general way.
 
         Actions & Required Arguments:
@@ -55,6 +77,7 @@ class Planner:
         - Do not issue multiple OBSERVE actions that restate the same view without a viewport/site change. If you need more items, SCROLL once or twice, then summarize.
         - Limit scroll attempts (e.g., ≤2) before summarizing and/or asking the user.
         - Do not repeatedly NAVIGATE to the same URL you are already on. If already on the intended site, proceed with the next logical action.
+        - An observation that starts with "(The screen did not visibly change after the last action.)" means that action had no visible effect; do not repeat it, try a different element or strategy.
 
         Authority‑First Navigation (Entities/Profiles)
         - When the goal involves a person, organization, or a catalog of works (e.g., publications, projects), prefer opening the authoritative/official page shown in results (e.g., a profile page) rather than sampling scattered results.
@@ -74,53 +97,450 @@ class Planner:
         Respond with a single, well‑formed JSON object.
         """
 
-        user_prompt = f"""
-        Conversation History:
-        {json.dumps(conversation_history, indent=2)}
+MACRO_PROMPT = """
+        Action Sequences (Optional)
+        - For routine flows whose steps do not depend on what you will see in between (e.g., CLEAR_INPUT → TYPE into a search box → OBSERVE the results), you MAY return several steps at once:
+          {{"actions": [{{"action": "...", ...}}, ...], "reason": "..."}}
+          with at most {max_steps} steps. Only NAVIGATE, CLICK, TYPE, CLEAR_INPUT, SCROLL, WAIT and OBSERVE may appear in a sequence.
+        - Give a step "expect": "url_changed" or "expect": "frame_changed" when its effect can be checked that way (e.g., a submit that loads a results page). If a step fails or its expectation is not met, the remaining steps are dropped and you plan again from the new observation.
+        - End a sequence with an OBSERVE to verify the outcome. Use single actions whenever the next step depends on the result of the previous one.
+"""
 
-        Current Page Description:
-        {screenshot_description}
+ELEMENT_PROMPT = """
+        Element Index
+        - The page description may end with an "Interactive elements" list of entries like [7] button "Add to Cart" (750,630), read from the page itself (center x,y in 0..1000). Unlabeled entries are tagged with their number in the screenshot the description was made from.
+        - For CLICK, TYPE and CLEAR_INPUT on an element from that list, give "element_id": 7 BEFORE "element_description" in the JSON. Still give element_description; it is used if the page has changed since the list was made.
+        - Ids stay valid after SCROLL and across the steps of an action sequence until the page content changes.
+"""
 
-        Current URL:
-        {current_url or 'unknown'}
+SUMMARY_PROMPT = """Condense the earlier part of a web agent's history into a short memory for its planner.
+Keep: the user's goal and preferences, sites and pages visited (with URLs), actions taken and whether they worked,
+facts found on pages, and open questions. Drop page descriptions that are no longer relevant. Plain text, at most {words} words."""
+
+
+def parse_partial_object(text):
+    """
+    Top-level members of a JSON object that are complete so far in a streamed,
+    possibly truncated response. A member whose value is still being generated
+    is left out. Returns (members, pending), where pending is the key of that
+    unfinished member (None if no member has started since the last complete one).
+    """
+    decoder = json.JSONDecoder()
+    members = {}
+    i = text.find("{")
+    if i == -1:
+        return members, None
+    i += 1
+    while True:
+        while i < len(text) and text[i] in " \t\r\n,":
+            i += 1
+        if i >= len(text) or text[i] != '"':
+            return members, None
+        try:
+            key, i = decoder.raw_decode(text, i)
+        except json.JSONDecodeError:
+            return members, None
+        try:
+            while i < len(text) and text[i] in " \t\r\n":
+                i += 1
+            if i >= len(text) or text[i] != ":":
+                return members, key
+            i += 1
+            while i < len(text) and text[i] in " \t\r\n":
+                i += 1
+            value, end = decoder.raw_decode(text, i)
+        except json.JSONDecodeError:
+            return members, key
+        # A number at the very end of the buffer may still be growing
+        if end >= len(text) and isinstance(value, (int, float)):
+            return members, key
+        members[key] = value
+        i = end
 
-        Based on the user's goal and your workflow, what is the next logical action?
-        """
 
+def count_tokens(text, model=None):
+    if tiktoken is not None:
+        try:
+            return len(tiktoken.encoding_for_model(model or "gpt-4o-mini").encode(text))
+        except Exception:
+            pass
+    return len(text) // 4
+
+
+class ActionStream:
+    """
+    Text and usage of a streamed planner completion, fed one chunk at a time.
+    on_partial(text) gets the text as it grows and on_partial(text, done=True)
+    at close(); on_action(action) is called once, as soon as early_action finds
+    an executable action in the partial JSON.
+    """
+
+    def __init__(self, early_action, on_action=None, on_partial=None):
+        self.early_action = early_action
+        self.on_action = on_action
+        self.on_partial = on_partial
+        self.text = ""
+        self.api_usage = None
+        self.dispatched = on_action is None
+
+    def feed(self, chunk):
+        if getattr(chunk, "usage", None) is not None:
+            self.api_usage = chunk.usage
+        if not chunk.choices:
+            return
+        delta = chunk.choices[0].delta.content or ""
+        if not delta:
+            return
+        self.text += delta
+        if self.on_partial is not None:
+            self.on_partial(self.text)
+        if not self.dispatched:
+            action = self.early_action(*parse_partial_object(self.text))
+            if action is not None:
+                self.dispatched = True
+                self.on_action(action)
+
+    def close(self):
+        """(text, api_usage) of the finished completion."""
+        if self.on_partial is not None:
+            self.on_partial(self.text, done=True)
+        return self.text, self.api_usage
+
+
+class PlannerContext:
+    """
+    Incrementally built planner prompt. The prefix (system prompt, rolling
+    memory, compact history) only ever grows by appending, so the API's prompt
+    cache keeps hitting; it is rewritten only when old turns are folded into
+    the memory after the token budget is exceeded.
+    """
+
+    def __init__(self, client, model, token_budget, keep_recent):
+        self.client = client
+        self.model = model
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.usage = []  # per-step token accounting
+        self.reset()
+
+    def reset(self):
+        self.memory = ""
+        self.lines = []        # compact serialized turns not yet folded into memory
+        self._entries = []     # (step, history entry) behind each of self.lines
+        self._seen = 0         # conversation_history entries already serialized
+        self._first = None     # first history entry, to notice a new conversation
+        self._digests = {}     # content digest -> step number where it first appeared
+        self._tokens = 0       # tokens in lines + memory
+        # Raw content of the newest entries; never more than a fold keeps, so they are always in lines
+        self._recent = deque(maxlen=min(3, self.keep_recent))
+
+    def update(self, conversation_history):
+        """Serialize only history entries added since the last call."""
+        if self._append(conversation_history):
+            self._fold()
+
+    def _append(self, conversation_history):
+        """Serialize new history entries; True once the token budget is exceeded."""
+        if (len(conversation_history) < self._seen
+                or (conversation_history and conversation_history[0] is not self._first
+                    and conversation_history[0] != self._first)):
+            self.reset()
+        if conversation_history:
+            self._first = conversation_history[0]
+        for step in range(self._seen, len(conversation_history)):
+            self._recent.append(str(conversation_history[step].get("content", "")))
+            line = self._serialize(step, conversation_history[step])
+            self.lines.append(line)
+            self._entries.append((step, conversation_history[step]))
+            self._tokens += count_tokens(line, self.model)
+        self._seen = len(conversation_history)
+        return self._tokens > self.token_budget
+
+    def _serialize(self, step, entry):
+        role, content = entry.get("role", "user"), str(entry.get("content", "")).strip()
+        # Identical long entries (typically re-observations of an unchanged page) are sent once
+        if len(content) > 200:
+            digest = hashlib.blake2b(content.encode(), digest_size=8).hexdigest()
+            if digest in self._digests:
+                header = content.splitlines()[0][:120]
+                return f"[{step}] {role}: {header} (identical to [{self._digests[digest]}])"
+            self._digests[digest] = step
+        return f"[{step}] {role}: {content}"
+
+    def _fold(self):
+        """Summarize all but the most recent turns into the rolling memory."""
+        old = self._fold_turns()
+        if not old:
+            return
         try:
             response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.0,
-                # Request strict JSON to reduce parsing failures (supported by 4o family)
-                response_format={"type": "json_object"}
+                model=self.model, messages=self._fold_messages(old), temperature=0.0,
             )
+            summary = response.choices[0].message.content.strip()
+        except Exception:
+            traceback.print_exc()
+            summary = None
+        self._folded(old, summary)
+
+    def _fold_turns(self):
+        old = self.lines[:-self.keep_recent]
+        if old:
+            print(f"🧠 Planner context over {self.token_budget} tokens; summarizing {len(old)} older turns.")
+        return old
+
+    def _fold_messages(self, old):
+        history = "\n".join(old)
+        return [
+            {"role": "system", "content": SUMMARY_PROMPT.format(words=max(100, self.token_budget // 8))},
+            {"role": "user", "content": f"Existing memory:\n{self.memory or '(none)'}\n\nHistory to fold in:\n{history}"},
+        ]
+
+    def _folded(self, old, summary):
+        """Replace the old turns by the summary (or, if summarizing failed, by the head of each)."""
+        self.memory = summary or "\n".join(filter(None, [self.memory] + [line[:200] for line in old]))
+        # Re-serialize the kept turns: an "(identical to [N])" line must not point at a folded one
+        self._entries = self._entries[len(old):]
+        self._digests = {}
+        self.lines = recent = [self._serialize(step, entry) for step, entry in self._entries]
+        self._tokens = count_tokens(self.memory, self.model) + sum(count_tokens(l, self.model) for l in recent)
+
+    def messages(self, system_prompt, screenshot_description, current_url):
+        history = "\n".join(self.lines)
+        # The latest observation is usually the last history entry already; do not send it twice
+        if screenshot_description and any(screenshot_description.strip() in c for c in self._recent):
+            page = "(the latest observation above)"
+        else:
+            page = screenshot_description
+        prefix = ""
+        if self.memory:
+            prefix = f"Memory of earlier steps:\n{self.memory}\n\n"
+        tail = (
+            f"Current Page Description:\n{page}\n\n"
+            f"Current URL:\n{current_url or 'unknown'}\n\n"
+            "Based on the user's goal and your workflow, what is the next logical action?"
+        )
+        estimate = {
+            "system": count_tokens(system_prompt, self.model),
+            "memory": count_tokens(self.memory, self.model) if self.memory else 0,
+            "history": self._tokens - (count_tokens(self.memory, self.model) if self.memory else 0),
+            "tail": count_tokens(tail, self.model),
+        }
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"{prefix}Conversation History:\n{history}"},
+            {"role": "user", "content": tail},
+        ]
+        return messages, estimate
+
+    def record(self, estimate, api_usage):
+        """Store a step's estimate alongside the API's reported usage (incl. cached prompt tokens)."""
+        entry = dict(estimate)
+        if api_usage is not None:
+            entry["prompt_tokens"] = api_usage.prompt_tokens
+            entry["completion_tokens"] = api_usage.completion_tokens
+            details = getattr(api_usage, "prompt_tokens_details", None)
+            entry["cached_tokens"] = getattr(details, "cached_tokens", 0) or 0
+        self.usage.append(entry)
+        return entry
+
+
+class Planner:
+    client_class = openai.OpenAI
+    context_class = PlannerContext
 
-            action_json = response.choices[0].message.content
-            
-            json_start = action_json.find('{')
-            json_end = action_json.rfind('}')
+    def __init__(self, api_key, client=None):
+        # A server with many agents passes one shared client (and so one connection pool)
+        self.client = client or self.client_class(api_key=api_key)
+        # Default to a cheaper capable model; allow override via env
+        self.model = os.getenv("OPENAI_PLANNER_MODEL", "gpt-4o-mini")
+        # Macro actions: one planner call may return a short verified action sequence
+        self.macros = os.getenv("PLANNER_MACROS", "1") == "1"
+        self.max_macro_steps = int(os.getenv("PLANNER_MAX_MACRO_STEPS", "4"))
+        # Built once so every call shares the same cacheable prefix
+        self.system_prompt = SYSTEM_PROMPT
+        if self.macros:
+            self.system_prompt += MACRO_PROMPT.format(max_steps=self.max_macro_steps)
+        # Element ids from the agent's per-page element index (set-of-marks)
+        if os.getenv("AGENT_ELEMENT_INDEX", "1") == "1":
+            self.system_prompt += ELEMENT_PROMPT
+        # Stream completions and hand out the action as soon as its required arguments are in
+        self.streaming = os.getenv("PLANNER_STREAMING", "1") == "1"
+        self.context = self.context_class(
+            self.client,
+            self.model,
+            token_budget=int(os.getenv("PLANNER_CONTEXT_TOKENS", "6000")),
+            keep_recent=int(os.getenv("PLANNER_KEEP_RECENT", "8")),
+        )
+
+    def reset(self):
+        self.context.reset()
+
+    @property
+    def last_usage(self):
+        """Token accounting of the most recent planner call."""
+        return self.context.usage[-1] if self.context.usage else None
+
+    def _parse_sequence(self, steps):
+        """Validate an "actions" list; returns a MACRO action, a single step, or None if unusable."""
+        if not isinstance(steps, list) or not steps or len(steps) > self.max_macro_steps:
+            return None
+        for step in steps:
+            if not isinstance(step, dict) or step.get("action") not in MACRO_ACTIONS:
+                return None
+            if step.get("expect") not in CHECKPOINTS | {None}:
+                step.pop("expect")
+        if len(steps) == 1:
+            return steps[0]
+        return {"action": "MACRO", "actions": steps}
+
+    def get_next_action(self, conversation_history, screenshot_description, current_url=None,
+                        on_action=None, on_partial=None):
+        """
+        Returns the next action. When streaming, on_action(action) is called
+        once, as soon as the action and its required arguments have arrived and
+        the stream has moved past them (see _early_action), while the remaining
+        fields are still being generated; on_partial(text) gets
+        the response text as it grows and on_partial(text, done=True) at the end.
+        """
+        print("🤖 Deciding next action with GPT-4...")
 
-            if json_start != -1 and json_end != -1:
-                action_str = action_json[json_start : json_end + 1]
+        try:
+            self.context.update(conversation_history)
+            messages, estimate = self.context.messages(self.system_prompt, screenshot_description, current_url)
+            if self.streaming:
+                action_json, api_usage = self._stream_completion(messages, on_action, on_partial)
             else:
-                action_str = action_json
-            
-            try:
-                action = json.loads(action_str)
-            except json.JSONDecodeError:
-                print("Failed to decode JSON from model, will retry.")
-                return {"action": "RETRY", "reason": "Malformed JSON response from planner."}
+                response = self.client.chat.completions.create(**self._request(messages))
+                action_json, api_usage = response.choices[0].message.content, getattr(response, "usage", None)
+            return self._finish(estimate, action_json, api_usage)
+        except Exception:
+            return self._planning_failed()
+
+    def _stream_completion(self, messages, on_action=None, on_partial=None):
+        stream = self.client.chat.completions.create(**self._request(messages, stream=True))
+        streamed = ActionStream(self._early_action, on_action, on_partial)
+        for chunk in stream:
+            streamed.feed(chunk)
+        return streamed.close()
+
+    def _request(self, messages, stream=False):
+        """Keyword arguments of a planner completion request."""
+        request = dict(
+            model=self.model,
+            messages=messages,
+            temperature=0.0,
+            # Request strict JSON to reduce parsing failures (supported by 4o family)
+            response_format={"type": "json_object"},
+        )
+        if stream:
+            request.update(stream=True, stream_options={"include_usage": True})
+        return request
 
-            if "action" not in action or action["action"] not in ["NAVIGATE", "CLICK", "TYPE", "CLEAR_INPUT", "SCROLL", "WAIT", "OBSERVE", "ASK_USER", "FINISH", "RETRY", "SUMMARIZE_OPTIONS"]:
-                raise ValueError("Invalid action specified.")
+    def _finish(self, estimate, action_json, api_usage):
+        """Record the call's token usage and parse its action."""
+        usage = self.context.record(estimate, api_usage)
+        print(f"🤖 Planner tokens: {usage}")
+        return self._parse_action(action_json)
 
-            return action
+    @staticmethod
+    def _planning_failed():
+        print(f"Error while planning:")
+        traceback.print_exc()
+        return {"action": "ASK_USER", "question": "I'm having trouble deciding what to do next. Can you please clarify your goal?"}
+
+    def _early_action(self, members, pending=None):
+        """
+        The action once it can be executed as-is, or None while arguments are
+        still missing. A single action waits until the stream has moved on to a
+        member other than LATE_FIELDS (typically "reason"), so an element_id or
+        expect given after the required arguments is not dropped.
+        """
+        name = members.get("action")
+        if name in REQUIRED_ARGS and all(arg in members for arg in REQUIRED_ARGS[name]):
+            if pending is None or pending in LATE_FIELDS:
+                return None
+            return dict(members)
+        if self.macros and name is None and "actions" in members:
+            return self._parse_sequence(copy.deepcopy(members["actions"]))
+        return None
+
+    def _parse_action(self, action_json):
+        json_start = action_json.find('{')
+        json_end = action_json.rfind('}')
+
+        if json_start != -1 and json_end != -1:
+            action_str = action_json[json_start : json_end + 1]
+        else:
+            action_str = action_json
+        
+        try:
+            action = json.loads(action_str)
+        except json.JSONDecodeError:
+            print("Failed to decode JSON from model, will retry.")
+            return {"action": "RETRY", "reason": "Malformed JSON response from planner."}
 
-        except Exception as e:
-            print(f"Error while planning:")
+        if self.macros and "action" not in action and "actions" in action:
+            sequence = self._parse_sequence(action["actions"])
+            if sequence is None:
+                print("Planner returned an unusable action sequence, will retry.")
+                return {"action": "RETRY", "reason": "Invalid action sequence from planner."}
+            if action.get("reason"):
+                sequence.setdefault("reason", action["reason"])
+            return sequence
+
+        if "action" not in action or action["action"] not in ACTIONS:
+            raise ValueError("Invalid action specified.")
+
+        return action
+
+
+class AsyncPlannerContext(PlannerContext):
+    """PlannerContext whose history folding awaits an AsyncOpenAI client."""
+
+    async def update(self, conversation_history):
+        if self._append(conversation_history):
+            await self._fold()
+
+    async def _fold(self):
+        old = self._fold_turns()
+        if not old:
+            return
+        try:
+            response = await self.client.chat.completions.create(
+                model=self.model, messages=self._fold_messages(old), temperature=0.0,
+            )
+            summary = response.choices[0].message.content.strip()
+        except Exception:
             traceback.print_exc()
-            return {"action": "ASK_USER", "question": "I'm having trouble deciding what to do next. Can you please clarify your goal?"}
+            summary = None
+        self._folded(old, summary)
+
+
+class AsyncPlanner(Planner):
+    """Planner for the asyncio agent runtime: the same prompts, streaming and parsing over openai.AsyncOpenAI."""
+
+    client_class = openai.AsyncOpenAI
+    context_class = AsyncPlannerContext
+
+    async def get_next_action(self, conversation_history, screenshot_description, current_url=None,
+                              on_action=None, on_partial=None):
+        print("🤖 Deciding next action with GPT-4...")
+
+        try:
+            await self.context.update(conversation_history)
+            messages, estimate = self.context.messages(self.system_prompt, screenshot_description, current_url)
+            if self.streaming:
+                action_json, api_usage = await self._stream_completion(messages, on_action, on_partial)
+            else:
+                response = await self.client.chat.completions.create(**self._request(messages))
+                action_json, api_usage = response.choices[0].message.content, getattr(response, "usage", None)
+            return self._finish(estimate, action_json, api_usage)
+        except Exception:
+            return self._planning_failed()
+
+    async def _stream_completion(self, messages, on_action=None, on_partial=None):
+        stream = await self.client.chat.completions.create(**self._request(messages, stream=True))
+        streamed = ActionStream(self._early_action, on_action, on_partial)
+        async for chunk in stream:
+            streamed.feed(chunk)
+        return streamed.close()
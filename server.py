@@ -1,12 +1,25 @@
 # server.py
 
+import io
 import os
-import uuid
+import re
+import json
+import math
+import time
+import queue
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
 from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from PIL import Image
 
 import torch
-from transformers import Qwen3VLForConditionalGeneration, AutoProcessor
+from transformers import Qwen3VLForConditionalGeneration, AutoProcessor, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
 from qwen_vl_utils import process_vision_info
 
 app = FastAPI()
@@ -14,6 +27,36 @@ app = FastAPI()
 # ---- Load model & processor once on startup ----
 MODEL_NAME = "Qwen/Qwen3-VL-8B-Instruct"
 
+# Micro-batching: concurrent /infer calls are collected for up to
+# BATCH_WINDOW_MS (or until MAX_BATCH_SIZE) and run through one generate.
+MAX_BATCH_SIZE = int(os.environ.get("VISION_MAX_BATCH_SIZE", "8"))
+BATCH_WINDOW_MS = float(os.environ.get("VISION_BATCH_WINDOW_MS", "10"))
+MAX_NEW_TOKENS = 256
+
+# Per-task generation budgets. "bbox" answers are a single [x1,y1,x2,y2] and
+# also stop as soon as a closed 4-int bracket has been generated.
+TASK_MAX_NEW_TOKENS = {
+    "describe": MAX_NEW_TOKENS,
+    "bbox": 32,
+}
+BBOX_PATTERN = re.compile(r"\[\s*\d+\s*,\s*\d+\s*,\s*\d+\s*,\s*\d+\s*\]")
+
+# Admission control: at most MAX_PENDING jobs may wait for the GPU; beyond that
+# callers get a fast 429 with a Retry-After hint instead of piling up.
+MAX_PENDING = int(os.environ.get("VISION_MAX_PENDING", "64"))
+
+# /infer_multi: prompts sharing one screenshot always land in the same batch
+MAX_PROMPTS = int(os.environ.get("VISION_MAX_PROMPTS", "16"))
+
+# Vision-tower outputs are cached per screenshot (content hash) so repeated
+# prompts on the same frame skip the image encoder. 0 disables the cache.
+EMBED_CACHE_MB = int(os.environ.get("VISION_EMBED_CACHE_MB", "1024"))
+
+# Optional server-side pixel budget per image (qwen-vl-utils resizes onto the
+# 32 px token grid within it). Clients normally pre-size screenshots already.
+IMAGE_MIN_PIXELS = int(os.environ.get("VISION_SERVER_MIN_PIXELS", "0")) or None
+IMAGE_MAX_PIXELS = int(os.environ.get("VISION_SERVER_MAX_PIXELS", "0")) or None
+
 print("Loading model on GPU...")
 model = Qwen3VLForConditionalGeneration.from_pretrained(
     MODEL_NAME,
@@ -22,102 +65,739 @@ model = Qwen3VLForConditionalGeneration.from_pretrained(
 )
 processor = AutoProcessor.from_pretrained(MODEL_NAME)
 
-# Optional: safer for batch later
+# Left padding so every row of a batch ends at the same position for generate
 processor.tokenizer.padding_side = "left"
 
 
+class Histogram:
+    """Fixed-bucket histogram (cumulative counts, Prometheus style)."""
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot = +Inf
+        self.total = 0.0
+        self.n = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    self.counts[i] += 1
+                    break
+            else:
+                self.counts[-1] += 1
+            self.total += value
+            self.n += 1
+
+    def snapshot(self):
+        with self._lock:
+            cumulative, running = {}, 0
+            for upper, c in zip(self.buckets + ["+Inf"], self.counts):
+                running += c
+                cumulative[str(upper)] = running
+            return {
+                "buckets": cumulative,
+                "count": self.n,
+                "sum": self.total,
+                "mean": (self.total / self.n) if self.n else 0.0,
+            }
+
+
+class QueueFullError(Exception):
+    """Raised by BatchScheduler.submit when the pending queue is at capacity."""
+
+    def __init__(self, retry_after):
+        super().__init__("Inference queue is full")
+        self.retry_after = retry_after
+
+
+class InferenceJob:
+    """One prompt+image waiting for a slot in a generate batch."""
+
+    def __init__(self, image, prompt, image_key=None, task="describe", max_new_tokens=None):
+        self.image = image  # decoded PIL image, handed to the processor as-is
+        self.image_key = image_key  # content hash of the upload, for the embedding cache
+        self.prompt = prompt
+        self.task = task
+        limit = TASK_MAX_NEW_TOKENS[task]
+        self.max_new_tokens = min(limit, max_new_tokens) if max_new_tokens else limit
+        self.on_delta = None  # streaming callback, called from the batch worker thread
+        self.cancelled = False  # set when a streaming client goes away
+        self.received_at = time.perf_counter()
+        self.enqueued_at = time.monotonic()
+        self.timings = {}
+        self.future = Future()
+
+
+class BatchScheduler:
+    """
+    Collects concurrent jobs into one padded model.generate call.
+
+    A single worker thread owns the GPU: it blocks for the first job, then keeps
+    pulling jobs until the batch window closes or the batch is full. The event
+    loop never touches the model; it only awaits the job's future.
+
+    Queue entries are groups of jobs; a group is never split across batches
+    (a group larger than max_batch_size runs as its own batch).
+    """
+
+    def __init__(self, max_batch_size, window_ms, max_pending):
+        self.max_batch_size = max(1, max_batch_size)
+        self.window_s = max(0.0, window_ms) / 1000.0
+        self.max_pending = max(1, max_pending)
+        self._queue = queue.Queue(maxsize=self.max_pending)
+        self.batch_size_hist = Histogram([1, 2, 4, 8, 16, 32])
+        self.queue_wait_hist = Histogram([1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000])  # ms
+        self.batch_latency_hist = Histogram([50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000])  # ms
+        # Per-stage latency breakdown (ms), filled by the /infer handler and run_batch
+        self.stage_hists = {
+            stage: Histogram([1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000])
+            for stage in ("read", "decode", "queue_wait", "preprocess", "generate", "postprocess", "total")
+        }
+        self.rejected = 0
+        self._rejected_lock = threading.Lock()
+        self._carry = None  # group that did not fit in the previous batch
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    @property
+    def healthy(self):
+        return self._thread.is_alive()
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def retry_after(self):
+        """Seconds until the current backlog should have drained (rough estimate)."""
+        mean_batch_s = self.batch_latency_hist.snapshot()["mean"] / 1000.0 or 1.0
+        batches_ahead = self.pending / self.max_batch_size + 1
+        return max(1, math.ceil(batches_ahead * mean_batch_s))
+
+    def reject(self):
+        """Count one rejected request (called from request threads and the event loop)."""
+        with self._rejected_lock:
+            self.rejected += 1
+
+    def submit(self, job):
+        return self.submit_group([job])[0]
+
+    def submit_group(self, jobs):
+        try:
+            self._queue.put_nowait(list(jobs))
+        except queue.Full:
+            self.reject()
+            raise QueueFullError(self.retry_after())
+        return [job.future for job in jobs]
+
+    def _collect(self):
+        if self._carry is not None:
+            batch, self._carry = self._carry, None
+        else:
+            batch = self._queue.get()
+        deadline = time.monotonic() + self.window_s
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                group = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if len(batch) + len(group) > self.max_batch_size:
+                self._carry = group
+                break
+            batch = batch + group
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            self.batch_size_hist.observe(len(batch))
+            for job in batch:
+                job.timings["queue_wait"] = (started - job.enqueued_at) * 1000.0
+                self.queue_wait_hist.observe(job.timings["queue_wait"])
+            try:
+                outputs = run_batch(batch)
+            except Exception as e:
+                for job in batch:
+                    job.future.set_exception(e)
+                continue
+            finally:
+                self.batch_latency_hist.observe((time.monotonic() - started) * 1000.0)
+            for job, output in zip(batch, outputs):
+                job.future.set_result(output)
+
+    def record_timings(self, timings):
+        for stage, ms in timings.items():
+            hist = self.stage_hists.get(stage)
+            if hist is not None:
+                hist.observe(ms)
+
+
+class VisionEmbeddingCache:
+    """
+    LRU of vision-tower outputs keyed by screenshot content hash.
+
+    Each entry holds one image's merged embeddings plus its slice of every
+    deepstack layer, and the cache is capped by total tensor bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _nbytes(entry):
+        embeds, deepstack = entry
+        tensors = [embeds] + list(deepstack or [])
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = self._nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+embed_cache = VisionEmbeddingCache(EMBED_CACHE_MB * 1024 * 1024)
+
+# Content keys for the images of the batch currently in generate, in image order.
+# Only the batch worker thread calls generate, so a thread-local is enough.
+_batch_image_keys = threading.local()
+_encode_images = model.model.get_image_features
+
+
+def cached_get_image_features(pixel_values, image_grid_thw=None):
+    """
+    Drop-in for Qwen3VLModel.get_image_features that only runs the vision tower
+    on images whose content key is not cached (and only once per key per batch).
+    """
+    keys = getattr(_batch_image_keys, "keys", None)
+    if (embed_cache.max_bytes <= 0 or image_grid_thw is None
+            or not keys or None in keys or len(keys) != len(image_grid_thw)):
+        return _encode_images(pixel_values, image_grid_thw)
+
+    # pixel_values holds every image's patches back to back
+    patch_counts = image_grid_thw.prod(-1).tolist()
+    patch_offsets = [0]
+    for n in patch_counts:
+        patch_offsets.append(patch_offsets[-1] + n)
+
+    entries = {}
+    to_encode = []  # first image index for each uncached key
+    for i, key in enumerate(keys):
+        if key in entries or any(keys[j] == key for j in to_encode):
+            continue
+        cached = embed_cache.get(key)
+        if cached is not None:
+            entries[key] = cached
+        else:
+            to_encode.append(i)
+
+    if to_encode:
+        pixels = torch.cat([pixel_values[patch_offsets[i]:patch_offsets[i + 1]] for i in to_encode])
+        embeds, deepstack = _encode_images(pixels, image_grid_thw[to_encode])
+        token_offset = 0
+        for j, i in enumerate(to_encode):
+            n_tokens = embeds[j].shape[0]
+            layers = [d[token_offset:token_offset + n_tokens] for d in deepstack] if deepstack is not None else None
+            token_offset += n_tokens
+            entries[keys[i]] = (embeds[j], layers)
+            embed_cache.put(keys[i], entries[keys[i]])
+
+    image_embeds = tuple(entries[key][0] for key in keys)
+    first_layers = entries[keys[0]][1]
+    if first_layers is None:
+        deepstack_embeds = None
+    else:
+        deepstack_embeds = [
+            torch.cat([entries[key][1][layer] for key in keys])
+            for layer in range(len(first_layers))
+        ]
+    return image_embeds, deepstack_embeds
+
+
+model.model.get_image_features = cached_get_image_features
+
+
+class RowStoppingCriteria(StoppingCriteria):
+    """
+    Per-row stop for a mixed batch: a row is done once it hits its own token
+    budget or, for bbox jobs, once a closed [x1,y1,x2,y2] has been generated.
+    Finished rows are padded by generate until every row is done.
+    """
+
+    def __init__(self, jobs, prompt_len):
+        self.jobs = jobs
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids, scores, **kwargs):
+        n_new = input_ids.shape[1] - self.prompt_len
+        done = []
+        for row, job in enumerate(self.jobs):
+            if n_new >= job.max_new_tokens or job.cancelled:
+                done.append(True)
+            elif job.task == "bbox":
+                text = processor.tokenizer.decode(input_ids[row, self.prompt_len:], skip_special_tokens=True)
+                done.append(BBOX_PATTERN.search(text) is not None)
+            else:
+                done.append(False)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class BatchStreamer(BaseStreamer):
+    """
+    Hands each streaming job its newly generated text while generate runs.
+    generate() calls put() once with the prompt ids, then once per decode step
+    with one new token per row.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.tokens = [[] for _ in jobs]
+        self.sent = [0] * len(jobs)  # characters already delivered per row
+        self.prompt_seen = False
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        value = value.reshape(len(self.jobs), -1)
+        for row, job in enumerate(self.jobs):
+            if job.on_delta is None or job.cancelled:
+                continue
+            self.tokens[row].extend(value[row].tolist())
+            text = processor.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+            if text.endswith("\ufffd"):
+                continue  # incomplete multi-byte character; wait for the next token
+            if len(text) > self.sent[row]:
+                job.on_delta(text[self.sent[row]:])
+                self.sent[row] = len(text)
+
+    def end(self):
+        pass
+
+
+def parse_bbox(text):
+    """First [x1,y1,x2,y2] in the generated text, as 4 ints, or None."""
+    match = BBOX_PATTERN.search(text)
+    if not match:
+        return None
+    return json.loads(match.group(0))
+
+
+def image_budget():
+    """min_pixels/max_pixels keys for a qwen-vl-utils image message, if configured."""
+    budget = {}
+    if IMAGE_MIN_PIXELS:
+        budget["min_pixels"] = IMAGE_MIN_PIXELS
+    if IMAGE_MAX_PIXELS:
+        budget["max_pixels"] = IMAGE_MAX_PIXELS
+    return budget
+
+
+def run_batch(jobs):
+    """Run one padded generate over all jobs and return the new text for each job."""
+    t0 = time.perf_counter()
+    # Build messages EXACTLY like Qwen examples expect
+    # (outer list = batch, inner list = conversation)
+    messages = [
+        [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image",
+                        "image": job.image,
+                        **image_budget(),
+                    },
+                    {
+                        "type": "text",
+                        "text": job.prompt,
+                    },
+                ],
+            }
+        ]
+        for job in jobs
+    ]
+
+    # Text prompts via chat template (tokenize=False), one per conversation
+    texts = processor.apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+
+    # Use qwen-vl-utils to prepare visual inputs
+    images, videos, video_kwargs = process_vision_info(
+        messages,
+        image_patch_size=16,           # Qwen3-VL vision patch size  [oai_citation:2‡GitHub](https://github.com/QwenLM/Qwen3-VL)
+        return_video_kwargs=True,
+        return_video_metadata=True,
+    )
+
+    # For Qwen3-VL, videos (if any) come as (tensor, metadata)
+    if videos is not None:
+        videos, video_metadatas = zip(*videos)
+        videos = list(videos)
+        video_metadatas = list(video_metadatas)
+    else:
+        video_metadatas = None
+
+    # Build model inputs via processor (cookbook style)
+    inputs = processor(
+        text=texts,
+        images=images,
+        videos=videos,
+        video_metadata=video_metadatas,
+        padding=True,
+        return_tensors="pt",
+        do_resize=False,   # qwen-vl-utils already resized  [oai_citation:3‡PyPI](https://pypi.org/project/qwen-vl-utils/)
+        **video_kwargs,
+    )
+
+    # Move to model device
+    inputs = {k: v.to(model.device) if isinstance(v, torch.Tensor) else v
+              for k, v in inputs.items()}
+
+    t1 = time.perf_counter()
+
+    # Left padding: every prompt ends at the same column, new tokens start after it
+    prompt_len = inputs["input_ids"].shape[1]
+    stopping = StoppingCriteriaList([RowStoppingCriteria(jobs, prompt_len)])
+
+    streamer = BatchStreamer(jobs) if any(job.on_delta for job in jobs) else None
+
+    _batch_image_keys.keys = [job.image_key for job in jobs]
+    try:
+        generated_ids = model.generate(
+            **inputs,
+            max_new_tokens=max(job.max_new_tokens for job in jobs),
+            stopping_criteria=stopping,
+            streamer=streamer,
+        )
+    finally:
+        _batch_image_keys.keys = None
+    t2 = time.perf_counter()
+
+    # Decode only the generated tokens; pad tokens are special and get skipped.
+    outputs = processor.batch_decode(
+        generated_ids[:, prompt_len:],
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=False,
+    )
+    t3 = time.perf_counter()
+
+    for job in jobs:
+        job.timings["preprocess"] = (t1 - t0) * 1000.0
+        job.timings["generate"] = (t2 - t1) * 1000.0
+        job.timings["postprocess"] = (t3 - t2) * 1000.0
+    return outputs
+
+
+def decode_upload(img_bytes):
+    """Decode an uploaded screenshot once, in memory (runs on the I/O executor)."""
+    img = Image.open(io.BytesIO(img_bytes))
+    return img.convert("RGB")
+
+
+def image_key(img_bytes):
+    """Content hash used to share vision embeddings between prompts on one frame."""
+    return hashlib.blake2b(img_bytes, digest_size=16).hexdigest()
+
+
+def prepare_upload(img_bytes):
+    return decode_upload(img_bytes), image_key(img_bytes)
+
+
+scheduler = BatchScheduler(MAX_BATCH_SIZE, BATCH_WINDOW_MS, MAX_PENDING)
+
+# Blocking image decoding goes here so the event loop stays free for other requests
+io_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="upload-io")
+
+
+def busy_response(status_code, retry_after, message):
+    return JSONResponse(
+        status_code=status_code,
+        content={"error": message, "retry_after": retry_after},
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+def result_payload(text, task):
+    payload = {"raw_output": text}
+    if task == "bbox":
+        payload["bbox"] = parse_bbox(text)
+    return payload
+
+
+def invalid_task_response(task):
+    return JSONResponse(
+        status_code=400,
+        content={"error": f"Unknown task '{task}'; expected one of {sorted(TASK_MAX_NEW_TOKENS)}"},
+    )
+
+
+async def submit_prompts(image, prompts, tasks, max_new_tokens=None, on_delta=None):
+    """
+    Decode one upload and queue one job per prompt as a single group.
+
+    Returns the queued jobs, or a ready-made busy JSONResponse when rejected.
+    """
+    if not scheduler.healthy:
+        return busy_response(503, 5, "Inference worker is not running")
+    if scheduler.pending >= scheduler.max_pending:
+        # Reject before reading the upload; no point buffering a screenshot we can't serve
+        scheduler.reject()
+        return busy_response(429, scheduler.retry_after(), "Inference queue is full")
+
+    loop = asyncio.get_running_loop()
+    t_start = time.perf_counter()
+
+    # 1. Read the upload and decode it once, in memory (off the event loop)
+    img_bytes = await image.read()
+    t_read = time.perf_counter()
+    pil_image, key = await loop.run_in_executor(io_executor, prepare_upload, img_bytes)
+    t_decode = time.perf_counter()
+
+    # 2. Queue for the next generate batch; callers await the job futures.
+    #    All prompts share the decoded image and its embedding-cache key.
+    jobs = [
+        InferenceJob(pil_image, prompt, image_key=key, task=task, max_new_tokens=max_new_tokens)
+        for prompt, task in zip(prompts, tasks)
+    ]
+    for job in jobs:
+        job.on_delta = on_delta
+        job.received_at = t_start
+        job.timings["read"] = (t_read - t_start) * 1000.0
+        job.timings["decode"] = (t_decode - t_read) * 1000.0
+    try:
+        scheduler.submit_group(jobs)
+    except QueueFullError as e:
+        return busy_response(429, e.retry_after, str(e))
+    return jobs
+
+
+def job_timings(job):
+    """Close out a finished job's timing breakdown and record it in /metrics."""
+    timings = dict(job.timings)
+    timings["total"] = (time.perf_counter() - job.received_at) * 1000.0
+    scheduler.record_timings(timings)
+    return {k: round(v, 2) for k, v in timings.items()}
+
+
+async def run_prompts(image, prompts, tasks, max_new_tokens=None):
+    """
+    Run prompts on one upload and wait for all of them.
+
+    Returns (payloads, timings) or a ready-made busy JSONResponse when rejected.
+    """
+    jobs = await submit_prompts(image, prompts, tasks, max_new_tokens)
+    if isinstance(jobs, JSONResponse):
+        return jobs
+    outputs = await asyncio.gather(*(asyncio.wrap_future(job.future) for job in jobs))
+    timings = job_timings(jobs[0])
+    payloads = [result_payload(text, job.task) for text, job in zip(outputs, jobs)]
+    return payloads, timings
+
+
+def sse(event):
+    return f"data: {json.dumps(event)}\n\n"
+
+
 @app.post("/infer")
 async def infer(
     image: UploadFile = File(...),
     prompt: str = Form(...),
+    task: str = Form("describe"),
+    max_new_tokens: int = Form(None),
 ):
+    """
+    task="bbox" caps generation at a few tokens, stops at the first closed
+    [x1,y1,x2,y2] and adds a parsed "bbox" field to the response.
+    """
+    if task not in TASK_MAX_NEW_TOKENS:
+        return invalid_task_response(task)
     try:
-        # 1. Save uploaded screenshot to a temp file
-        img_bytes = await image.read()
-        tmp_name = f"{uuid.uuid4().hex}.png"
-        tmp_path = os.path.join("/tmp", tmp_name)
-        with open(tmp_path, "wb") as f:
-            f.write(img_bytes)
-
-        # 2. Build messages EXACTLY like Qwen examples expect
-        #    (outer list = batch, inner list = conversation)
-        messages = [
-            [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "image": f"file://{tmp_path}",
-                        },
-                        {
-                            "type": "text",
-                            "text": prompt,
-                        },
-                    ],
-                }
-            ]
-        ]
+        result = await run_prompts(image, [prompt], [task], max_new_tokens)
+        if isinstance(result, JSONResponse):
+            return result
+        payloads, timings = result
+        return JSONResponse({**payloads[0], "timings_ms": timings})
 
-        # 3. Get text prompt via chat template (tokenize=False)
-        text = processor.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True,
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"error": str(e)},
         )
 
-        # 4. Use qwen-vl-utils to prepare visual inputs
-        images, videos, video_kwargs = process_vision_info(
-            messages,
-            image_patch_size=16,           # Qwen3-VL vision patch size  [oai_citation:2‡GitHub](https://github.com/QwenLM/Qwen3-VL)
-            return_video_kwargs=True,
-            return_video_metadata=True,
-        )
 
-        # For Qwen3-VL, videos (if any) come as (tensor, metadata)
-        if videos is not None:
-            videos, video_metadatas = zip(*videos)
-            videos = list(videos)
-            video_metadatas = list(video_metadatas)
-        else:
-            video_metadatas = None
-
-        # 5. Build model inputs via processor (cookbook style)
-        inputs = processor(
-            text=text,
-            images=images,
-            videos=videos,
-            video_metadata=video_metadatas,
-            return_tensors="pt",
-            do_resize=False,   # qwen-vl-utils already resized  [oai_citation:3‡PyPI](https://pypi.org/project/qwen-vl-utils/)
-            **video_kwargs,
-        )
+@app.post("/infer_multi")
+async def infer_multi(
+    image: UploadFile = File(...),
+    prompts: str = Form(...),
+    tasks: str = Form(None),
+):
+    """
+    One screenshot, several prompts (JSON list of strings), one batched generate.
+    Optional `tasks` is a parallel JSON list of task names (default "describe").
+    """
+    try:
+        prompt_list = json.loads(prompts)
+    except json.JSONDecodeError:
+        prompt_list = None
+    if (not isinstance(prompt_list, list) or not prompt_list
+            or not all(isinstance(p, str) for p in prompt_list)):
+        return JSONResponse(status_code=400, content={"error": "'prompts' must be a non-empty JSON list of strings"})
+    if len(prompt_list) > MAX_PROMPTS:
+        return JSONResponse(status_code=400, content={"error": f"At most {MAX_PROMPTS} prompts per request"})
+    try:
+        task_list = json.loads(tasks) if tasks else ["describe"] * len(prompt_list)
+    except json.JSONDecodeError:
+        task_list = None
+    if not isinstance(task_list, list) or len(task_list) != len(prompt_list):
+        return JSONResponse(status_code=400, content={"error": "'tasks' must be a JSON list matching 'prompts'"})
+    for task in task_list:
+        if task not in TASK_MAX_NEW_TOKENS:
+            return invalid_task_response(task)
+
+    try:
+        result = await run_prompts(image, prompt_list, task_list)
+        if isinstance(result, JSONResponse):
+            return result
+        payloads, timings = result
+        return JSONResponse({"outputs": payloads, "timings_ms": timings})
 
-        # 6. Move to model device
-        inputs = {k: v.to(model.device) if isinstance(v, torch.Tensor) else v
-                  for k, v in inputs.items()}
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"error": str(e)},
+        )
 
-        # 7. Generate + decode only the new tokens
-        generated_ids = model.generate(**inputs, max_new_tokens=256)
 
-        # For this qwen-vl-utils pipeline we didn’t pass input_ids directly,
-        # so we can just decode the whole sequence; the template is short anyway.
-        output_text = processor.batch_decode(
-            generated_ids,
-            skip_special_tokens=True,
-            clean_up_tokenization_spaces=False,
-        )[0]
+@app.post("/infer_stream")
+async def infer_stream(
+    image: UploadFile = File(...),
+    prompt: str = Form(...),
+    task: str = Form("describe"),
+    max_new_tokens: int = Form(None),
+):
+    """
+    Server-sent events variant of /infer: one {"delta": ...} event per decoded
+    chunk, then a final {"done": true, "raw_output": ..., ...} event. Closing
+    the connection early stops generation for this request's row.
+    """
+    if task not in TASK_MAX_NEW_TOKENS:
+        return invalid_task_response(task)
 
-        # 8. Cleanup tmp file
-        try:
-            os.remove(tmp_path)
-        except OSError:
-            pass
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
 
-        return JSONResponse({"raw_output": output_text})
+    def on_delta(text):
+        loop.call_soon_threadsafe(events.put_nowait, {"delta": text})
 
+    try:
+        jobs = await submit_prompts(image, [prompt], [task], max_new_tokens, on_delta=on_delta)
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"error": str(e)},
-        )
\ No newline at end of file
+        )
+    if isinstance(jobs, JSONResponse):
+        return jobs
+    job = jobs[0]
+    # Deltas are queued from the worker before the future resolves, so this sentinel comes last
+    job.future.add_done_callback(lambda _: loop.call_soon_threadsafe(events.put_nowait, None))
+
+    async def event_stream():
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield sse(event)
+            try:
+                text = job.future.result()
+            except Exception as e:
+                yield sse({"error": str(e)})
+                return
+            yield sse({"done": True, **result_payload(text, job.task), "timings_ms": job_timings(job)})
+        finally:
+            if not job.future.done():
+                job.cancelled = True
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.get("/health")
+async def health():
+    """Cheap liveness/load probe; never waits on the model."""
+    status = 200 if scheduler.healthy else 503
+    return JSONResponse(
+        status_code=status,
+        content={
+            "ok": scheduler.healthy,
+            "pending": scheduler.pending,
+            "max_pending": scheduler.max_pending,
+        },
+    )
+
+
+@app.get("/metrics")
+async def metrics():
+    """Batch-size and queue-wait histograms for tuning the batch window."""
+    return {
+        "max_batch_size": scheduler.max_batch_size,
+        "batch_window_ms": scheduler.window_s * 1000.0,
+        "max_pending": scheduler.max_pending,
+        "pending": scheduler.pending,
+        "rejected": scheduler.rejected,
+        "batch_size": scheduler.batch_size_hist.snapshot(),
+        "queue_wait_ms": scheduler.queue_wait_hist.snapshot(),
+        "batch_latency_ms": scheduler.batch_latency_hist.snapshot(),
+        "stage_ms": {stage: h.snapshot() for stage, h in scheduler.stage_hists.items()},
+        "embed_cache": embed_cache.stats(),
+    }
@@ -0,0 +1,91 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dom_grounding import DomIndex
+
+
+def element(role, name, box, pinned=False):
+    return {"role": role, "name": name, "tag": "a" if role == "link" else role, "pinned": pinned, "box": box}
+
+
+def index(elements, scroll=(0, 0), reach=2):
+    return DomIndex({"width": 1000, "height": 800, "scroll": list(scroll), "reach": reach, "elements": elements})
+
+
+MENU = [
+    element("link", "Margherita Pizza", [100, 100, 300, 130]),
+    element("button", "Add to cart", [320, 100, 420, 130]),
+    element("link", "Pepperoni Pizza", [100, 200, 300, 230]),
+    element("button", "Add to cart", [320, 200, 420, 230]),
+    element("searchbox", "Search menu", [600, 20, 900, 50]),
+]
+
+
+def test_exact_label_and_role_resolve():
+    dom = index(MENU)
+    assert dom.resolve("the 'Margherita Pizza' link") == [100, 125, 300, 162]
+    assert dom.resolve("search menu box") == [600, 25, 900, 62]
+
+
+def test_anchored_descriptions_fall_back_to_vision():
+    dom = index(MENU)
+    assert dom.resolve("the button next to 'Margherita Pizza'") is None
+    assert dom.resolve("Add to cart button within the card for Pepperoni Pizza") is None
+    assert dom.resolve("the link below the search box") is None
+
+
+def test_role_mismatch_is_rejected():
+    dom = index(MENU)
+    # The only element named Margherita Pizza is a link, not a button
+    assert dom.resolve("'Margherita Pizza' button") is None
+    assert dom.resolve("Margherita Pizza tab") is None
+
+
+def test_ambiguous_matches_are_left_unresolved():
+    dom = index(MENU)
+    # Two identical "Add to cart" buttons: within the margin of each other
+    assert dom.resolve("Add to cart button") is None
+    strict = DomIndex({"width": 1000, "height": 800, "elements": MENU[:2]}, margin=0.2)
+    assert strict.resolve("Add to cart button") == [320, 125, 420, 162]
+
+
+def test_weak_matches_are_left_unresolved():
+    dom = index(MENU)
+    assert dom.resolve("checkout") is None
+    assert dom.resolve("the pizza") is None  # both pizza links match equally
+
+
+def test_off_screen_elements_do_not_resolve_until_scrolled_to():
+    below = element("button", "Load more", [400, 1500, 600, 1540])
+    dom = index(MENU + [below])
+    assert dom.resolve("Load more button") is None
+    assert dom.covers(0, 800)
+    dom.scroll_to(0, 800)
+    assert dom.resolve("Load more button") == [400, 875, 600, 925]
+    # Scrolled away from the menu: its links are off screen now
+    assert dom.resolve("'Margherita Pizza' link") is None
+
+
+def test_pinned_elements_keep_their_viewport_position():
+    header = element("link", "Sign in", [850, 10, 950, 40], pinned=True)
+    dom = index(MENU + [header])
+    dom.scroll_to(0, 1200)
+    assert dom.resolve("Sign in link") == [850, 12, 950, 50]
+    assert dom.box(6) == [850, 12, 950, 50]
+    assert dom.box(1) is None
+    assert dom.box(0) is None and dom.box(99) is None
+
+
+def test_covers_is_limited_to_the_indexed_reach():
+    dom = index(MENU, scroll=(0, 400), reach=1)
+    assert dom.covers(0, 0)
+    assert not dom.covers(0, 1300)
+    assert not dom.covers(50, 400)
+
+
+def test_listing_numbers_on_screen_elements():
+    listing = index(MENU).listing()
+    assert listing.splitlines()[0] == '[1] link "Margherita Pizza" (200,143)'
+    assert '[5] searchbox "Search menu" (750,43)' in listing
@@ -0,0 +1,95 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dom_grounding import ELEMENTS_JS
+from web_navigator import BaseNavigator
+
+SNAPSHOT = {
+    "width": 1000,
+    "height": 800,
+    "scroll": [0, 0],
+    "reach": 1,
+    "elements": [
+        {"role": "link", "name": "Home", "tag": "a", "pinned": True, "box": [0, 0, 200, 50]},
+        {"role": "button", "name": "Add to cart", "tag": "button", "pinned": False, "box": [100, 1000, 300, 1100]},
+        {"role": "button", "name": "", "tag": "button", "pinned": False, "box": [500, 100, 540, 140]},
+    ],
+}
+
+
+class FakePage:
+    """Answers the navigator's INDEX_STATE_JS and ELEMENTS_JS evaluations."""
+
+    def __init__(self):
+        self.state = ["doc-1", 0, 0, 0]  # document, mutations, scroll x, scroll y
+        self.snapshots = 0
+
+    def evaluate(self, script, arg=None):
+        if script == ELEMENTS_JS:
+            self.snapshots += 1
+            return dict(SNAPSHOT, scroll=self.state[2:])
+        return list(self.state)
+
+
+def drive(steps, page):
+    value = None
+    while True:
+        try:
+            name, *args = steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        assert name == "_evaluate"
+        value = page.evaluate(*args)
+
+
+def test_scroll_inside_indexed_region_keeps_generation():
+    nav, page = BaseNavigator(None), FakePage()
+    generation, index = drive(nav._element_index(), page)
+    assert index.box(2) is None  # below the fold
+
+    page.state[3] = 600
+    assert drive(nav._element_index(), page) == (generation, index)
+    assert page.snapshots == 1
+    # Document boxes move with the scroll, pinned ones stay put
+    assert index.box(2) == [100, 500, 300, 625]
+    assert index.box(1) == [0, 0, 200, 62]
+
+
+def test_scroll_past_indexed_region_reindexes():
+    nav, page = BaseNavigator(None), FakePage()
+    generation, _ = drive(nav._element_index(), page)
+    page.state[3] = 900  # the viewport would end past the reach below the first snapshot
+    assert drive(nav._element_index(), page)[0] == generation + 1
+    assert page.snapshots == 2
+
+
+def test_mutation_or_new_document_reindexes():
+    nav, page = BaseNavigator(None), FakePage()
+    generation, _ = drive(nav._element_index(), page)
+    page.state[1] = 1
+    assert drive(nav._element_index(), page)[0] == generation + 1
+    page.state[0] = "doc-2"
+    assert drive(nav._element_index(), page)[0] == generation + 2
+    # Unknown mutation count: never trust the old index
+    page.state[1] = -1
+    drive(nav._element_index(), page)
+    assert drive(nav._element_index(), page)[0] == generation + 4
+
+
+def test_stale_element_id_is_rejected():
+    nav, page = BaseNavigator(None), FakePage()
+    generation, _ = drive(nav._element_index(), page)
+    assert drive(nav._indexed_box(1, generation), page) == [0, 0, 200, 62]
+    page.state[1] = 5
+    assert drive(nav._indexed_box(1, generation), page) is None
+    assert drive(nav._indexed_box(1, generation + 1), page) == [0, 0, 200, 62]
+
+
+def test_element_list_numbers_on_screen_elements():
+    nav, page = BaseNavigator(None), FakePage()
+    elements = drive(nav._elements(50), page)
+    assert elements.generation == 1
+    assert elements.listing == '[1] link "Home" (100,31)\n[3] button (unlabeled) (520,150)'
+    assert elements.unlabeled == [(3, [500, 125, 540, 175])]
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from planner import AsyncPlanner, Planner, PlannerContext, parse_partial_object
+
+
+class FakeClient:
+    """chat.completions.create returning a fixed summary."""
+
+    def __init__(self, summary="summary of earlier steps"):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.summary = summary
+
+    def create(self, **kwargs):
+        message = SimpleNamespace(content=self.summary)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def observation(n=0):
+    return "Page: search results\n" + "A long description of the page. " * 20 + str(n)
+
+
+def test_fold_re_expands_entries_deduped_against_folded_ones():
+    context = PlannerContext(FakeClient(), "gpt-4o-mini", token_budget=10 ** 6, keep_recent=2)
+    page = observation()
+    history = [
+        {"role": "user", "content": page},
+        {"role": "assistant", "content": "SCROLL down"},
+        {"role": "user", "content": page},
+    ]
+    context.update(history)
+    assert "(identical to [0])" in context.lines[2]
+
+    # Fold the first entry, the one the dedupe pointer refers to
+    context.token_budget = 1
+    history.append({"role": "assistant", "content": "OBSERVE"})
+    context.update(history)
+
+    history_text = "\n".join(context.lines)
+    assert "[0]" not in history_text
+    assert "identical to" not in history_text
+    assert page.strip() in history_text
+    messages, _ = context.messages("system", page, "https://example.com")
+    assert page.strip() in messages[1]["content"]
+
+
+def test_repeated_entries_are_sent_once_while_unfolded():
+    context = PlannerContext(FakeClient(), "gpt-4o-mini", token_budget=10 ** 6, keep_recent=8)
+    page = observation()
+    context.update([{"role": "user", "content": page}] * 3)
+    assert "(identical to [0])" in context.lines[1]
+    assert "(identical to [0])" in context.lines[2]
+
+
+class FakeStream:
+    """chat.completions.create(stream=True) yielding the response text in small chunks."""
+
+    def __init__(self, text, size=4):
+        self.chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        for chunk in self.chunks:
+            delta = SimpleNamespace(content=chunk)
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])
+
+
+def stream_plan(monkeypatch, response):
+    monkeypatch.setenv("PLANNER_STREAMING", "1")
+    monkeypatch.setenv("PLANNER_MACROS", "1")
+    planner = Planner("sk-test", client=FakeStream(response))
+    early = []
+    final = planner.get_next_action([{"role": "user", "content": "goal"}], "a page", on_action=early.append)
+    return early, final
+
+
+def test_early_action_waits_for_element_id_after_target(monkeypatch):
+    early, final = stream_plan(
+        monkeypatch,
+        '{"action": "CLICK", "element_description": "the Search button", "element_id": 12, "reason": "submit the query"}',
+    )
+    assert len(early) == 1
+    assert early[0]["element_id"] == 12
+    assert "reason" not in early[0]  # still dispatched before the stream finished
+    assert final["element_id"] == 12
+
+
+def test_early_action_waits_for_expect(monkeypatch):
+    early, _ = stream_plan(
+        monkeypatch,
+        '{"action": "TYPE", "text": "shoes", "element_description": "search box", "expect": "url_changed", "reason": "search"}',
+    )
+    assert early[0]["expect"] == "url_changed"
+
+
+def test_no_early_action_when_required_args_end_the_object(monkeypatch):
+    early, final = stream_plan(monkeypatch, '{"action": "CLICK", "element_description": "OK"}')
+    assert early == []
+    assert final == {"action": "CLICK", "element_description": "OK"}
+
+
+class AsyncFakeStream(FakeStream):
+    """FakeStream for an AsyncOpenAI client: create is awaited and returns an async iterator."""
+
+    async def create(self, **kwargs):
+        async def chunks():
+            for chunk in FakeStream.create(self, **kwargs):
+                yield chunk
+        return chunks()
+
+
+def test_async_planner_streams_like_the_threaded_one(monkeypatch):
+    response = '{"action": "CLICK", "element_description": "the Search button", "element_id": 12, "reason": "submit"}'
+    early, final = stream_plan(monkeypatch, response)
+    planner = AsyncPlanner("sk-test", client=AsyncFakeStream(response))
+    async_early, partials = [], []
+    async_final = asyncio.run(planner.get_next_action(
+        [{"role": "user", "content": "goal"}], "a page", on_action=async_early.append,
+        on_partial=lambda text, done=False: partials.append((text, done)),
+    ))
+    assert async_early == early
+    assert async_final == final
+    assert partials[-1] == (response, True)
+
+
+def test_parse_partial_object_reports_the_member_in_progress():
+    assert parse_partial_object('{"action": "CLICK", "element_id": 1') == ({"action": "CLICK"}, "element_id")
+    assert parse_partial_object('{"action": "CLICK", "reas') == ({"action": "CLICK"}, None)
+    assert parse_partial_object('{"action": "CLICK", "reason": "ok"}') == ({"action": "CLICK", "reason": "ok"}, None)
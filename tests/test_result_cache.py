@@ -0,0 +1,65 @@
+import io
+import os
+import sys
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vision_processor import ResultCache
+
+
+def screenshot(label, compress_level=6):
+    image = Image.new("RGB", (1280, 896), "white")
+    ImageDraw.Draw(image).rectangle([100, 100, 700, 500], fill=(30, 60, 120))
+    ImageDraw.Draw(image).text((120, 600), label, fill="black")
+    out = io.BytesIO()
+    image.save(out, format="PNG", compress_level=compress_level)
+    return out.getvalue()
+
+
+def test_key_follows_page_and_prompt():
+    cache = ResultCache()
+    key = cache.key("describe", screenshot("Cart"), "What is on the page?")
+    # Different bytes for the same pixels share the perceptual hash
+    assert cache.key("describe", screenshot("Cart", compress_level=1), "What is on the page?") == key
+    assert cache.key("describe", screenshot("Cart"), "Where is the cart?") != key
+    assert cache.key("ground", screenshot("Cart"), "What is on the page?") != key
+
+
+def test_memory_hit_and_miss():
+    cache = ResultCache()
+    assert cache.get("a") is None
+    cache.put("a", [1, 2, 3, 4])
+    assert cache.get("a") == [1, 2, 3, 4]
+    assert cache.stats["memory_hits"] == 1 and cache.stats["misses"] == 1
+
+
+def test_lru_evicts_least_recently_used():
+    cache = ResultCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats["evicted"] == 1
+
+
+def test_expired_entries_are_dropped(tmp_path):
+    cache = ResultCache(ttl=-1, path=str(tmp_path / "cache.db"))
+    cache.put("a", "answer")
+    assert cache.get("a") is None
+    assert cache.stats["expired"] == 2  # memory, then disk
+    assert cache.metrics()["disk_size"] == 0
+
+
+def test_sqlite_tier_survives_restart(tmp_path):
+    path = str(tmp_path / "cache.db")
+    ResultCache(path=path).put("a", {"bbox": [1, 2, 3, 4]})
+    cache = ResultCache(path=path)
+    assert cache.get("a") == {"bbox": [1, 2, 3, 4]}
+    assert cache.stats["disk_hits"] == 1
+    # Promoted into memory on the way out
+    assert cache.get("a") == {"bbox": [1, 2, 3, 4]}
+    assert cache.stats["memory_hits"] == 1
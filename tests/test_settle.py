@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from web_navigator import BaseNavigator
+
+
+def drive(steps, **operations):
+    """Run a BaseNavigator step generator against fake browser operations."""
+    value = None
+    while True:
+        try:
+            name, *args = steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value = operations[name](*args)
+
+
+def navigator(ceiling_ms=50):
+    nav = BaseNavigator(None)
+    nav.page = SimpleNamespace(viewport_size={"width": 1000, "height": 800})
+    nav.settle_poll_ms = 5
+    nav.settle_quiet_ms = 10
+    nav.settle_ceiling_ms["type"] = ceiling_ms
+    return nav
+
+
+def test_quiet_page_settles_before_ceiling():
+    nav = navigator()
+    drive(nav._settle("type", visual=False), _sleep=lambda ms: time.sleep(ms / 1000), _evaluate=lambda *a: 0)
+    assert nav.settle_timeouts["type"] == 0
+    assert nav.settle_times["type"][0] < 50
+
+
+def test_pending_navigation_holds_settle_past_ceiling():
+    nav = navigator()
+    nav._loading = (object(), time.monotonic())
+    sleeps = []
+
+    def sleep(ms):
+        sleeps.append(ms)
+        if len(sleeps) == 30:  # ~150 ms, three ceilings
+            nav._loading = None  # domcontentloaded
+        time.sleep(ms / 1000)
+
+    drive(nav._settle("type", visual=False), _sleep=sleep, _evaluate=lambda *a: 0)
+    assert nav.settle_timeouts["type"] == 0
+    assert nav.settle_times["type"][0] >= 150
+
+
+def test_navigation_wait_is_capped():
+    nav = navigator()
+    nav.settle_load_ms = 60
+    nav._loading = (object(), time.monotonic())
+    drive(nav._settle("type", visual=False), _sleep=lambda ms: time.sleep(ms / 1000), _evaluate=lambda *a: 0)
+    # Past the cap the navigation is ignored and the page settles as usual
+    assert 60 <= nav.settle_times["type"][0] < 1000
+
+
+def test_failed_navigation_stops_waiting():
+    nav = navigator()
+    request = object()
+    nav._loading = (request, time.monotonic())
+    nav._on_request_failed(object())
+    assert nav._loading is not None
+    nav._on_request_failed(request)
+    assert nav._loading is None
+
+
+def test_clear_input_settles_focus_before_selecting():
+    nav = navigator()
+    log = []
+
+    def ground(*args):
+        return [100, 100, 200, 200]
+        yield
+
+    def settle(action, visual=None):
+        log.append(("settle", action))
+        return
+        yield
+
+    nav._ground, nav._settle = ground, settle
+    cleared = drive(
+        nav._clear_input("Search field"),
+        _front=lambda: None,
+        _pointer=lambda method, x, y: log.append((method, x, y)),
+        _keyboard=lambda method, key: None,
+    )
+    assert cleared
+    assert log[:4] == [("click", 150, 120), ("settle", "focus"), ("dblclick", 150, 120), ("settle", "clear_input")]
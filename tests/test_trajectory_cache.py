@@ -0,0 +1,70 @@
+import io
+import os
+import sys
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trajectory_cache import TrajectoryCache, goal_key, url_pattern
+
+
+FORMS = {"Email": (80, 120), "Password": (700, 300), "Sign in": (300, 600)}
+
+
+def page(title):
+    """A page whose form sits in a different place per title, so their hashes differ."""
+    image = Image.new("RGB", (1280, 896), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([0, 0, 1280, 60], fill=(30, 60, 120))
+    x, y = FORMS[title]
+    draw.rectangle([x, y, x + 480, y + 240], fill=(90, 90, 90))
+    draw.text((x + 20, y + 20), title, fill="white")
+    out = io.BytesIO()
+    image.save(out, format="PNG")
+    return out.getvalue()
+
+
+LOGIN = "https://shop.example.com/login"
+
+
+def test_keys_ignore_case_ids_and_query():
+    assert goal_key("Log in, then Buy socks!") == goal_key("log in then buy socks")
+    assert url_pattern("https://Shop.example.com/orders/12345?tab=1#x") == "shop.example.com/orders/*"
+
+
+def test_user_typed_text_is_not_stored(tmp_path):
+    cache = TrajectoryCache(str(tmp_path / "steps.db"))
+    cache.record(
+        "Log in",
+        [
+            (LOGIN, page("Email"), {"action": "TYPE", "description": "Email", "text": "me@example.com"}, LOGIN),
+            (LOGIN, page("Password"), {"action": "TYPE", "description": "Password", "text": "hunter2"}, LOGIN),
+            (LOGIN, page("Sign in"), {"action": "CLICK", "description": "Sign in", "reason": "done", "element_id": 7}, LOGIN),
+        ],
+        user_inputs=["My password is hunter2"],
+    )
+    rows = cache.db.execute("SELECT action FROM steps").fetchall()
+    assert "hunter2" not in str(rows)
+
+    # The planner's own text replays; the user's answer is left to the planner
+    _, action, _ = cache.lookup("Log in", LOGIN, page("Email"))
+    assert action["text"] == "me@example.com"
+    assert cache.lookup("Log in", LOGIN, page("Password")) is None
+    assert cache.stats["needs_user"] == 1
+    # Run-specific fields are dropped
+    _, action, _ = cache.lookup("Log in", LOGIN, page("Sign in"))
+    assert action == {"action": "CLICK", "description": "Sign in"}
+
+
+def test_divergence_drops_step_and_replay_counts(tmp_path):
+    cache = TrajectoryCache(str(tmp_path / "steps.db"))
+    cache.record("Log in", [(LOGIN, page("Sign in"), {"action": "CLICK", "description": "Sign in"}, LOGIN)])
+    step_id, _, _ = cache.lookup("Log in", LOGIN, page("Sign in"))
+    cache.replayed(step_id)
+    assert cache.db.execute("SELECT hits FROM steps WHERE id = ?", (step_id,)).fetchone() == (1,)
+
+    cache.diverged(step_id)
+    assert cache.lookup("Log in", LOGIN, page("Sign in")) is None
+    metrics = cache.metrics()
+    assert metrics["replayed"] == 1 and metrics["diverged"] == 1 and metrics["size"] == 0
@@ -0,0 +1,71 @@
+import io
+import os
+import sys
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import bbox_from_crop, crop_region, frame_change, smart_resize
+
+
+def page(total):
+    image = Image.new("RGB", (1280, 896), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([0, 0, 1280, 60], fill=(30, 60, 120))
+    draw.text((40, 200), "Cart", fill="black")
+    draw.text((40, 240), f"Total: {total}", fill="black")
+    out = io.BytesIO()
+    image.save(out, format="PNG")
+    return out.getvalue()
+
+
+def test_unchanged_frame_is_none():
+    assert frame_change(page("$41"), page("$41")) == ("none", None)
+
+
+def test_single_glyph_change_is_local():
+    kind, bbox = frame_change(page("$41"), page("$47"))
+    assert kind == "local"
+    x1, y1, x2, y2 = bbox
+    # Around the price line, not the whole page
+    assert x1 < 120 and y1 <= 270 and y2 >= 270 and (x2 - x1) * (y2 - y1) < 50_000
+
+
+def test_resized_frame_is_global():
+    small = io.BytesIO()
+    Image.new("RGB", (640, 448), "white").save(small, format="PNG")
+    assert frame_change(page("$41"), small.getvalue()) == ("global", [0, 0, 1000, 1000])
+
+
+def test_smart_resize_snaps_to_patch_grid():
+    assert smart_resize(1280, 896) == (1280, 896)
+    assert smart_resize(1280, 720) == (1280, 704)
+    assert smart_resize(10, 10) == (32, 32)
+
+
+def test_smart_resize_keeps_pixel_budget():
+    w, h = smart_resize(1280, 720, max_pixels=500_000)
+    assert w % 32 == 0 and h % 32 == 0 and w * h <= 500_000
+    assert abs(w / h - 1280 / 720) < 0.1
+    w, h = smart_resize(100, 50, min_pixels=200_000)
+    assert w % 32 == 0 and h % 32 == 0 and w * h >= 200_000
+    assert w == 2 * h
+
+
+def test_crop_region_pads_around_box():
+    # 100x80 px box, padded by its own size on each side
+    assert crop_region((1000, 800), [450, 450, 550, 550]) == (350, 280, 650, 520)
+
+
+def test_crop_region_keeps_minimum_and_stays_inside_image():
+    # A tiny box in the corner still gets a quarter of each side, shifted onto the image
+    assert crop_region((1000, 800), [0, 0, 20, 20]) == (0, 0, 250, 200)
+    assert crop_region((1000, 800), [900, 900, 1000, 1000], margin=10) == (0, 0, 1000, 800)
+
+
+def test_bbox_from_crop_maps_back_to_full_image():
+    crop = crop_region((1000, 800), [450, 450, 550, 550])
+    # The target sits in the middle third of the crop
+    assert bbox_from_crop([333, 333, 667, 667], crop, (1000, 800)) == [450, 450, 550, 550]
+    assert bbox_from_crop([0, 0, 1000, 1000], crop, (1000, 800)) == [350, 350, 650, 650]
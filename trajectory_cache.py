@@ -0,0 +1,152 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+from utils import dhash
+
+# Only deterministic browser actions are replayed; judgement calls go to the planner
+REPLAYABLE_ACTIONS = {"NAVIGATE", "CLICK", "TYPE", "CLEAR_INPUT", "SCROLL", "WAIT"}
+
+
+def goal_key(goal):
+    """Normalized goal text: case, punctuation and spacing do not split cache entries."""
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", goal.lower()).split())
+
+
+def url_pattern(url):
+    """Host + path with ids and numbers wildcarded, query and fragment dropped."""
+    if not url:
+        return ""
+    parts = urlsplit(url)
+    segments = [
+        "*" if re.search(r"\d", s) or len(s) > 32 else s
+        for s in parts.path.strip("/").split("/") if s
+    ]
+    return f"{parts.netloc.lower()}/{'/'.join(segments)}"
+
+
+def from_user(text, user_inputs):
+    """True if typed text contains, or is part of, something the user answered during the run."""
+    text = str(text or "").strip()
+    return bool(text) and any(
+        answer in text or text in answer for answer in (str(a or "").strip() for a in user_inputs) if answer
+    )
+
+
+class TrajectoryCache:
+    """
+    Persistent memo of successful agent steps, keyed by normalized goal, URL
+    pattern and a perceptual hash of the page the step was taken on. A lookup
+    returns the recorded action if a stored page is within max_distance bits.
+    Text the user typed in answer to a question (possibly a credential) is
+    never stored; such a step is recorded without it and left to the planner.
+    """
+
+    def __init__(self, path, max_steps=5000, max_distance=8):
+        self.max_steps = max_steps
+        self.max_distance = max_distance
+        self.stats = Counter()  # lookups, hits, needs_user, replayed, diverged, recorded, evicted
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS steps (
+                id INTEGER PRIMARY KEY,
+                goal TEXT NOT NULL,
+                url TEXT NOT NULL,
+                page_hash TEXT NOT NULL,
+                action TEXT NOT NULL,
+                url_after TEXT NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS steps_key ON steps (goal, url)")
+        self.db.commit()
+
+    def lookup(self, goal, url, image_bytes, exclude=()):
+        """(step_id, action, url_after) for the closest recorded page, or None."""
+        page_hash = dhash(image_bytes)
+        with self._lock:
+            self.stats["lookups"] += 1
+            rows = self.db.execute(
+                "SELECT id, page_hash, action, url_after FROM steps WHERE goal = ? AND url = ?",
+                (goal_key(goal), url_pattern(url)),
+            ).fetchall()
+            best = None
+            for step_id, stored, action, url_after in rows:
+                if step_id in exclude:
+                    continue
+                distance = bin(int(stored, 16) ^ page_hash).count("1")
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, step_id, action, url_after)
+            if best is None:
+                return None
+            action = json.loads(best[2])
+            if action.get("action") == "TYPE" and action.get("text") is None:
+                # The text was the user's; the planner takes this step and asks for it again
+                self.stats["needs_user"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.db.execute("UPDATE steps SET last_used = ? WHERE id = ?", (time.time(), best[1]))
+            self.db.commit()
+            return best[1], action, best[3]
+
+    def replayed(self, step_id):
+        """The replayed step behaved as recorded."""
+        with self._lock:
+            self.stats["replayed"] += 1
+            self.db.execute("UPDATE steps SET hits = hits + 1 WHERE id = ?", (step_id,))
+            self.db.commit()
+
+    def diverged(self, step_id):
+        """The replayed step failed or led elsewhere; drop it so the live run can re-record it."""
+        with self._lock:
+            self.stats["diverged"] += 1
+            self.db.execute("DELETE FROM steps WHERE id = ?", (step_id,))
+            self.db.commit()
+
+    def record(self, goal, steps, user_inputs=()):
+        """
+        Store the steps of a successful run. Each step is
+        (url, image_bytes, action, url_after); non-replayable actions are skipped.
+        user_inputs are the user's answers during the run; TYPE text taken from
+        them is stored as None.
+        """
+        goal = goal_key(goal)
+        now = time.time()
+        with self._lock:
+            for url, image_bytes, action, url_after in steps:
+                if action.get("action") not in REPLAYABLE_ACTIONS:
+                    continue
+                # Element ids only mean something within the run that indexed the page
+                action = {k: v for k, v in action.items() if k not in ("reason", "element_id")}
+                if action.get("action") == "TYPE" and from_user(action.get("text"), user_inputs):
+                    action["text"] = None
+                key = (goal, url_pattern(url), format(dhash(image_bytes), "016x"))
+                # Same page, newer answer: replace rather than accumulate
+                self.db.execute("DELETE FROM steps WHERE goal = ? AND url = ? AND page_hash = ?", key)
+                self.db.execute(
+                    "INSERT INTO steps (goal, url, page_hash, action, url_after, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                    (*key, json.dumps(action), url_pattern(url_after), now),
+                )
+                self.stats["recorded"] += 1
+            evicted = self.db.execute(
+                "DELETE FROM steps WHERE id NOT IN (SELECT id FROM steps ORDER BY last_used DESC LIMIT ?)",
+                (self.max_steps,),
+            ).rowcount
+            self.stats["evicted"] += evicted
+            self.db.commit()
+
+    def metrics(self):
+        with self._lock:
+            size = self.db.execute("SELECT COUNT(*) FROM steps").fetchone()[0]
+            lookups = self.stats["lookups"]
+            return {
+                **self.stats,
+                "size": size,
+                "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+            }
@@ -1,6 +1,8 @@
+import io
 import re
 import json
-from PIL import Image, ImageDraw, ImageColor
+import math
+from PIL import Image, ImageChops, ImageDraw, ImageColor
 
 def extract_bbox(raw_text):
     """
@@ -24,6 +26,33 @@ def extract_bbox(raw_text):
     except Exception:
         raise ValueError(f"Could not parse bbox: {bbox_str}")
 
+def normalize_target(text):
+    """Canonical form of an element description, for matching planner targets to observed ones."""
+    text = " ".join(re.sub(r"[^a-z0-9]+", " ", text.lower()).split())
+    return re.sub(r"^(the|a|an) ", "", text)
+
+
+def element_candidates(description, limit=6):
+    """
+    Likely click/type targets named in a page description: the label part of
+    each bullet line ("- **Search button**: top right" -> "Search button").
+    """
+    candidates = []
+    seen = set()
+    for line in description.splitlines():
+        match = re.match(r"\s*(?:[-*\u2022]|\d+[.)])\s+(.*)", line)
+        if not match:
+            continue
+        label = re.split(r":|\s[-\u2013\u2014]\s|\(", match.group(1).replace("**", ""))[0].strip(" .\"'")
+        key = normalize_target(label)
+        if key and len(label) <= 60 and key not in seen:
+            seen.add(key)
+            candidates.append(label)
+            if len(candidates) >= limit:
+                break
+    return candidates
+
+
 def draw_point(image, point, radius=10, color='red'):
     """Draw a semi-transparent point using Qwen's visualization style."""
     overlay = Image.new('RGBA', image.size, (255, 255, 255, 0))
@@ -48,3 +77,164 @@ def draw_box(image, box, color='green', width=4):
         width=width
     )
     return Image.alpha_composite(image.convert('RGBA'), overlay).convert('RGB')
+
+
+def draw_marks(image_bytes, marks, color='red'):
+    """
+    Set-of-marks overlay: outline each normalized 0..1000 box in marks
+    [(id, bbox), ...] and tag it with its id. Returns bytes in the input's format.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    fmt = image.format or "PNG"
+    image = image.convert("RGB")
+    draw = ImageDraw.Draw(image)
+    rgb = ImageColor.getrgb(color)
+    for mark_id, (x1, y1, x2, y2) in marks:
+        box = (x1 * image.width // 1000, y1 * image.height // 1000,
+               x2 * image.width // 1000, y2 * image.height // 1000)
+        draw.rectangle(box, outline=rgb, width=2)
+        label = str(mark_id)
+        left, top, right, bottom = draw.textbbox((0, 0), label)
+        tag = (box[0], max(box[1] - (bottom - top) - 4, 0))
+        draw.rectangle((tag[0], tag[1], tag[0] + right - left + 4, tag[1] + bottom - top + 4), fill=rgb)
+        draw.text((tag[0] + 2 - left, tag[1] + 2 - top), label, fill="white")
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, **({"quality": 90} if fmt in ("JPEG", "WEBP") else {}))
+    return buffer.getvalue()
+
+
+# Qwen3-VL sees 16 px patches merged 2x2, so each visual token covers a 32 px square
+IMAGE_FACTOR = 32
+
+IMAGE_MIME = {
+    "png": ("screenshot.png", "image/png"),
+    "jpeg": ("screenshot.jpg", "image/jpeg"),
+    "webp": ("screenshot.webp", "image/webp"),
+    "raw": ("screenshot.ppm", "image/x-portable-pixmap"),
+}
+
+
+def smart_resize(width, height, factor=IMAGE_FACTOR, min_pixels=None, max_pixels=None):
+    """
+    Qwen-VL style target size: both sides rounded to multiples of factor and the
+    area kept within [min_pixels, max_pixels], preserving aspect ratio.
+    Returns (width, height).
+    """
+    w = max(factor, round(width / factor) * factor)
+    h = max(factor, round(height / factor) * factor)
+    if max_pixels and w * h > max_pixels:
+        beta = math.sqrt((width * height) / max_pixels)
+        w = max(factor, math.floor(width / beta / factor) * factor)
+        h = max(factor, math.floor(height / beta / factor) * factor)
+    elif min_pixels and w * h < min_pixels:
+        beta = math.sqrt(min_pixels / (width * height))
+        w = math.ceil(width * beta / factor) * factor
+        h = math.ceil(height * beta / factor) * factor
+    return w, h
+
+
+def encode_screenshot(image, fmt="png", quality=85, min_pixels=None, max_pixels=None, factor=IMAGE_FACTOR):
+    """
+    Resize a screenshot (PIL image or encoded bytes) onto the model's patch grid
+    and encode it for upload. fmt is one of png, jpeg, webp or raw (binary PPM,
+    i.e. uncompressed RGB that the server decodes without a codec).
+    The whole frame is kept, so normalized 0..1000 coordinates still map onto the viewport.
+    """
+    if isinstance(image, (bytes, bytearray)):
+        image = Image.open(io.BytesIO(image))
+    image = image.convert("RGB")
+    size = smart_resize(image.width, image.height, factor, min_pixels, max_pixels)
+    if size != image.size:
+        image = image.resize(size, Image.LANCZOS)
+    out = io.BytesIO()
+    if fmt == "jpeg":
+        image.save(out, format="JPEG", quality=quality)
+    elif fmt == "webp":
+        image.save(out, format="WEBP", quality=quality, method=4)
+    elif fmt == "raw":
+        image.save(out, format="PPM")
+    elif fmt == "png":
+        image.save(out, format="PNG", compress_level=1)
+    else:
+        raise ValueError(f"Unknown screenshot format: {fmt}")
+    return out.getvalue()
+
+
+def image_upload(image_bytes):
+    """(filename, content type) for an encoded screenshot, sniffed from its magic bytes."""
+    if image_bytes[:3] == b"\xff\xd8\xff":
+        return IMAGE_MIME["jpeg"]
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return IMAGE_MIME["webp"]
+    if image_bytes[:2] == b"P6":
+        return IMAGE_MIME["raw"]
+    return IMAGE_MIME["png"]
+
+
+def crop_region(image_size, bbox, margin=1.0, min_fraction=0.25):
+    """
+    Pixel crop box (left, top, right, bottom) around a normalized 0..1000 bbox,
+    padded by margin x the box size on each side and at least min_fraction of
+    the image in each dimension, clamped to the image.
+    """
+    width, height = image_size
+    x1, y1, x2, y2 = bbox
+    cx, cy = (x1 + x2) / 2000 * width, (y1 + y2) / 2000 * height
+    half_w = max((x2 - x1) / 1000 * width * (0.5 + margin), min_fraction * width / 2)
+    half_h = max((y2 - y1) / 1000 * height * (0.5 + margin), min_fraction * height / 2)
+    half_w, half_h = min(half_w, width / 2), min(half_h, height / 2)
+    # Shift rather than shrink the window when it runs past an edge
+    left = int(min(max(0, cx - half_w), width - 2 * half_w))
+    top = int(min(max(0, cy - half_h), height - 2 * half_h))
+    return left, top, int(left + 2 * half_w), int(top + 2 * half_h)
+
+
+def bbox_from_crop(bbox, crop_box, image_size):
+    """Map a 0..1000 bbox predicted on a crop back to 0..1000 on the full image."""
+    left, top, right, bottom = crop_box
+    width, height = image_size
+    cw, ch = right - left, bottom - top
+    x1, y1, x2, y2 = bbox
+    return [
+        round((left + x1 / 1000 * cw) / width * 1000),
+        round((top + y1 / 1000 * ch) / height * 1000),
+        round((left + x2 / 1000 * cw) / width * 1000),
+        round((top + y2 / 1000 * ch) / height * 1000),
+    ]
+
+
+def dhash(image_bytes, size=8):
+    """size*size-bit difference hash of a screenshot (64 bits at the default size 8): near-identical pages differ in only a few bits."""
+    img = Image.open(io.BytesIO(image_bytes)).convert("L").resize((size + 1, size), Image.BILINEAR)
+    pixels = list(img.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def frame_change(before, after, grid=(96, 64), threshold=24, local_area=0.25):
+    """
+    How the page changed between two screenshots: ("none", None), or ("local" or
+    "global", bbox) with bbox the changed area in normalized 0..1000 coordinates.
+    Pixels whose grayscale value moved by more than threshold count as changed,
+    so encoder noise stays out; a grid cell is changed if any of its pixels is,
+    so a single changed digit or checkbox is not averaged away. A change is
+    local while its bounding box covers at most local_area of the page.
+    """
+    a, b = Image.open(io.BytesIO(before)), Image.open(io.BytesIO(after))
+    if a.size != b.size:
+        return "global", [0, 0, 1000, 1000]
+    changed = ImageChops.difference(a.convert("L"), b.convert("L")).point(lambda v: 255 if v > threshold else 0)
+    # Max per cell: any changed pixel leaves its (box-averaged) cell non-zero
+    box = changed.resize(grid, Image.BOX, reducing_gap=None).point(lambda v: 255 if v else 0).getbbox()
+    if box is None:
+        return "none", None
+    x1, y1, x2, y2 = box
+    width, height = grid
+    bbox = [x1 * 1000 // width, y1 * 1000 // height, -(-x2 * 1000 // width), -(-y2 * 1000 // height)]
+    area = (x2 - x1) * (y2 - y1) / (width * height)
+    return ("local" if area <= local_area else "global"), bbox
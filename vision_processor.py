@@ -2,65 +2,649 @@ import requests
 import io
 from PIL import Image
 import json
-from utils import extract_bbox, draw_box, draw_point
+from utils import (
+    extract_bbox, draw_box, draw_point, image_upload, encode_screenshot, crop_region, bbox_from_crop,
+    dhash, normalize_target,
+)
 import os
+import time
+import random
+import hashlib
+import sqlite3
+import threading
+import asyncio
+from collections import deque, OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from requests.adapters import HTTPAdapter
 
-class VisionProcessor:
-    def __init__(self, model_url=None):
-        self.model_url = model_url or os.environ.get("VISION_MODEL_URL", "http://localhost:8000/infer")
+try:
+    import httpx
+except ImportError:  # optional: only the asyncio runtime (AsyncVisionProcessor) needs it
+    httpx = None
 
-    def query_model(self, image_bytes, prompt):
-        """Send screenshot + prompt to the Qwen-VL server."""
-        # Basic retries for transient server errors
+
+class VisionEndpoint:
+    """One vision server replica: its base URL, client-side load and circuit-breaker state."""
+
+    def __init__(self, infer_url):
+        self.infer_url = infer_url
+        self.outstanding = 0     # requests this client has in flight to the replica
+        self.server_pending = 0  # queue depth last reported by /health
+        self.healthy = True
+        self.failures = 0        # consecutive transport/5xx failures
+        self.open_until = 0.0    # circuit open (replica skipped) until this monotonic time
+        self.busy_until = 0.0    # replica asked us to back off (429/503 Retry-After)
+
+    def url(self, path):
+        return BaseVisionProcessor._sibling_url(self.infer_url, path)
+
+    def __repr__(self):
+        return f"VisionEndpoint({self.infer_url!r})"
+
+
+class ResultCache:
+    """
+    Vision answers keyed by a perceptual hash of the screenshot plus the
+    normalized prompt, so a page seen before (by any task or user) is answered
+    without a GPU round-trip. An in-memory LRU sits in front of an optional
+    SQLite file; entries in both expire after ttl seconds.
+    """
+
+    def __init__(self, max_entries=512, ttl=3600, path=None, max_disk_entries=20000, hash_size=32):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.hash_size = hash_size
+        self.stats = Counter()  # memory_hits, disk_hits, misses, stores, expired, evicted
+        self._memory = OrderedDict()  # key -> (value, stored_at)
+        self._page_hashes = OrderedDict()  # exact image digest -> perceptual hash, for repeat queries
+        self._lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS results_age ON results (stored_at)")
+            self.db.commit()
+
+    def key(self, kind, image_bytes, prompt):
+        digest = hashlib.blake2b(image_bytes, digest_size=16).digest()
+        with self._lock:
+            page = self._page_hashes.get(digest)
+        if page is None:
+            page = format(dhash(image_bytes, self.hash_size), "x")
+            with self._lock:
+                self._page_hashes[digest] = page
+                if len(self._page_hashes) > 64:
+                    self._page_hashes.popitem(last=False)
+        return hashlib.sha1(f"{kind}\0{page}\0{prompt}".encode()).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if now - stored_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+                self.stats["expired"] += 1
+            if self.db is not None:
+                row = self.db.execute("SELECT value, stored_at FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    if now - row[1] <= self.ttl:
+                        value = json.loads(row[0])
+                        self._remember(key, value, row[1])
+                        self.stats["disk_hits"] += 1
+                        return value
+                    self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+                    self.db.commit()
+                    self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            self.stats["stores"] += 1
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, json.dumps(value), now))
+                if self.stats["stores"] % 100 == 0:
+                    self.stats["evicted"] += self.db.execute(
+                        "DELETE FROM results WHERE stored_at < ? OR key NOT IN "
+                        "(SELECT key FROM results ORDER BY stored_at DESC LIMIT ?)",
+                        (now - self.ttl, self.max_disk_entries),
+                    ).rowcount
+                self.db.commit()
+
+    def _remember(self, key, value, stored_at):
+        self._memory[key] = (value, stored_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["memory_size"] = len(self._memory)
+            if self.db is not None:
+                stats["disk_size"] = self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        hits = stats.get("memory_hits", 0) + stats.get("disk_hits", 0)
+        lookups = hits + stats.get("misses", 0)
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
+
+
+# Returned by a stream consumer (see BaseVisionProcessor._stream) to ask for the next event
+MORE = object()
+
+
+def _decode(image_bytes):
+    return Image.open(io.BytesIO(image_bytes)).convert("RGB")
+
+
+class BaseVisionProcessor:
+    """
+    Replica choice, circuit breaker, retry/throttle/hedging policy, result cache
+    and the prompt and answer handling shared by VisionProcessor (requests,
+    threads) and AsyncVisionProcessor (httpx, asyncio). The request logic is
+    written once as generators of transport operations; each subclass's _drive
+    performs them with its own HTTP client, so the two only differ in I/O.
+    """
+
+    # Exceptions of the subclass's HTTP client that count as a failed attempt
+    transport_errors = ()
+
+    def __init__(self, model_url=None, streaming=None, cache=None, health_interval=None):
+        # VISION_MODEL_URL may list several replicas, comma-separated
+        urls = model_url or os.environ.get("VISION_MODEL_URL", "http://localhost:8000/infer")
+        if isinstance(urls, str):
+            urls = urls.split(",")
+        self.endpoints = [VisionEndpoint(u.strip()) for u in urls if u.strip()]
+        self.model_url = self.endpoints[0].infer_url
+        # Stream grounding answers so a bbox is returned as soon as it parses
+        if streaming is None:
+            streaming = os.environ.get("VISION_STREAMING", "1") == "1"
+        self.streaming = streaming
+        self._stream_supported = True  # flipped off if the server has no /infer_stream
+        # Upper bound on total time spent honoring Retry-After for one query
+        self.max_throttle_wait = float(os.environ.get("VISION_MAX_THROTTLE_WAIT", "60"))
+        # Coarse-to-fine grounding: low-res locate pass, then a zoomed crop of that region
+        self.coarse_to_fine = os.environ.get("VISION_COARSE_TO_FINE", "0") == "1"
+        self.coarse_max_pixels = int(os.environ.get("VISION_COARSE_MAX_PIXELS", str(320 * 32 * 32)))
+        self.fine_min_pixels = int(os.environ.get("VISION_FINE_MIN_PIXELS", str(192 * 32 * 32)))
+        self.fine_max_pixels = int(os.environ.get("VISION_FINE_MAX_PIXELS", str(320 * 32 * 32)))
+        self.crop_margin = float(os.environ.get("VISION_CROP_MARGIN", "1.0"))
+        self.crop_min_fraction = float(os.environ.get("VISION_CROP_MIN_FRACTION", "0.25"))
+
+        self.timeout = (
+            float(os.environ.get("VISION_CONNECT_TIMEOUT", "5")),
+            float(os.environ.get("VISION_READ_TIMEOUT", "120")),
+        )
+        self.max_attempts = int(os.environ.get("VISION_MAX_ATTEMPTS", "3"))
+        self.backoff_s = float(os.environ.get("VISION_BACKOFF", "0.5"))
+        # Circuit breaker: skip a replica for a cooldown after N consecutive failures
+        self.breaker_failures = int(os.environ.get("VISION_BREAKER_FAILURES", "3"))
+        self.breaker_cooldown = float(os.environ.get("VISION_BREAKER_COOLDOWN", "30"))
+        # Hedging: if a call outlives the recent p95 for its kind, duplicate it to another replica
+        self.hedge = os.environ.get("VISION_HEDGE", "0") == "1" and len(self.endpoints) > 1
+        self.hedge_delay = float(os.environ.get("VISION_HEDGE_DELAY", "2"))
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+        # Results cache: repeat screenshots of the same page/layout are answered locally. Off by
+        # default: pages that differ only in small text (prices, counters) share a hash
+        if cache is None:
+            cache = os.environ.get("VISION_CACHE", "0") == "1"
+        self.cache = ResultCache(
+            max_entries=int(os.environ.get("VISION_CACHE_SIZE", "512")),
+            ttl=float(os.environ.get("VISION_CACHE_TTL", "3600")),
+            path=os.environ.get("VISION_CACHE_PATH") or None,
+            max_disk_entries=int(os.environ.get("VISION_CACHE_DISK_SIZE", "20000")),
+            hash_size=int(os.environ.get("VISION_CACHE_HASH_SIZE", "32")),
+        ) if cache else None
+
+        if health_interval is None:
+            health_interval = float(os.environ.get("VISION_HEALTH_INTERVAL", "10"))
+        self.health_interval = health_interval
+
+    # Requests, written once as generators of transport operations. Each step yields
+    # (operation, *args) and is sent the result, or has the operation's exception thrown in:
+    #   _http_post(url, data, files, stream), _http_get(url, timeout), _close(response),
+    #   _lines(response), _next_line(lines), _sleep(seconds), _cpu(fn, *args),
+    #   _spawn(steps) and _wait(futures, timeout) for hedging
+
+    def _query(self, image_bytes, prompt, task=None):
+        data = {"prompt": prompt}
+        if task:
+            data["task"] = task
+        return (yield from self._post("infer", data, image_bytes))
+
+    def _query_many(self, image_bytes, prompts, tasks=None):
+        prompts = list(prompts)
+        if not prompts:
+            return []
+        data = {"prompts": json.dumps(prompts)}
+        if tasks:
+            data["tasks"] = json.dumps(list(tasks))
+        result = yield from self._post("infer_multi", data, image_bytes)
+        outputs = result.get("outputs")
+        if not isinstance(outputs, list) or len(outputs) != len(prompts):
+            raise RuntimeError(f"Vision model returned malformed multi-prompt response: {result}")
+        return outputs
+
+    def _post(self, path, data, image_bytes):
+        response, _ = yield from self._request(path, data, image_bytes)
+        try:
+            return response.json()
+        except json.JSONDecodeError:
+            return {"raw_output": response.text}
+
+    def _stream(self, image_bytes, prompt, task, consume):
+        """
+        Stream an answer from /infer_stream, passing each event ({"delta": text}...,
+        then {"done": True, "raw_output": ...}) to consume until it returns something
+        other than MORE, and return that. A stream that ends without its done event
+        is finished with {"done": True}. Stopping early drops the connection, which
+        stops generation on the server.
+        """
+        data = {"prompt": prompt}
+        if task:
+            data["task"] = task
+        if self._stream_supported:
+            response, endpoint = yield from self._request(
+                "infer_stream", data, image_bytes, stream=True, passthrough=(404,))
+            if response.status_code != 404:
+                return (yield from self._consume(response, endpoint, consume))
+            # Server without streaming support: answer in one piece from now on
+            yield ("_close", response)
+            self._finish(endpoint)
+            self._stream_supported = False
+        return consume({"done": True, **(yield from self._post("infer", data, image_bytes))})
+
+    def _consume(self, response, endpoint, consume):
+        try:
+            lines = yield ("_lines", response)
+            while True:
+                line = yield ("_next_line", lines)
+                if line is None:
+                    result = consume({"done": True})
+                    break
+                if not line.startswith("data:"):
+                    continue
+                event = json.loads(line[len("data:"):].strip())
+                if "error" in event:
+                    raise RuntimeError(f"Vision model stream failed: {event['error']}")
+                result = consume(event)
+                if result is not MORE:
+                    break
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            # Also on cancellation: the streamed response holds its endpoint until closed
+            yield ("_close", response)
+            self._finish(endpoint, failed=isinstance(e, self.transport_errors))
+            raise
+        yield ("_close", response)
+        self._finish(endpoint)
+        return result
+
+    def _request(self, path, data, image_bytes, stream=False, passthrough=()):
+        """
+        POST to the least-loaded usable replica and return (response, endpoint).
+        Transport errors and 5xx retry on another replica with jittered
+        exponential backoff; 429/503 mark the replica busy per Retry-After.
+        A streamed response keeps its endpoint checked out until the caller
+        passes it to _finish.
+        """
+        kind = (path, data.get("task"))
         last_exc = None
-        for attempt in range(2):
+        attempt = 0
+        throttled_s = 0.0
+        failed_on = set()
+        while attempt < self.max_attempts:
+            endpoint = self._pick(exclude=failed_on)
             try:
-                response = requests.post(
-                    self.model_url,
-                    data={"prompt": prompt},
-                    files={"image": ("screenshot.png", image_bytes, "image/png")},
-                    timeout=120,
-                )
-                response.raise_for_status()
+                if self.hedge and not stream:
+                    response, endpoint = yield from self._send_hedged(endpoint, path, data, image_bytes, kind, failed_on)
+                else:
+                    response = yield from self._send(endpoint, path, data, image_bytes, stream, kind)
+                status = response.status_code
+                if status in (429, 503):
+                    delay = self._mark_busy(endpoint, self._retry_after(response))
+                    if throttled_s + delay <= self.max_throttle_wait:
+                        yield from self._release(response, endpoint, stream)
+                        if delay > 0:
+                            print(f"Vision server busy ({status}); retrying in {delay:.1f}s")
+                            yield ("_sleep", delay)
+                            throttled_s += delay
+                        continue
+                if status < 400 or status in passthrough:
+                    return response, endpoint
                 try:
-                    return response.json()
-                except json.JSONDecodeError:
-                    return {"raw_output": response.text}
-            except requests.exceptions.RequestException as e:
+                    response.raise_for_status()
+                finally:
+                    yield from self._release(response, endpoint, stream)
+            except self.transport_errors as e:
                 last_exc = e
+                failed_on.add(endpoint)
+                response = getattr(e, "response", None)
+                if response is not None and response.status_code < 500:
+                    break  # client errors (and an exhausted throttle budget) will not improve on retry
+            attempt += 1
+            if attempt < self.max_attempts:
+                yield ("_sleep", self.backoff_s * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
         # Surface a structured error for the agent
         raise RuntimeError(f"Vision model request failed: {last_exc}")
 
-    def describe_image(self, image_bytes, question=None):
+    def _send(self, endpoint, path, data, image_bytes, stream, kind):
+        """One HTTP attempt against one replica, with load and breaker bookkeeping."""
+        with self._lock:
+            endpoint.outstanding += 1
+        filename, content_type = image_upload(image_bytes)
+        start = time.monotonic()
+        try:
+            response = yield ("_http_post", endpoint.url(path), data,
+                              {"image": (filename, image_bytes, content_type)}, stream)
+        except self.transport_errors:
+            self._finish(endpoint, failed=True)
+            raise
+        except BaseException:
+            with self._lock:
+                endpoint.outstanding -= 1  # abandoned (hedge loser, cancelled task); not the replica's fault
+            raise
+        if not stream:
+            ok = response.status_code < 400
+            self._finish(endpoint, failed=self._is_failure(response), kind=kind,
+                         latency=time.monotonic() - start if ok else None)
+        return response
+
+    def _release(self, response, endpoint, stream):
+        """Drop a response that will not be returned; streamed ones still hold their endpoint."""
+        yield ("_close", response)
+        if stream:
+            self._finish(endpoint, failed=self._is_failure(response))
+
+    def _send_hedged(self, primary, path, data, image_bytes, kind, exclude):
         """
-        Takes an image and returns a description of the elements on the page.
-        If a question is provided, it will be used as the prompt.
+        Send to primary; if it has not answered within the recent p95 for this
+        kind of call, send a copy to a second replica and keep the first good answer.
         """
-        if question:
-            prompt = question
-        else:
-            prompt = "Describe the main elements on this webpage. Include buttons, input fields, and links. Be concise and use bullet points."
-        
-        model_output = self.query_model(image_bytes, prompt)
-        
-        raw_output = model_output["raw_output"]
-        
+        first = yield ("_spawn", self._send(primary, path, data, image_bytes, False, kind))
+        owners = {first: primary}
+        winner = first
+        try:
+            if not (yield ("_wait", {first}, self._hedge_after(kind))):
+                backup = self._pick(exclude=set(exclude) | {primary})
+                if backup is primary:
+                    yield ("_wait", {first}, None)
+                    return first.result(), primary
+                print(f"Vision call slow on {primary.infer_url}; hedging to {backup.infer_url}")
+                second = yield ("_spawn", self._send(backup, path, data, image_bytes, False, kind))
+                owners[second] = backup
+                pending = set(owners)
+                while pending:
+                    done = yield ("_wait", pending, None)
+                    pending -= done
+                    for future in done:
+                        if future.exception() is None and future.result().status_code < 400:
+                            winner = future
+                            return future.result(), owners[future]
+            # Answered in time, or neither copy produced a usable answer: the primary's outcome
+            return first.result(), primary
+        finally:
+            for future in owners:
+                if future is not winner:
+                    self._abandon(future)
+
+    def _check_health(self, endpoint):
+        try:
+            response = yield ("_http_get", endpoint.url("health"), self.timeout[0])
+            # Servers without /health are assumed up; the breaker still guards them
+            healthy = response.status_code in (200, 404)
+            body = response.json() if response.status_code == 200 else {}
+        except self.transport_errors + (ValueError,):
+            healthy, body = False, {}
+        self._set_health(endpoint, healthy, body)
+
+    # Replica state; shared by every thread or coroutine using this processor
+
+    @staticmethod
+    def _is_failure(response):
+        # 503 is the server's own back-pressure signal, not a sign the replica is broken
+        return response.status_code >= 500 and response.status_code != 503
+
+    def _usable(self, endpoint, now):
+        """Healthy and circuit closed, or half-open with no trial request in flight."""
+        if not endpoint.healthy:
+            return False
+        if endpoint.failures < self.breaker_failures:
+            return True
+        return now >= endpoint.open_until and endpoint.outstanding == 0
+
+    def _pick(self, exclude=()):
+        """Least-outstanding-requests choice, preferring usable, non-throttled replicas."""
+        now = time.monotonic()
+        with self._lock:
+            usable = [e for e in self.endpoints if self._usable(e, now)]
+            ready = [e for e in usable if now >= e.busy_until]
+            candidates = [e for e in ready if e not in exclude] or ready or usable or self.endpoints
+            return min(candidates, key=lambda e: (e.outstanding, e.server_pending, random.random()))
+
+    def _finish(self, endpoint, failed=False, kind=None, latency=None):
+        """Release an in-flight request and update the replica's circuit breaker."""
+        now = time.monotonic()
+        with self._lock:
+            endpoint.outstanding -= 1
+            if not failed:
+                endpoint.failures = 0
+                if latency is not None:
+                    self._latencies.setdefault(kind, deque(maxlen=200)).append(latency)
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= self.breaker_failures:
+                if now >= endpoint.open_until:
+                    print(f"Vision endpoint {endpoint.infer_url} failing; skipping it for {self.breaker_cooldown:.0f}s")
+                endpoint.open_until = now + self.breaker_cooldown
+
+    def _mark_busy(self, endpoint, delay):
+        """Record a Retry-After; return how long until some usable replica accepts work."""
+        now = time.monotonic()
+        with self._lock:
+            endpoint.busy_until = now + max(delay, 0.1)
+            usable = [e for e in self.endpoints if self._usable(e, now)] or [endpoint]
+            return max(0.0, min(e.busy_until for e in usable) - now)
+
+    def _hedge_after(self, kind):
+        """p95 of recent latencies for this kind of call, or the configured delay until warmed up."""
+        with self._lock:
+            samples = sorted(self._latencies.get(kind, ()))
+        if len(samples) < 20:
+            return self.hedge_delay
+        return samples[int(0.95 * (len(samples) - 1))]
+
+    def _set_health(self, endpoint, healthy, body):
+        with self._lock:
+            if endpoint.healthy != healthy:
+                print(f"Vision endpoint {endpoint.infer_url} is {'up' if healthy else 'down'}")
+            endpoint.healthy = healthy
+            endpoint.server_pending = body.get("pending", 0) if isinstance(body, dict) else 0
+
+    @staticmethod
+    def _sibling_url(infer_url, path):
+        """Derive another endpoint (e.g. /infer_multi) from the configured /infer URL."""
+        base = infer_url.rstrip("/")
+        if base.endswith("/infer"):
+            base = base[: -len("/infer")]
+        return f"{base}/{path}"
+
+    @staticmethod
+    def _retry_after(response, default=1.0):
+        """Parse a Retry-After header given in seconds; fall back to a short default."""
+        value = response.headers.get("Retry-After")
+        try:
+            return max(0.0, float(value))
+        except (TypeError, ValueError):
+            return default
+
+    DESCRIBE_PROMPT = "Describe the main elements on this webpage. Include buttons, input fields, and links. Be concise and use bullet points."
+    # For a crop of the part of the page that changed since the last whole-page description
+    REGION_DESCRIBE_PROMPT = "This is a crop of a webpage showing an area that just changed. Describe what it shows now, including any menus, dialogs, messages, buttons, input fields, and links. Be concise and use bullet points."
+    # For screenshots with set-of-marks tags on controls that have no text label
+    MARKED_DESCRIBE_PROMPT = DESCRIBE_PROMPT + " Some controls carry a small numbered red tag; when you mention one of them, start its bullet with the number in brackets, e.g. [12]."
+
+    # The public calls, as steps
+
+    def _describe_image(self, image_bytes, question=None, on_token=None):
+        prompt = question or self.DESCRIBE_PROMPT
+        return (yield from self._cached("describe", image_bytes, self._prompt_key(prompt),
+                                        self._describe(image_bytes, prompt, on_token)))
+
+    def _describe(self, image_bytes, prompt, on_token=None):
+        if on_token is None or not self.streaming:
+            model_output = yield from self._query(image_bytes, prompt)
+            return self._response_text(model_output["raw_output"])
+
+        text = ""
+
+        def consume(event):
+            nonlocal text
+            if event.get("delta"):
+                text += event["delta"]
+                on_token(text)
+            if event.get("done"):
+                return self._response_text(event.get("raw_output", text))
+            return MORE
+
+        return (yield from self._stream(image_bytes, prompt, None, consume))
+
+    def _describe_many(self, image_bytes, questions):
+        prompts = [q or self.DESCRIBE_PROMPT for q in questions]
+
+        def answer(missing):
+            return [self._response_text(o["raw_output"]) for o in (yield from self._query_many(image_bytes, missing))]
+
+        return (yield from self._cached_many(
+            "describe", image_bytes, prompts, [self._prompt_key(p) for p in prompts], answer))
+
+    def _element_bbox(self, image_bytes, element_description, stream=None, coarse_to_fine=None):
+        if self.coarse_to_fine if coarse_to_fine is None else coarse_to_fine:
+            return (yield from self._cached("bbox-c2f", image_bytes, normalize_target(element_description),
+                                            self._ground_coarse_to_fine(image_bytes, element_description, stream)))
+        return (yield from self._cached("bbox", image_bytes, normalize_target(element_description),
+                                        self._ground(image_bytes, element_description, stream)))
+
+    def _ground(self, image_bytes, element_description, stream=None):
+        prompt = self._bbox_prompt(element_description)
+        if not (self.streaming if stream is None else stream):
+            model_output = yield from self._query(image_bytes, prompt, task="bbox")
+            return self._parse_bbox(model_output, element_description)
+
+        text = ""
+
+        def consume(event):
+            nonlocal text
+            if event.get("done"):
+                return self._parse_bbox({"raw_output": text, **event}, element_description)
+            text += event.get("delta", "")
+            try:
+                return extract_bbox(text)
+            except ValueError:
+                return MORE
+
+        return (yield from self._stream(image_bytes, prompt, "bbox", consume))
+
+    def _ground_coarse_to_fine(self, image_bytes, element_description, stream=None):
+        # Decoding, cropping and re-encoding are CPU work (off the event loop in the asyncio runtime)
+        img = yield ("_cpu", _decode, image_bytes)
+        coarse_bytes = yield ("_cpu", partial(encode_screenshot, img, "jpeg", max_pixels=self.coarse_max_pixels))
+        coarse = yield from self._ground(coarse_bytes, element_description, stream)
+        if coarse is None:
+            return None
+
+        crop_box = crop_region(img.size, coarse, self.crop_margin, self.crop_min_fraction)
+        crop_bytes = yield ("_cpu", partial(
+            encode_screenshot, img.crop(crop_box), "jpeg",
+            min_pixels=self.fine_min_pixels, max_pixels=self.fine_max_pixels,
+        ))
+        fine = yield from self._ground(crop_bytes, element_description, stream)
+        if fine is None:
+            # The crop lost the target (or the model did); the coarse box is still usable
+            return coarse
+        return bbox_from_crop(fine, crop_box, img.size)
+
+    def _element_bboxes(self, image_bytes, element_descriptions):
+        def ground(missing):
+            prompts = [self._bbox_prompt(d) for d in missing]
+            outputs = yield from self._query_many(image_bytes, prompts, tasks=["bbox"] * len(prompts))
+            return [self._parse_bbox(o, d) for o, d in zip(outputs, missing)]
+
+        keys = [normalize_target(d) for d in element_descriptions]
+        return (yield from self._cached_many("bbox", image_bytes, element_descriptions, keys, ground))
+
+    @staticmethod
+    def _prompt_key(prompt):
+        return " ".join(prompt.lower().split())
+
+    def _cached(self, kind, image_bytes, prompt_key, compute):
+        """The compute steps' answer unless the cache has one for this page and prompt; None answers are not kept."""
+        if self.cache is None:
+            return (yield from compute)
+        # The page hash decodes the screenshot and the disk tier is sqlite
+        key = yield ("_cpu", self.cache.key, kind, image_bytes, prompt_key)
+        value = yield ("_cpu", self.cache.get, key)
+        if value is None:
+            value = yield from compute
+            if value is not None:
+                yield ("_cpu", self.cache.put, key, value)
+        return value
+
+    def _cached_many(self, kind, image_bytes, items, prompt_keys, compute):
+        """Batch form of _cached: the compute(missing_items) steps run once, for the items not in the cache."""
+        if self.cache is None:
+            return (yield from compute(items))
+        keys, values = yield ("_cpu", self._cache_lookup, kind, image_bytes, prompt_keys)
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            computed = yield from compute([items[i] for i in missing])
+            for i, value in zip(missing, computed):
+                values[i] = value
+            fresh = [(keys[i], value) for i, value in zip(missing, computed) if value is not None]
+            if fresh:
+                yield ("_cpu", self._cache_store, fresh)
+        return values
+
+    def _cache_lookup(self, kind, image_bytes, prompt_keys):
+        keys = [self.cache.key(kind, image_bytes, k) for k in prompt_keys]
+        return keys, [self.cache.get(key) for key in keys]
+
+    def _cache_store(self, entries):
+        for key, value in entries:
+            self.cache.put(key, value)
+
+    @staticmethod
+    def _response_text(raw_output):
         if "assistant\n" in raw_output:
-            actual_response = raw_output.split("assistant\n")[-1].strip()
-        else:
-            actual_response = raw_output.strip()
+            return raw_output.split("assistant\n")[-1].strip()
+        return raw_output.strip()
 
-        return actual_response
+    @staticmethod
+    def _bbox_prompt(element_description):
+        return f"Give the exact bounding box of the {element_description} with absolute pixel coordinates in the format [x1,y1,x2,y2]."
 
-    def get_element_bbox(self, image_bytes, element_description):
-        """
-        Takes an image and a natural language description of an element,
-        and returns the bounding box of that element or None if not found.
-        """
-        prompt = f"Give the exact bounding box of the {element_description} with absolute pixel coordinates in the format [x1,y1,x2,y2]."
-        model_output = self.query_model(image_bytes, prompt)
+    @staticmethod
+    def _parse_bbox(model_output, element_description):
+        # Servers with task support return a parsed bbox; older ones only raw text
+        bbox = model_output.get("bbox")
+        if isinstance(bbox, list) and len(bbox) == 4:
+            return bbox
         raw = model_output["raw_output"].strip()
-        
         try:
             bbox = extract_bbox(raw)
             return bbox
@@ -89,3 +673,233 @@ class VisionProcessor:
         img_annotated = draw_point(img_annotated, (cx, cy), radius=12, color='red')
         
         return img_annotated
+
+
+class VisionProcessor(BaseVisionProcessor):
+    """Vision client over one keep-alive requests.Session, safe to share between threads."""
+
+    transport_errors = (requests.exceptions.RequestException,)
+
+    def __init__(self, model_url=None, streaming=None, cache=None, health_interval=None):
+        super().__init__(model_url, streaming, cache, health_interval)
+        # One keep-alive connection pool shared by every call (and every thread)
+        pool_size = int(os.environ.get("VISION_POOL_SIZE", "8"))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._hedge_pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="vision-hedge") if self.hedge else None
+        self._closed = threading.Event()
+        self._health_thread = None
+        if self.health_interval > 0:
+            self._health_thread = threading.Thread(target=self._health_loop, name="vision-health", daemon=True)
+            self._health_thread.start()
+
+    def close(self):
+        """Stop the health poller and release the connection pools."""
+        self._closed.set()
+        if self._health_thread is not None:
+            self._health_thread.join()
+        if self._hedge_pool is not None:
+            self._hedge_pool.shutdown(wait=False)
+        self.session.close()
+
+    def query_model(self, image_bytes, prompt, task=None):
+        """
+        Send screenshot + prompt to the Qwen-VL server.
+        task="bbox" asks the server for a short, early-stopped grounding answer.
+        """
+        return self._drive(self._query(image_bytes, prompt, task))
+
+    def query_many(self, image_bytes, prompts, tasks=None):
+        """
+        Send one screenshot with several prompts; the server answers them in a
+        single batched generation. Returns one {"raw_output": ...} per prompt.
+        """
+        return self._drive(self._query_many(image_bytes, prompts, tasks))
+
+    def describe_image(self, image_bytes, question=None, on_token=None):
+        """
+        Takes an image and returns a description of the elements on the page.
+        If a question is provided, it will be used as the prompt.
+        If on_token is given (and streaming is enabled), the answer is streamed
+        and on_token(text_so_far) is called as text arrives.
+        """
+        return self._drive(self._describe_image(image_bytes, question, on_token))
+
+    def describe_many(self, image_bytes, questions):
+        """Answer several questions about one screenshot in a single round-trip."""
+        return self._drive(self._describe_many(image_bytes, questions))
+
+    def get_element_bbox(self, image_bytes, element_description, stream=None, coarse_to_fine=None):
+        """
+        Takes an image and a natural language description of an element,
+        and returns the bounding box of that element or None if not found.
+        When streaming, returns as soon as a complete bbox has arrived.
+        With coarse_to_fine, a low-resolution pass locates the region and a
+        zoomed crop of it is grounded again; the result is in full-frame 0..1000 space.
+        """
+        return self._drive(self._element_bbox(image_bytes, element_description, stream, coarse_to_fine))
+
+    def get_element_bboxes(self, image_bytes, element_descriptions):
+        """Ground several elements on one screenshot in a single round-trip."""
+        return self._drive(self._element_bboxes(image_bytes, element_descriptions))
+
+    def _drive(self, steps):
+        """Run one of BaseVisionProcessor's step generators on the calling thread."""
+        value, error = None, None
+        while True:
+            try:
+                operation = steps.send(value) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value, error = getattr(self, operation[0])(*operation[1:]), None
+            except BaseException as e:  # thrown in so a streamed response is released on interrupts too
+                value, error = None, e
+
+    def _health_loop(self):
+        while not self._closed.is_set():
+            for endpoint in self.endpoints:
+                self._drive(self._check_health(endpoint))
+            self._closed.wait(self.health_interval)
+
+    # Transport operations the shared steps yield
+
+    def _http_post(self, url, data, files, stream):
+        return self.session.post(url, data=data, files=files, timeout=self.timeout, stream=stream)
+
+    def _http_get(self, url, timeout):
+        return self.session.get(url, timeout=timeout)
+
+    def _close(self, response):
+        response.close()
+
+    def _lines(self, response):
+        return response.iter_lines(decode_unicode=True)
+
+    def _next_line(self, lines):
+        return next(lines, None)
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+    def _cpu(self, fn, *args):
+        return fn(*args)
+
+    def _spawn(self, steps):
+        return self._hedge_pool.submit(self._drive, steps)
+
+    def _wait(self, futures, timeout):
+        return wait(futures, timeout=timeout, return_when=FIRST_COMPLETED).done
+
+    def _abandon(self, future):
+        future.add_done_callback(self._discard)
+
+    @staticmethod
+    def _discard(future):
+        if future.exception() is None:
+            future.result().close()
+
+
+class AsyncVisionProcessor(BaseVisionProcessor):
+    """
+    asyncio form of VisionProcessor for the async agent runtime: the same
+    replica choice, circuit breaker, retries, hedging and result cache, over
+    one httpx.AsyncClient, so a call in flight is a coroutine instead of a
+    blocked thread. Hedged losers are cancelled rather than left to finish.
+    """
+
+    transport_errors = (httpx.HTTPError,) if httpx is not None else ()
+
+    def __init__(self, model_url=None, streaming=None, cache=None, health_interval=None):
+        if httpx is None:
+            raise RuntimeError("AsyncVisionProcessor needs httpx (pip install httpx)")
+        super().__init__(model_url, streaming, cache, health_interval)
+        # Many sessions share this client, so its pool is sized separately from the threaded one
+        pool_size = int(os.environ.get("VISION_ASYNC_POOL_SIZE", "64"))
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+        )
+        self._health_task = None  # needs a running loop; started by the first request
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+        await self.client.aclose()
+
+    async def query_model(self, image_bytes, prompt, task=None):
+        return await self._drive(self._query(image_bytes, prompt, task))
+
+    async def query_many(self, image_bytes, prompts, tasks=None):
+        return await self._drive(self._query_many(image_bytes, prompts, tasks))
+
+    async def describe_image(self, image_bytes, question=None, on_token=None):
+        return await self._drive(self._describe_image(image_bytes, question, on_token))
+
+    async def describe_many(self, image_bytes, questions):
+        return await self._drive(self._describe_many(image_bytes, questions))
+
+    async def get_element_bbox(self, image_bytes, element_description, stream=None, coarse_to_fine=None):
+        return await self._drive(self._element_bbox(image_bytes, element_description, stream, coarse_to_fine))
+
+    async def get_element_bboxes(self, image_bytes, element_descriptions):
+        return await self._drive(self._element_bboxes(image_bytes, element_descriptions))
+
+    async def _drive(self, steps):
+        """VisionProcessor._drive, awaiting each operation on the event loop."""
+        value, error = None, None
+        while True:
+            try:
+                operation = steps.send(value) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value, error = await getattr(self, operation[0])(*operation[1:]), None
+            except BaseException as e:  # a cancelled call still closes its streamed response
+                value, error = None, e
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(self._drive(self._check_health(e)) for e in self.endpoints))
+            await asyncio.sleep(self.health_interval)
+
+    # Transport operations the shared steps yield
+
+    async def _http_post(self, url, data, files, stream):
+        if self.health_interval > 0 and self._health_task is None:
+            self._health_task = asyncio.get_running_loop().create_task(self._health_loop())
+        request = self.client.build_request("POST", url, data=data, files=files)
+        return await self.client.send(request, stream=stream)
+
+    async def _http_get(self, url, timeout):
+        return await self.client.get(url, timeout=timeout)
+
+    async def _close(self, response):
+        await response.aclose()
+
+    async def _lines(self, response):
+        return response.aiter_lines()
+
+    async def _next_line(self, lines):
+        try:
+            return await lines.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    async def _sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    async def _cpu(self, fn, *args):
+        return await asyncio.to_thread(fn, *args)
+
+    async def _spawn(self, steps):
+        return asyncio.ensure_future(self._drive(steps))
+
+    async def _wait(self, futures, timeout):
+        done, _ = await asyncio.wait(futures, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        return done
+
+    def _abandon(self, task):
+        task.cancel()  # no-op for finished ones
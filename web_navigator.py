@@ -1,14 +1,580 @@
 from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright
 from vision_processor import VisionProcessor
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from queue import Queue, Empty
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from itertools import count
+from collections import namedtuple, defaultdict, deque, Counter
+from utils import encode_screenshot, smart_resize, normalize_target
+from dom_grounding import DomIndex, ELEMENTS_JS
 import traceback
+import asyncio
+import hashlib
+import socket
+import time
+import os
 
-class WebNavigator:
-    def __init__(self, vision_processor):
+# Counts DOM mutations per document so a stored frame can be checked for staleness cheaply
+MUTATION_COUNTER_JS = """
+(() => {
+  if (window.__vwaMutations !== undefined) return;
+  window.__vwaMutations = 0;
+  window.__vwaDocument = Math.random();
+  new MutationObserver(() => { window.__vwaMutations++; }).observe(document, {
+    subtree: true, childList: true, attributes: true, characterData: true,
+  });
+})();
+"""
+
+# Both sides on the model's 32-px grid, so a screenshot needs no resize (and JPEG frames
+# come straight from the browser) at the default pixel budget
+VIEWPORT = {"width": 1280, "height": 896}
+
+# Commands that may change what is on screen; each one dirties the stored frame
+PAGE_ACTIONS = {"navigate", "scroll", "click", "type", "clear_input", "wait"}
+
+Frame = namedtuple("Frame", "version image_bytes mutations captured_at")
+# The planner-facing element index: ids are valid while `generation` is current
+ElementList = namedtuple("ElementList", "generation listing unlabeled")
+
+# Identifies the indexed DOM state: document, mutation count, scroll offset
+INDEX_STATE_JS = "[window.__vwaDocument ?? 0, window.__vwaMutations ?? -1, window.scrollX, window.scrollY]"
+
+# How long a blocking caller waits for each command; grounding commands include vision calls
+COMMAND_TIMEOUT_S = {
+    "navigate": 90,
+    "take_screenshot": 90,
+    "get_frame": 90,
+    "get_elements": 30,
+    "scroll": 30,
+    "click": 600,
+    "type": 600,
+    "clear_input": 600,
+    "get_url": 10,
+}
+
+# Upper bound on how long each action may wait for the page to settle; no longer than the
+# fixed sleeps these replaced, so pages that never go quiet are not slower than before.
+# Each can be overridden with BROWSER_SETTLE_<ACTION>_MS (e.g. BROWSER_SETTLE_NAVIGATE_MS).
+SETTLE_CEILING_MS = {
+    "navigate": 1000,
+    "click": 1000,
+    "type": 1000,
+    "scroll": 1000,
+    "clear_input": 200,  # settled twice per clear
+    "focus": 100,  # between the focusing click and the selecting double-click
+    "hover": 200,
+}
+# Long-lived streams never "finish"; they must not hold off network idle
+SETTLE_IGNORED_RESOURCES = {"websocket", "eventsource", "media"}
+
+
+class FrameStore:
+    """
+    Latest captured frame plus a monotonic page version. Anything that may change
+    the page bumps the version, and a stored frame is only served while the
+    version it was captured at is current.
+    """
+
+    def __init__(self, max_age):
+        self._lock = Lock()
+        self.version = 0
+        self.frame = None
+        self.hints = {}  # normalized element description -> bbox grounded on the current frame
+        self.max_age = max_age
+
+    def invalidate(self):
+        with self._lock:
+            self._bump()
+
+    def _bump(self):
+        self.version += 1
+        self.frame = None
+        self.hints = {}
+
+    def add_hint(self, version, element_description, bbox):
+        """Remember a (speculative) grounding result, unless the frame it used is already stale."""
+        with self._lock:
+            if bbox is not None and version == self.version:
+                self.hints[normalize_target(element_description)] = bbox
+
+    def hint(self, version, element_description):
+        with self._lock:
+            if version != self.version:
+                return None
+            return self.hints.get(normalize_target(element_description))
+
+    def put(self, image_bytes, mutations):
+        with self._lock:
+            self.frame = Frame(self.version, image_bytes, mutations, time.monotonic())
+            return self.frame
+
+    def latest(self, mutations):
+        """The stored frame if the DOM mutation count still matches, else None (and the store is dirtied)."""
+        with self._lock:
+            frame = self.frame
+            if frame is None or frame.version != self.version:
+                return None
+            if (mutations < 0 or mutations != frame.mutations
+                    or time.monotonic() - frame.captured_at > self.max_age):
+                self._bump()
+                return None
+            return frame
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _port_in_use(port):
+    with socket.socket() as sock:
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+
+class BrowserPool:
+    """
+    One Chromium process shared by many WebNavigators. Playwright objects are
+    bound to the thread that made them, so each navigator keeps its own thread,
+    connects to this browser over CDP and gets an isolated context (cookies,
+    storage, tabs) of its own.
+    """
+
+    def __init__(self, port=None, headless=None):
+        # A pinned port (BROWSER_CDP_PORT) must be free; by default a free one is picked, so a second
+        # app instance or a developer's Chrome with remote debugging is never attached to by mistake
+        port = int(os.environ.get("BROWSER_CDP_PORT", "0") if port is None else port)
+        if port and _port_in_use(port):
+            raise RuntimeError(f"CDP port {port} is already in use; set BROWSER_CDP_PORT to a free port or leave it unset")
+        self.port = port or _free_port()
+        if headless is None:
+            headless = os.environ.get("BROWSER_HEADLESS", "0") == "1"
+        self.headless = headless
+        self.endpoint = f"http://127.0.0.1:{self.port}"
+        self._ready = Event()
+        self._stop_event = Event()
+        self._error = None
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise RuntimeError(f"Could not start the shared browser: {self._error}")
+
+    def _run(self):
+        try:
+            with sync_playwright() as p:
+                browser = p.chromium.launch(headless=self.headless, args=[f"--remote-debugging-port={self.port}"])
+                self._ready.set()
+                self._stop_event.wait()
+                browser.close()
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+
+    def new_context(self, playwright, **options):
+        """(browser connection, new isolated context); call from the navigator's own thread."""
+        browser = playwright.chromium.connect_over_cdp(self.endpoint)
+        return browser, browser.new_context(**options)
+
+    def close(self):
+        self._stop_event.set()
+        self.thread.join()
+
+
+class BaseNavigator:
+    """
+    Settings, page-state bookkeeping (frame store, element index, settle and
+    grounding statistics) and the page logic shared by the threaded WebNavigator
+    and the asyncio AsyncWebNavigator, which only supply the browser I/O.
+    """
+
+    def __init__(self, vision_processor, pool=None):
         self.vision_processor = vision_processor
+        # With a BrowserPool this navigator is one context in a shared Chromium, else it launches its own
+        self.pool = pool
+        # Screenshot pipeline: format/quality of the upload and the pixel budget
+        # it is resized into (sides aligned to the model's 32 px token grid)
+        self.image_format = os.environ.get("VISION_IMAGE_FORMAT", "jpeg")
+        self.image_quality = int(os.environ.get("VISION_IMAGE_QUALITY", "90"))
+        self.min_pixels = int(os.environ.get("VISION_MIN_PIXELS", str(256 * 32 * 32)))
+        self.max_pixels = int(os.environ.get("VISION_MAX_PIXELS", str(1280 * 900)))
+        # One capture per page state, shared by the agent's observation and grounding
+        self.frames = FrameStore(float(os.environ.get("VISION_FRAME_MAX_AGE", "10")))
+        # Settle engine: an action is done once network, DOM and pixels are all quiet
+        self.settle_quiet_ms = float(os.environ.get("BROWSER_SETTLE_QUIET_MS", "150"))
+        self.settle_poll_ms = float(os.environ.get("BROWSER_SETTLE_POLL_MS", "50"))
+        self.settle_ceiling_ms = {
+            action: float(os.environ.get(f"BROWSER_SETTLE_{action.upper()}_MS", ms))
+            for action, ms in SETTLE_CEILING_MS.items()
+        }
+        # Requests may stay in flight up to this count without holding off settle...
+        self.settle_max_inflight = int(os.environ.get("BROWSER_SETTLE_MAX_INFLIGHT", "0"))
+        # ...and one pending longer than this is taken for a long-poll and ignored
+        self.settle_request_max_ms = float(os.environ.get("BROWSER_SETTLE_REQUEST_MAX_MS", "1000"))
+        self.settle_visual = os.environ.get("BROWSER_SETTLE_VISUAL", "1") == "1"
+        # A main-frame navigation in progress holds settle off until its new document has
+        # loaded (e.g. a search submitted with Enter), up to this long
+        self.settle_load_ms = float(os.environ.get("BROWSER_SETTLE_LOAD_MS", "10000"))
+        self._loading = None  # (navigation request, start time) until domcontentloaded
+        self.settle_times = defaultdict(lambda: deque(maxlen=200))
+        self.settle_timeouts = Counter()
+        self._inflight = {}  # request -> start time
+        self._mouse = None   # last known pointer position
+        # Grounding fast path: match descriptions against the DOM before asking the vision model
+        self.dom_grounding = os.environ.get("BROWSER_DOM_GROUNDING", "1") == "1"
+        self.dom_min_score = float(os.environ.get("BROWSER_DOM_MIN_SCORE", "0.75"))
+        self.dom_margin = float(os.environ.get("BROWSER_DOM_MARGIN", "0.2"))
+        # Elements up to this many viewport heights off screen are indexed, so scrolls reuse the index
+        self.index_reach = float(os.environ.get("BROWSER_ELEMENT_INDEX_REACH", "2"))
+        self._dom_index = (None, 0, None)  # (document/mutation key, generation, DomIndex)
+        self._index_generations = count(1)
+        self.grounding_counts = Counter()  # index, dom, vision
+        self.grounding_ms = defaultdict(lambda: deque(maxlen=200))  # dom_attempt, vision
+
+    def settle_stats(self):
+        """Per-action settle time summary: count, mean/p95 ms and how often the ceiling was hit."""
+        stats = {}
+        for action, times in list(self.settle_times.items()):
+            samples = sorted(times)
+            if samples:
+                stats[action] = {
+                    "count": len(samples),
+                    "mean_ms": sum(samples) / len(samples),
+                    "p95_ms": samples[int(0.95 * (len(samples) - 1))],
+                    "timeouts": self.settle_timeouts[action],
+                }
+        return stats
+
+    def grounding_stats(self):
+        """Element-id and DOM fast-path hit rate and the vision latency they saved (net of the DOM lookups)."""
+        index, dom, vision = (self.grounding_counts[k] for k in ("index", "dom", "vision"))
+        dom_ms, vision_ms = list(self.grounding_ms["dom_attempt"]), list(self.grounding_ms["vision"])
+        mean_vision = sum(vision_ms) / len(vision_ms) if vision_ms else 0.0
+        mean_dom = sum(dom_ms) / len(dom_ms) if dom_ms else 0.0
+        total = index + dom + vision
+        return {
+            "index_hits": index,
+            "dom_hits": dom,
+            "vision_calls": vision,
+            "hit_rate": (index + dom) / total if total else 0.0,
+            "dom_ms_mean": mean_dom,
+            "vision_ms_mean": mean_vision,
+            "saved_ms": (index + dom) * mean_vision - len(dom_ms) * mean_dom,
+        }
+
+    def _on_request(self, request):
+        if request.resource_type not in SETTLE_IGNORED_RESOURCES:
+            self._inflight[request] = time.monotonic()
+        try:
+            if request.is_navigation_request() and request.frame == self.page.main_frame:
+                self._loading = (request, time.monotonic())
+        except Exception:
+            pass  # no page yet, or a request without a frame (service worker)
+
+    def _on_request_done(self, request):
+        self._inflight.pop(request, None)
+
+    def _on_request_failed(self, request):
+        self._on_request_done(request)
+        if self._loading is not None and self._loading[0] is request:
+            self._loading = None  # no new document is coming
+
+    def _watch_page(self, page):
+        def _on_navigated(frame):
+            if frame == page.main_frame:
+                self.frames.invalidate()
+
+        def _on_loaded(_):
+            if page is self.page:
+                self._loading = None
+        page.on("framenavigated", _on_navigated)
+        page.on("domcontentloaded", _on_loaded)
+
+    def _navigation_pending(self, now):
+        """Whether the main frame is still loading a new document, within the load cap."""
+        return self._loading is not None and now - self._loading[1] < self.settle_load_ms / 1000.0
+
+    def _inflight_count(self, now):
+        # Requests pending this long are long-polls or leaks; drop them
+        for request, started in list(self._inflight.items()):
+            if now - started > self.settle_request_max_ms / 1000.0:
+                del self._inflight[request]
+        return len(self._inflight)
+
+    @staticmethod
+    def _wait_seconds(seconds):
+        try:
+            return float(seconds)
+        except Exception:
+            return 1.0
+
+    def _reuse_index(self, state):
+        """(generation, DomIndex) if the index still describes the page at state (document, mutations, x, y), else None."""
+        document, mutations, x, y = state
+        key, generation, index = self._dom_index
+        if index is not None and mutations >= 0 and key == (document, mutations) and index.covers(x, y):
+            index.scroll_to(x, y)
+            return generation, index
+        return None
+
+    def _store_index(self, state, snapshot):
+        """Index an ELEMENTS_JS snapshot taken at state under a new generation."""
+        index = DomIndex(snapshot, self.dom_min_score, self.dom_margin)
+        generation = next(self._index_generations)
+        self._dom_index = ((state[0], state[1]), generation, index)
+        return generation, index
+
+    @staticmethod
+    def _element_list(generation, index, limit):
+        unlabeled = [(element_id, bbox) for element_id, element, bbox in index.on_screen() if not element["name"]]
+        return ElementList(generation, index.listing(limit), unlabeled)
+
+    @staticmethod
+    def _center(bbox, viewport_size):
+        """Viewport pixel at the center of a normalized 0..1000 bbox."""
+        x1, y1, x2, y2 = bbox
+        px1, py1 = int(x1 / 1000 * viewport_size['width']), int(y1 / 1000 * viewport_size['height'])
+        px2, py2 = int(x2 / 1000 * viewport_size['width']), int(y2 / 1000 * viewport_size['height'])
+        return (px1 + px2) // 2, (py1 + py2) // 2
+
+    # The page logic of both navigators, written once as generators of browser operations.
+    # Each step yields (operation, *args) and is sent back the result, or has the operation's
+    # exception thrown in; WebNavigator._drive runs the operation on its thread's page and
+    # AsyncWebNavigator._drive awaits it, so the two classes only differ in the I/O.
+
+    def _navigate(self, url):
+        yield ("_goto", url)
+        yield from self._settle("navigate")
+        return True
+
+    def _take_screenshot(self):
+        return (yield from self._frame()).image_bytes
+
+    def _frame(self):
+        """The stored frame if the page is unchanged since it was captured, else a new capture."""
+        frame = self.frames.latest((yield from self._mutation_count()))
+        if frame is None:
+            frame = yield from self._capture()
+        return frame
+
+    def _ground(self, element_description, element_id=None, generation=None):
+        """
+        Bbox of an element on the current page: by element id while its index is
+        current, else from a speculative hint, the DOM, or the vision model.
+        """
+        if element_id is not None:
+            bbox = yield from self._indexed_box(element_id, generation)
+            if bbox is not None:
+                print(f"Using element [{element_id}] for '{element_description}'")
+                self.grounding_counts["index"] += 1
+                return bbox
+        # Reuses the frame the agent just observed unless the page has changed since
+        frame = yield from self._frame()
+        bbox = self.frames.hint(frame.version, element_description)
+        if bbox is not None:
+            print(f"Using pre-grounded bbox for '{element_description}'")
+            return bbox
+        if self.dom_grounding:
+            start = time.perf_counter()
+            bbox = yield from self._dom_ground(element_description)
+            self.grounding_ms["dom_attempt"].append((time.perf_counter() - start) * 1000)
+            if bbox is not None:
+                print(f"Grounded '{element_description}' from the DOM")
+                self.grounding_counts["dom"] += 1
+                return bbox
+        start = time.perf_counter()
+        bbox = yield ("_locate", frame.image_bytes, element_description)
+        self.grounding_ms["vision"].append((time.perf_counter() - start) * 1000)
+        self.grounding_counts["vision"] += 1
+        return bbox
+
+    def _element_index(self):
+        """(generation, DomIndex) of the current DOM; a scroll inside the indexed region keeps the generation."""
+        state = yield ("_evaluate", INDEX_STATE_JS)
+        reused = self._reuse_index(state)
+        if reused is not None:
+            return reused
+        return self._store_index(state, (yield ("_evaluate", ELEMENTS_JS, self.index_reach)))
+
+    def _dom_ground(self, element_description):
+        """Bbox from the DOM index, if exactly one on-screen element clearly matches."""
+        try:
+            return (yield from self._element_index())[1].resolve(element_description)
+        except Exception as e:
+            print(f"DOM snapshot failed, using vision: {e}")
+            return None
+
+    def _indexed_box(self, element_id, generation):
+        try:
+            current, index = yield from self._element_index()
+        except Exception:
+            return None
+        if generation is not None and generation != current:
+            print(f"Element [{element_id}] is from an outdated index; grounding by description")
+            return None
+        return index.box(element_id)
+
+    def _elements(self, limit):
+        return self._element_list(*(yield from self._element_index()), limit)
+
+    def _mutation_count(self):
+        try:
+            return (yield ("_evaluate", "window.__vwaMutations ?? -1"))
+        except Exception:
+            return -1  # unknown: treat the page as dirty
+
+    def _capture(self):
+        yield ("_front",)
+        vp = self.page.viewport_size
+        # Nudge mouse to center so hidden controls (e.g., video bars) appear
+        try:
+            cx, cy = int(vp['width'] / 2), int(vp['height'] / 2)
+            if self._mouse != (cx, cy):
+                yield ("_pointer", "move", cx, cy)
+                self._mouse = (cx, cy)
+                # Short settle to allow overlays/controls to reveal
+                yield from self._settle("hover", visual=False)
+        except Exception:
+            pass
+        # Count mutations before capturing so any change during the capture dirties the frame
+        mutations = yield from self._mutation_count()
+        target = smart_resize(vp['width'], vp['height'], min_pixels=self.min_pixels, max_pixels=self.max_pixels)
+        # Give a more generous timeout; some pages are slow
+        if self.image_format == "jpeg" and target == (vp['width'], vp['height']):
+            # Already on the grid: let the browser encode the JPEG directly
+            image_bytes = yield ("_screenshot", {"timeout": 60000, "type": "jpeg", "quality": self.image_quality})
+        else:
+            png = yield ("_screenshot", {"timeout": 60000})
+            image_bytes = yield ("_encode", png)
+        return self.frames.put(image_bytes, mutations)
+
+    def _scroll(self, direction):
+        if direction == "down":
+            yield ("_evaluate", "window.scrollBy(0, window.innerHeight)")
+        elif direction == "up":
+            yield ("_evaluate", "window.scrollBy(0, -window.innerHeight)")
+        yield from self._settle("scroll")
+        return True
+
+    def _click(self, element_description, element_id=None, generation=None):
+        yield ("_front",)
+        bbox = yield from self._ground(element_description, element_id, generation)
+        if bbox is None:
+            return False  # Signal failure
+        cx, cy = self._center(bbox, self.page.viewport_size)
+        print(f"Clicking on '{element_description}' at: ({cx}, {cy})")
+        yield ("_pointer", "click", cx, cy)
+        self._mouse = (cx, cy)
+        yield from self._settle("click")
+        return True  # Signal success
+
+    def _type(self, text, element_description, element_id=None, generation=None):
+        if not (yield from self._clear_input(element_description, element_id, generation)):
+            return False
+        print(f"Typing '{text}' into '{element_description}'")
+        yield ("_keyboard", "type", text)
+        print("Pressing Enter to submit.")
+        yield ("_keyboard", "press", "Enter")
+        yield from self._settle("type")
+        return True
+
+    def _clear_input(self, element_description, element_id=None, generation=None):
+        print(f"Attempting to clear input field: '{element_description}'")
+        # Compute click target via vision and triple-click to focus+select
+        bbox = yield from self._ground(element_description, element_id, generation)
+        if bbox is None:
+            return False
+        cx, cy = self._center(bbox, self.page.viewport_size)
+
+        # Bring to front, focus with single click, then double-click to select
+        yield ("_front",)
+        yield ("_pointer", "click", cx, cy)      # focus
+        # Let focus handlers (autocomplete, input masks) run before selecting
+        yield from self._settle("focus", visual=False)
+        yield ("_pointer", "dblclick", cx, cy)   # select word/field
+        self._mouse = (cx, cy)
+        yield from self._settle("clear_input", visual=False)
+
+        # Aggressive clearing: many backspaces, then a few deletes
+        for key, presses in (("Backspace", 40), ("Delete", 10)):
+            for _ in range(presses):
+                try:
+                    yield ("_keyboard", "press", key)
+                except Exception:
+                    break
+        yield from self._settle("clear_input", visual=False)
+        print(f"Input field '{element_description}' cleared.")
+        return True
+
+    def _settle(self, action, visual=None):
+        """
+        Wait until the page is stable after an action, or until its ceiling.
+        Stable means no tracked requests in flight and no DOM mutations for the
+        quiet window, then (if visual) two consecutive identical low-res frames.
+        While the main frame is loading a new document (a form submitted with
+        Enter, a link) settle waits for it, and the ceiling counts from its load.
+        """
+        began = start = time.monotonic()
+        ceiling = self.settle_ceiling_ms.get(action, 1000) / 1000.0
+        quiet = self.settle_quiet_ms / 1000.0
+        visual = self.settle_visual if visual is None else visual
+        mutations = yield from self._mutation_count()
+        last_change = start
+        last_hash = None
+        settled = False
+        while True:
+            # Also lets Playwright dispatch request/navigation events to our handlers
+            yield ("_sleep", self.settle_poll_ms)
+            now = time.monotonic()
+            if self._navigation_pending(now):
+                start, mutations, last_change, last_hash = now, None, now, None
+                continue
+            if now - start >= ceiling:
+                break
+            count = yield from self._mutation_count()
+            if count != mutations or self._inflight_count(now) > self.settle_max_inflight:
+                mutations, last_change, last_hash = count, now, None
+                continue
+            if now - last_change < quiet:
+                continue
+            if not visual:
+                settled = True
+                break
+            frame_hash = yield from self._visual_hash()
+            if frame_hash is not None and frame_hash == last_hash:
+                settled = True
+                break
+            last_hash = frame_hash
+        self.settle_times[action].append((time.monotonic() - began) * 1000.0)
+        if not settled:
+            self.settle_timeouts[action] += 1
+
+    def _visual_hash(self):
+        try:
+            shot = yield ("_screenshot", {"type": "jpeg", "quality": 20, "scale": "css", "timeout": 2000})
+        except Exception:
+            return None
+        return hashlib.blake2b(shot, digest_size=16).digest()
+
+    def _wait(self, seconds):
+        yield ("_sleep", self._wait_seconds(seconds) * 1000)
+        return True
+
+    def _get_url(self):
+        try:
+            return self.page.url
+        except Exception:
+            return ""
+
+
+class WebNavigator(BaseNavigator):
+    def __init__(self, vision_processor, pool=None):
+        super().__init__(vision_processor, pool)
+        # Each command carries an id and its own Future, so results cannot be crossed
         self.command_queue = Queue()
-        self.result_queue = Queue()
+        self._command_ids = count(1)
         self._stop_event = Event()
 
         self.thread = Thread(target=self._run_playwright)
@@ -16,11 +582,11 @@ class WebNavigator:
 
     def _run_playwright(self):
         with sync_playwright() as p:
-            self.browser = p.chromium.launch(headless=False)
-            self.context = self.browser.new_context(
-                viewport={"width": 1280, "height": 900},
-                device_scale_factor=1
-            )
+            if self.pool is not None:
+                self.browser, self.context = self.pool.new_context(p, viewport=VIEWPORT, device_scale_factor=1)
+            else:
+                self.browser = p.chromium.launch(headless=False)
+                self.context = self.browser.new_context(viewport=VIEWPORT, device_scale_factor=1)
             # Abort font requests to avoid screenshot hangs on "waiting for fonts to load"
             try:
                 def _route_all(route):
@@ -31,55 +597,107 @@ class WebNavigator:
                 self.context.route("**/*", _route_all)
             except Exception:
                 pass
+            self.context.add_init_script(MUTATION_COUNTER_JS)
+            self.context.on("request", self._on_request)
+            self.context.on("requestfinished", self._on_request_done)
+            self.context.on("requestfailed", self._on_request_failed)
             self.page = self.context.new_page()
+            self._watch_page(self.page)
             
             self.context.on("page", self._on_new_page_internal)
 
             while not self._stop_event.is_set():
                 try:
                     command = self.command_queue.get(timeout=1)
-                    action = command.get("action")
-                    data = command.get("data")
-                    
-                    result = None
-                    if action == "navigate":
-                        self._navigate(data)
-                        result = True
-                    elif action == "take_screenshot":
-                        result = self._take_screenshot()
-                    elif action == "scroll":
-                        self._scroll(data)
-                        result = True
-                    elif action == "click":
-                        result = self._click(data)
-                    elif action == "type":
-                        result = self._type(data)
-                    elif action == "clear_input":
-                        result = self._clear_input(data)
-                    elif action == "wait":
-                        result = self._wait(data)
-                    elif action == "get_url":
-                        result = self._get_url()
-                    
-                    self.result_queue.put(result)
-                
                 except Empty:
-                    continue 
-                except Exception as e:
-                    print(f"Error in Playwright thread for action '{action}':")
-                    traceback.print_exc()
-                    self.result_queue.put(False) # Put False on error
+                    continue
+                self._dispatch(command)
 
+            # Commands nobody will run any more
+            while True:
+                try:
+                    self.command_queue.get_nowait()["future"].cancel()
+                except Empty:
+                    break
+            # A pooled navigator only closes its own context and disconnects
             self.browser.close()
 
+    def _dispatch(self, command):
+        future = command["future"]
+        if not future.set_running_or_notify_cancel():
+            return  # cancelled (or timed out) before the browser thread got to it
+        action = command.get("action")
+        data = command.get("data")
+        try:
+            result = None
+            if action == "navigate":
+                result = self._drive(self._navigate(data))
+            elif action == "take_screenshot":
+                result = self._drive(self._take_screenshot())
+            elif action == "scroll":
+                result = self._drive(self._scroll(data))
+            elif action == "click":
+                result = self._drive(self._click(**data))
+            elif action == "type":
+                result = self._drive(self._type(**data))
+            elif action == "clear_input":
+                result = self._drive(self._clear_input(**data))
+            elif action == "wait":
+                result = self._drive(self._wait(data))
+            elif action == "get_url":
+                result = self._get_url()
+            elif action == "get_frame":
+                result = self._drive(self._frame())
+            elif action == "get_elements":
+                result = self._drive(self._elements(data))
+            else:
+                raise ValueError(f"Unknown browser command '{action}'")
+        except Exception as e:
+            print(f"Error in Playwright thread for command #{command['id']} '{action}':")
+            traceback.print_exc()
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            if action in PAGE_ACTIONS:
+                self.frames.invalidate()
+
     def _on_new_page_internal(self, new_page):
         print("🤖 New tab or window opened. Switching context.")
         self.page = new_page
+        self._watch_page(new_page)
+        self.frames.invalidate()
+        self._mouse = None
+        self._loading = None
         self.page.bring_to_front()
 
-    def _execute_command(self, command):
-        self.command_queue.put(command)
-        return self.result_queue.get()
+    def submit(self, action, data=None):
+        """
+        Queue a command for the browser thread and return its Future right away,
+        so callers can overlap other work (encoding, vision uploads) with it.
+        Cancelling the Future before the browser thread starts it skips the command.
+        """
+        future = Future()
+        self.command_queue.put({"id": next(self._command_ids), "action": action, "data": data, "future": future})
+        return future
+
+    def _execute_command(self, command, timeout=None):
+        """Blocking form of submit: the result, or False on error or timeout."""
+        action = command["action"]
+        if timeout is None:
+            timeout = COMMAND_TIMEOUT_S.get(action)
+            if action == "wait":
+                timeout = self._wait_seconds(command.get("data")) + 30
+        future = self.submit(action, command.get("data"))
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            # Not started yet: drop it. Already running: its late result stays in its own Future.
+            future.cancel()
+            print(f"Browser command '{action}' timed out after {timeout}s")
+            return False
+        except Exception:
+            return False
 
     def navigate(self, url):
         return self._execute_command({"action": "navigate", "data": url})
@@ -87,17 +705,29 @@ class WebNavigator:
     def take_screenshot(self):
         return self._execute_command({"action": "take_screenshot"})
 
+    def get_frame(self):
+        """Latest Frame (version, image_bytes, ...); re-captured only if the page changed."""
+        return self._execute_command({"action": "get_frame"})
+
+    def get_elements(self, limit=50):
+        """ElementList of the interactive elements on screen; its ids can be passed to click/type/clear_input."""
+        return self._execute_command({"action": "get_elements", "data": limit})
+
     def scroll(self, direction):
         return self._execute_command({"action": "scroll", "data": direction})
 
-    def click(self, element_description):
-        return self._execute_command({"action": "click", "data": element_description})
+    # element_id/generation come from get_elements(); the description is used if the id no longer applies
+    def click(self, element_description, element_id=None, generation=None):
+        return self._execute_command({"action": "click", "data": {
+            "element_description": element_description, "element_id": element_id, "generation": generation}})
 
-    def type(self, text, element_description):
-        return self._execute_command({"action": "type", "data": {"text": text, "element_description": element_description}})
-    
-    def clear_input(self, element_description):
-        return self._execute_command({"action": "clear_input", "data": element_description})
+    def type(self, text, element_description, element_id=None, generation=None):
+        return self._execute_command({"action": "type", "data": {
+            "text": text, "element_description": element_description, "element_id": element_id, "generation": generation}})
+
+    def clear_input(self, element_description, element_id=None, generation=None):
+        return self._execute_command({"action": "clear_input", "data": {
+            "element_description": element_description, "element_id": element_id, "generation": generation}})
 
     def wait(self, seconds):
         return self._execute_command({"action": "wait", "data": seconds})
@@ -109,114 +739,228 @@ class WebNavigator:
         self._stop_event.set()
         self.thread.join()
 
-    def _navigate(self, url):
+    def _drive(self, steps):
+        """Run one of BaseNavigator's step generators on this thread's page."""
+        value, error = None, None
+        while True:
+            try:
+                operation = steps.send(value) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value, error = getattr(self, operation[0])(*operation[1:]), None
+            except Exception as e:
+                value, error = None, e
+
+    # Browser operations the shared steps yield
+
+    def _goto(self, url):
         self.page.goto(url, wait_until="domcontentloaded")
-        self.page.wait_for_timeout(1000)
 
-    def _take_screenshot(self):
+    def _evaluate(self, script, arg=None):
+        return self.page.evaluate(script, arg)
+
+    def _screenshot(self, options):
+        return self.page.screenshot(**options)
+
+    def _front(self):
         self.page.bring_to_front()
-        # Nudge mouse to center so hidden controls (e.g., video bars) appear
+
+    def _pointer(self, method, x, y):
+        getattr(self.page.mouse, method)(x, y)
+
+    def _keyboard(self, method, text):
+        getattr(self.page.keyboard, method)(text)
+
+    def _sleep(self, ms):
+        self.page.wait_for_timeout(ms)
+
+    def _encode(self, png):
+        return encode_screenshot(png, self.image_format, self.image_quality, self.min_pixels, self.max_pixels)
+
+    def _locate(self, image_bytes, element_description):
+        return self.vision_processor.get_element_bbox(image_bytes, element_description)
+
+
+class AsyncBrowserPool:
+    """
+    One Chromium shared by the AsyncWebNavigators of an event loop. Async
+    Playwright objects belong to the loop rather than to a thread, so each
+    navigator opens its isolated context on this browser directly.
+    """
+
+    def __init__(self, headless=None):
+        if headless is None:
+            headless = os.environ.get("BROWSER_HEADLESS", "0") == "1"
+        self.headless = headless
+        self.playwright = None
+        self.browser = None
+
+    async def start(self):
+        self.playwright = await async_playwright().start()
+        self.browser = await self.playwright.chromium.launch(headless=self.headless)
+        return self
+
+    async def new_context(self, **options):
+        return await self.browser.new_context(**options)
+
+    async def close(self):
+        await self.browser.close()
+        await self.playwright.stop()
+
+
+class AsyncWebNavigator(BaseNavigator):
+    """
+    WebNavigator for the asyncio runtime, on playwright.async_api. Every public
+    method is a coroutine that drives the page on the event loop, so a session
+    costs no browser thread; commands still run one at a time per navigator.
+    Needs an AsyncVisionProcessor and `await start()` before use. Like
+    WebNavigator, a failed or timed-out command returns False.
+    """
+
+    def __init__(self, vision_processor, pool=None):
+        super().__init__(vision_processor, pool)
+        self._command_lock = asyncio.Lock()
+        self._playwright = None
+        self.browser = None
+
+    async def start(self):
+        if self.pool is not None:
+            self.context = await self.pool.new_context(viewport=VIEWPORT, device_scale_factor=1)
+        else:
+            self._playwright = await async_playwright().start()
+            self.browser = await self._playwright.chromium.launch(headless=False)
+            self.context = await self.browser.new_context(viewport=VIEWPORT, device_scale_factor=1)
+
+        # Abort font requests to avoid screenshot hangs on "waiting for fonts to load"
+        async def _route_all(route):
+            if route.request.resource_type == "font":
+                await route.abort()
+            else:
+                await route.continue_()
         try:
-            vp = self.page.viewport_size
-            cx, cy = int(vp['width'] / 2), int(vp['height'] / 2)
-            self.page.mouse.move(cx, cy)
-            # Small settle to allow overlays/controls to reveal
-            self.page.wait_for_timeout(200)
+            await self.context.route("**/*", _route_all)
         except Exception:
             pass
-        # Give a more generous timeout; some pages are slow
-        return self.page.screenshot(timeout=60000)
+        await self.context.add_init_script(MUTATION_COUNTER_JS)
+        self.context.on("request", self._on_request)
+        self.context.on("requestfinished", self._on_request_done)
+        self.context.on("requestfailed", self._on_request_failed)
+        self.page = await self.context.new_page()
+        self._watch_page(self.page)
+        self.context.on("page", self._on_new_page_internal)
+        return self
 
-    def _scroll(self, direction):
-        if direction == "down":
-            self.page.evaluate("window.scrollBy(0, window.innerHeight)")
-        elif direction == "up":
-            self.page.evaluate("window.scrollBy(0, -window.innerHeight)")
-        self.page.wait_for_timeout(1000)
+    async def close(self):
+        await self.context.close()
+        if self.browser is not None:
+            await self.browser.close()
+            await self._playwright.stop()
 
-    def _click(self, element_description):
-        self.page.bring_to_front()
-        viewport_size = self.page.viewport_size
-        self.page.mouse.move(viewport_size['width'] / 2, viewport_size['height'] / 2)
-        self.page.wait_for_timeout(500) 
+    async def _on_new_page_internal(self, new_page):
+        print("🤖 New tab or window opened. Switching context.")
+        self.page = new_page
+        self._watch_page(new_page)
+        self.frames.invalidate()
+        self._mouse = None
+        self._loading = None
+        await self.page.bring_to_front()
 
-        screenshot_bytes = self._take_screenshot()
-        bbox = self.vision_processor.get_element_bbox(screenshot_bytes, element_description)
-        
-        if bbox is None:
-            return False # Signal failure
+    async def _execute(self, action, steps, timeout=None):
+        """Run one command's steps with its timeout; the result, or False on error or timeout."""
+        if timeout is None:
+            timeout = COMMAND_TIMEOUT_S.get(action)
 
-        x1, y1, x2, y2 = bbox
-        px1, py1 = int(x1 / 1000 * viewport_size['width']), int(y1 / 1000 * viewport_size['height'])
-        px2, py2 = int(x2 / 1000 * viewport_size['width']), int(y2 / 1000 * viewport_size['height'])
-        cx, cy = (px1 + px2) // 2, (py1 + py2) // 2
-        print(f"Clicking on '{element_description}' at: ({cx}, {cy})")
-        self.page.mouse.click(cx, cy)
-        self.page.wait_for_timeout(1000)
-        return True # Signal success
+        async def run():
+            async with self._command_lock:
+                try:
+                    return await self._drive(steps)
+                finally:
+                    if action in PAGE_ACTIONS:
+                        self.frames.invalidate()
 
-    def _type(self, data):
-        text, element_description = data["text"], data["element_description"]
-        if not self._clear_input(element_description):
+        try:
+            return await asyncio.wait_for(run(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Browser command '{action}' timed out after {timeout}s")
             return False
-        
-        print(f"Typing '{text}' into '{element_description}'")
-        self.page.keyboard.type(text)
-        print("Pressing Enter to submit.")
-        self.page.keyboard.press("Enter")
-        self.page.wait_for_load_state("domcontentloaded")
-        self.page.wait_for_timeout(1000)
-        return True
-
-    def _clear_input(self, element_description):
-        print(f"Attempting to clear input field: '{element_description}'")
-        # Compute click target via vision and triple-click to focus+select
-        screenshot_bytes = self._take_screenshot()
-        bbox = self.vision_processor.get_element_bbox(screenshot_bytes, element_description)
-        if bbox is None:
+        except Exception:
+            print(f"Error in browser command '{action}':")
+            traceback.print_exc()
             return False
 
-        viewport_size = self.page.viewport_size
-        x1, y1, x2, y2 = bbox
-        px1, py1 = int(x1 / 1000 * viewport_size['width']), int(y1 / 1000 * viewport_size['height'])
-        px2, py2 = int(x2 / 1000 * viewport_size['width']), int(y2 / 1000 * viewport_size['height'])
-        cx, cy = (px1 + px2) // 2, (py1 + py2) // 2
+    async def navigate(self, url):
+        return await self._execute("navigate", self._navigate(url))
 
-        # Bring to front, focus with single click, then double-click to select
-        self.page.bring_to_front()
-        self.page.mouse.move(cx, cy)
-        self.page.wait_for_timeout(60)
-        self.page.mouse.click(cx, cy)      # focus
-        self.page.wait_for_timeout(80)
-        self.page.mouse.dblclick(cx, cy)   # select word/field
-        self.page.wait_for_timeout(120)
+    async def take_screenshot(self):
+        return await self._execute("take_screenshot", self._take_screenshot())
 
-        # Aggressive clearing: many backspaces, then a few deletes
-        for _ in range(40):
+    async def get_frame(self):
+        return await self._execute("get_frame", self._frame())
+
+    async def get_elements(self, limit=50):
+        return await self._execute("get_elements", self._elements(limit))
+
+    async def scroll(self, direction):
+        return await self._execute("scroll", self._scroll(direction))
+
+    async def click(self, element_description, element_id=None, generation=None):
+        return await self._execute("click", self._click(element_description, element_id, generation))
+
+    async def type(self, text, element_description, element_id=None, generation=None):
+        return await self._execute("type", self._type(text, element_description, element_id, generation))
+
+    async def clear_input(self, element_description, element_id=None, generation=None):
+        return await self._execute("clear_input", self._clear_input(element_description, element_id, generation))
+
+    async def wait(self, seconds):
+        return await self._execute("wait", self._wait(seconds), self._wait_seconds(seconds) + 30)
+
+    async def get_current_url(self):
+        return self._get_url()
+
+    async def _drive(self, steps):
+        """WebNavigator._drive, awaiting each operation on the event loop."""
+        value, error = None, None
+        while True:
             try:
-                self.page.keyboard.press("Backspace")
-            except Exception:
-                break
-        self.page.wait_for_timeout(80)
-        for _ in range(10):
+                operation = steps.send(value) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
             try:
-                self.page.keyboard.press("Delete")
-            except Exception:
-                break
-        self.page.wait_for_timeout(120)
-        print(f"Input field '{element_description}' cleared.")
-        return True
+                value, error = await getattr(self, operation[0])(*operation[1:]), None
+            except Exception as e:
+                value, error = None, e
 
-    def _wait(self, seconds):
-        try:
-            ms = int(float(seconds) * 1000)
-        except Exception:
-            ms = 1000
-        self.page.wait_for_timeout(ms)
-        return True
+    # Browser operations the shared steps yield
 
-    def _get_url(self):
-        try:
-            return self.page.url
-        except Exception:
-            return ""
+    async def _goto(self, url):
+        await self.page.goto(url, wait_until="domcontentloaded")
+
+    async def _evaluate(self, script, arg=None):
+        return await self.page.evaluate(script, arg)
+
+    async def _screenshot(self, options):
+        return await self.page.screenshot(**options)
+
+    async def _front(self):
+        await self.page.bring_to_front()
+
+    async def _pointer(self, method, x, y):
+        await getattr(self.page.mouse, method)(x, y)
+
+    async def _keyboard(self, method, text):
+        await getattr(self.page.keyboard, method)(text)
+
+    async def _sleep(self, ms):
+        # Polls yield to the loop, so other sessions run meanwhile
+        await asyncio.sleep(ms / 1000.0)
+
+    async def _encode(self, png):
+        # Resizing and encoding are CPU work; keep them off the event loop
+        return await asyncio.to_thread(
+            encode_screenshot, png, self.image_format, self.image_quality, self.min_pixels, self.max_pixels,
+        )
+
+    async def _locate(self, image_bytes, element_description):
+        return await self.vision_processor.get_element_bbox(image_bytes, element_description)